@@ -0,0 +1,106 @@
+"""
+Measures the stitching throughput (patches per second) of the `StandardPredictor`: the legacy per-sample loop
+(halo removal, logging and visit counting of every patch) vs the batch stitching with pre-computed slices and
+normalization weights (`_PatchStitcher`).
+The network forward pass is not included, predictions are random patches generated up front.
+
+Usage:
+    python benchmarks/stitching.py --volume_shape 64 256 256 --patch_shape 32 64 64 --stride_shape 16 48 48
+"""
+import argparse
+import logging
+import os
+import time
+
+import numpy as np
+
+from pytorch3dunet.datasets.utils import SliceBuilder
+from pytorch3dunet.unet3d.predictor import _PatchStitcher
+from pytorch3dunet.unet3d.utils import get_logger, remove_halo
+
+logger = get_logger('StitchingBenchmark')
+
+
+def _batches(slices, batch_size):
+    for i in range(0, len(slices), batch_size):
+        yield slices[i:i + batch_size]
+
+
+def legacy_stitching(predictions, batches, prediction_map, normalization_mask, volume_shape, patch_halo):
+    # per-patch INFO logging of the legacy predictor, the output is discarded
+    legacy_logger = logging.getLogger('LegacyStitching')
+    legacy_logger.setLevel(logging.INFO)
+    legacy_logger.propagate = False
+    if not legacy_logger.handlers:
+        stream_handler = logging.StreamHandler(open(os.devnull, 'w'))
+        stream_handler.setFormatter(
+            logging.Formatter('%(asctime)s [%(threadName)s] %(levelname)s %(name)s - %(message)s'))
+        legacy_logger.addHandler(stream_handler)
+    out_channels = prediction_map.shape[0]
+    for indices in batches:
+        prediction = predictions[:len(indices)]
+        for pred, index in zip(prediction, indices):
+            index = (slice(0, out_channels),) + index
+            legacy_logger.info(f'Saving predictions for slice:{index}...')
+            u_prediction, u_index = remove_halo(pred, index, volume_shape, patch_halo)
+            prediction_map[u_index] += u_prediction
+            normalization_mask[u_index] += 1
+
+
+def batch_stitching(predictions, batches, prediction_map, stitcher):
+    for indices in batches:
+        stitcher.stitch(predictions[:len(indices)], indices, prediction_map)
+
+
+def _measure(name, fn, num_patches, repeats):
+    durations = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        durations.append(time.perf_counter() - start)
+    duration = min(durations)
+    patches_per_second = num_patches / duration
+    logger.info(f'{name}: {patches_per_second:.1f} patches/s ({duration:.3f}s for {num_patches} patches)')
+    return patches_per_second
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Predictor stitching benchmark')
+    parser.add_argument('--volume_shape', type=int, nargs=3, default=[64, 256, 256])
+    parser.add_argument('--patch_shape', type=int, nargs=3, default=[32, 64, 64])
+    parser.add_argument('--stride_shape', type=int, nargs=3, default=[16, 48, 48])
+    parser.add_argument('--patch_halo', type=int, nargs=3, default=[4, 8, 8])
+    parser.add_argument('--out_channels', type=int, default=2)
+    parser.add_argument('--batch_size', type=int, default=8)
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+
+    volume_shape = tuple(args.volume_shape)
+    patch_shape = tuple(args.patch_shape)
+    slices = SliceBuilder._build_slices(np.empty(volume_shape, dtype='uint8'), patch_shape, args.stride_shape)
+    batches = list(_batches(slices, args.batch_size))
+    predictions = np.random.rand(args.batch_size, args.out_channels, *patch_shape).astype('float32')
+    output_shape = (args.out_channels,) + volume_shape
+    logger.info(f'Volume: {volume_shape}, patch: {patch_shape}, stride: {tuple(args.stride_shape)}, '
+                f'number of patches: {len(slices)}, batch size: {args.batch_size}')
+
+    def _run_legacy():
+        legacy_stitching(predictions, batches, np.zeros(output_shape, dtype='float32'),
+                         np.zeros(output_shape, dtype='uint8'), volume_shape, args.patch_halo)
+
+    def _run_batch(blending):
+        def _run():
+            # slices and weights are pre-computed once per prediction, so count it in
+            stitcher = _PatchStitcher(volume_shape, blending, args.patch_halo, slices=slices)
+            batch_stitching(predictions, batches, np.zeros(output_shape, dtype='float32'), stitcher)
+
+        return _run
+
+    before = _measure('legacy per-sample stitching', _run_legacy, len(slices), args.repeats)
+    after = _measure('batch stitching (average)', _run_batch('average'), len(slices), args.repeats)
+    _measure('batch stitching (gaussian)', _run_batch('gaussian'), len(slices), args.repeats)
+    logger.info(f'Speedup (average blending): {after / before:.2f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,25 @@
+import argparse
+
+from pytorch3dunet.datasets.hdf5 import AbstractHDF5Dataset
+from pytorch3dunet.datasets.npy import convert_h5_to_npy
+from pytorch3dunet.unet3d import utils
+
+logger = utils.get_logger('UNet3DConvert')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert H5 files into the memory-mapped .npy files of the NpyDataset')
+    parser.add_argument('file_paths', type=str, nargs='+', help='H5 files or directories containing the H5 files')
+    parser.add_argument('--output-dir', type=str, required=True, help='Output directory')
+    parser.add_argument('--internal-path', type=str, action='append', default=None,
+                        help='Internal path of the dataset to convert; can be given multiple times '
+                             '(all datasets are converted by default)')
+    args = parser.parse_args()
+
+    for file_path in AbstractHDF5Dataset.traverse_h5_paths(args.file_paths):
+        container = convert_h5_to_npy(file_path, args.output_dir, args.internal_path)
+        logger.info(f'Converted {file_path} to: {container}')
+
+
+if __name__ == '__main__':
+    main()
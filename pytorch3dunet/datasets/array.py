@@ -0,0 +1,77 @@
+import numpy as np
+import torch
+
+from pytorch3dunet.augment import transforms
+from pytorch3dunet.datasets.utils import ConfigDataset, PaddedVolume, calculate_stats, get_slice_builder
+from pytorch3dunet.unet3d.utils import get_logger
+
+logger = get_logger('ArrayDataset')
+
+
+class ArrayDataset(ConfigDataset):
+    """
+    Implementation of the test dataset backed by an in-memory NumPy array (or torch tensor), which iterates over the
+    volume patch by patch with a given stride. Used for the prediction without any file I/O
+    (see `StandardPredictor.predict_array`).
+    """
+
+    def __init__(self, raw, slice_builder_config, transformer_config, mirror_padding=None, stats=None):
+        """
+        :param raw: 3D (DxHxW) or 4D (CxDxHxW) input volume; 2D (HxW) images are expanded to (1xHxW)
+        :param slice_builder_config: configuration of the SliceBuilder
+        :param transformer_config: data transformation configuration
+        :param mirror_padding (int or tuple): number of voxels padded to each axis
+        :param stats (tuple): optional (min, max, mean, std) of the input used by the transforms; computed directly
+            from the `raw` array if not given
+        """
+        if isinstance(raw, torch.Tensor):
+            raw = raw.detach().cpu().numpy()
+        if raw.ndim == 2:
+            raw = np.expand_dims(raw, axis=0)
+        assert raw.ndim in [3, 4], 'Raw array must be 3D (DxHxW) or 4D (CxDxHxW)'
+
+        if mirror_padding is not None:
+            if isinstance(mirror_padding, int):
+                mirror_padding = (mirror_padding,) * 3
+            else:
+                assert len(mirror_padding) == 3, f"Invalid mirror_padding: {mirror_padding}"
+
+        self.mirror_padding = mirror_padding
+        self.phase = 'test'
+        self.file_path = None
+
+        if stats is None:
+            stats = calculate_stats([raw])
+        min_value, max_value, mean, std = stats
+        logger.info(f'Input stats: min={min_value}, max={max_value}, mean={mean}, std={std}')
+
+        self.transformer = transforms.get_transformer(transformer_config, min_value=min_value, max_value=max_value,
+                                                      mean=mean, std=std)
+        self.raw_transform = self.transformer.raw_transform()
+
+        # add mirror padding if needed (without copying the volume)
+        if self.mirror_padding is not None:
+            raw = PaddedVolume(raw, self.mirror_padding)
+
+        # keep the same layout as the HDF5 datasets, so that the predictors can use both interchangeably
+        self.raws = [raw]
+
+        slice_builder = get_slice_builder(self.raws, None, None, slice_builder_config)
+        self.raw_slices = slice_builder.raw_slices
+
+        self.patch_count = len(self.raw_slices)
+        logger.info(f'Number of patches: {self.patch_count}')
+
+    def __getitem__(self, idx):
+        if idx >= len(self):
+            raise StopIteration
+
+        raw_idx = self.raw_slices[idx]
+        raw_patch_transformed = self.raw_transform(self.raws[0][raw_idx])
+        # discard the channel dimension in the slices: predictor requires only the spatial dimensions of the volume
+        if len(raw_idx) == 4:
+            raw_idx = raw_idx[1:]
+        return raw_patch_transformed, raw_idx
+
+    def __len__(self):
+        return self.patch_count
@@ -4,14 +4,15 @@ import imageio
 import numpy as np
 
 from pytorch3dunet.augment import transforms
-from pytorch3dunet.datasets.utils import ConfigDataset, calculate_stats
+from pytorch3dunet.datasets.utils import ConfigDataset, StatsCache, calculate_stats
 from pytorch3dunet.unet3d.utils import get_logger
 
 logger = get_logger('DSB2018Dataset')
 
 
 class DSB2018Dataset(ConfigDataset):
-    def __init__(self, root_dir, phase, transformer_config, mirror_padding=(0, 32, 32), expand_dims=True):
+    def __init__(self, root_dir, phase, transformer_config, mirror_padding=(0, 32, 32), expand_dims=True,
+                 stats_cache=None):
         assert os.path.isdir(root_dir), 'root_dir is not a directory'
         assert phase in ['train', 'val', 'test']
 
@@ -29,7 +30,8 @@ class DSB2018Dataset(ConfigDataset):
         assert os.path.isdir(images_dir)
         self.images = self._load_files(images_dir, expand_dims)
 
-        min_value, max_value, mean, std = calculate_stats(self.images)
+        min_value, max_value, mean, std = self.images_stats(images_dir, self.images, stats_cache,
+                                                          expand_dims=expand_dims)
         logger.info(f'Input stats: min={min_value}, max={max_value}, mean={mean}, std={std}')
 
         transformer = transforms.get_transformer(transformer_config, min_value=min_value, max_value=max_value,
@@ -86,14 +88,35 @@ class DSB2018Dataset(ConfigDataset):
         mirror_padding = dataset_config.get('mirror_padding', None)
 
         if phase != 'test':
-            return [cls(file_paths[0], phase, transformer_config, mirror_padding)]
+            return [cls(file_paths[0], phase, transformer_config, mirror_padding,
+                        stats_cache=dataset_config.get('stats_cache', None))]
         else:
             raise NotImplementedError
 
+    @classmethod
+    def precompute_stats(cls, dataset_config, phase):
+        stats_cache = StatsCache.from_config(dataset_config.get('stats_cache', None))
+        assert stats_cache is not None, "Precomputing the statistics requires 'stats_cache' in the loaders config"
+        images_dir = os.path.join(dataset_config[phase]['file_paths'][0], 'images')
+        logger.info(f'Computing input stats of: {images_dir}')
+        cls.images_stats(images_dir, cls._load_files(images_dir, expand_dims=False), stats_cache, expand_dims=False)
+
+    @staticmethod
+    def images_stats(images_dir, images, stats_cache=None, expand_dims=True):
+        stats_cache = StatsCache.from_config(stats_cache)
+        if stats_cache is None:
+            return calculate_stats(images)
+        # key on the shapes of the image files, so that the stats are shared regardless of `expand_dims`
+        key = {'images': [[list(img.shape[1:] if expand_dims else img.shape), str(img.dtype)] for img in images]}
+        return stats_cache.get(images_dir, key, lambda: calculate_stats(images))
+
     @staticmethod
     def _load_files(dir, expand_dims):
         files_data = []
-        for file in os.listdir(dir):
+        for file in sorted(os.listdir(dir)):
+            if file.startswith('.'):
+                # skip hidden files, e.g. the `.stats.json` sidecar of the StatsCache
+                continue
             path = os.path.join(dir, file)
             img = np.asarray(imageio.imread(path))
             if expand_dims:
@@ -1,17 +1,19 @@
 import glob
+import hashlib
 import os
+from contextlib import contextmanager
 from itertools import chain
-from multiprocessing import Lock
 
 import h5py
 import numpy as np
+import torch
 
 import pytorch3dunet.augment.transforms as transforms
-from pytorch3dunet.datasets.utils import get_slice_builder, ConfigDataset, calculate_stats
+from pytorch3dunet.datasets.utils import get_slice_builder, ConfigDataset, calculate_stats, PaddedVolume, StatsCache, \
+    PatchIndexCache, PatchSlices, patch_value_counts
 from pytorch3dunet.unet3d.utils import get_logger
 
 logger = get_logger('HDF5Dataset')
-lock = Lock()
 
 
 class AbstractHDF5Dataset(ConfigDataset):
@@ -27,7 +29,11 @@ class AbstractHDF5Dataset(ConfigDataset):
                  mirror_padding=(16, 32, 32),
                  raw_internal_path='raw',
                  label_internal_path='label',
-                 weight_internal_path=None):
+                 weight_internal_path=None,
+                 roi=None,
+                 stats_subsample=None,
+                 stats_cache=None,
+                 patch_index_cache=None):
         """
         :param file_path: path to H5 file containing raw data as well as labels and per pixel weights (optional)
         :param phase: 'train' for training, 'val' for validation, 'test' for testing; data augmentation is performed
@@ -38,6 +44,16 @@ class AbstractHDF5Dataset(ConfigDataset):
         :param raw_internal_path (str or list): H5 internal path to the raw dataset
         :param label_internal_path (str or list): H5 internal path to the label dataset
         :param weight_internal_path (str or list): H5 internal path to the per pixel weights
+        :param roi (tuple): optional region of interest `(start, stop)` (both DHW) predicted in the 'test' phase; only
+            the region plus `mirror_padding` is read from the H5 and the mirror padding is applied only at the
+            borders of the volume
+        :param stats_subsample (float): if given, the normalization statistics of the raw data are approximated from
+            a random fraction of its blocks (see `calculate_stats`)
+        :param stats_cache (bool, str or StatsCache): if given, the normalization statistics are loaded from/saved to
+            the `StatsCache` (`true` for the sidecar files next to the data or a path to the cache directory)
+        :param patch_index_cache (bool, str or PatchIndexCache): if given, the slices of the patches (and the per-patch
+            arrays computed by the slice builder, e.g. by the `FilterSliceBuilder`) are loaded from/saved to the
+            `PatchIndexCache` (`true` for the files next to the data or a path to the cache directory)
         """
         assert phase in ['train', 'val', 'test']
         if phase in ['train', 'val']:
@@ -52,6 +68,11 @@ class AbstractHDF5Dataset(ConfigDataset):
         self.mirror_padding = mirror_padding
         self.phase = phase
         self.file_path = file_path
+        if roi is not None:
+            assert phase == 'test', 'Region of interest is supported only in the test phase'
+            roi = tuple(tuple(int(i) for i in corner) for corner in roi)
+            assert len(roi) == 2 and all(len(corner) == 3 for corner in roi), f'Invalid roi: {roi}'
+        self.roi = roi
 
         # convert raw_internal_path, label_internal_path and weight_internal_path to list for ease of computation
         if isinstance(raw_internal_path, str):
@@ -67,12 +88,23 @@ class AbstractHDF5Dataset(ConfigDataset):
         if weight_internal_path is not None:
             internal_paths.extend(weight_internal_path)
 
-        input_file = self.create_h5_file(file_path, internal_paths)
-
-        self.raws = self.fetch_and_check(input_file, raw_internal_path)
-
-        # calculate global min, max, mean and std for normalization
-        min_value, max_value, mean, std = calculate_stats(self.raws)
+        if roi is not None:
+            # read only the region of interest (plus padding) into memory
+            self.raws = self._read_roi(file_path, raw_internal_path, roi, mirror_padding)
+        else:
+            input_file = self.create_h5_file(file_path, internal_paths)
+            self.raws = self.fetch_and_check(input_file, raw_internal_path)
+
+        # calculate global min, max, mean and std for normalization; in case of the roi the statistics are computed
+        # from the whole volume (read block by block from the file), so that the roi is normalized exactly as
+        # in the prediction of the full volume
+        if roi is not None:
+            min_value, max_value, mean, std = self.file_raw_stats(file_path, raw_internal_path,
+                                                                  stats_subsample=stats_subsample,
+                                                                  stats_cache=stats_cache)
+        else:
+            min_value, max_value, mean, std = self.raw_stats(file_path, self.raws, raw_internal_path,
+                                                             stats_subsample=stats_subsample, stats_cache=stats_cache)
         logger.info(f'Input stats: min={min_value}, max={max_value}, mean={mean}, std={std}')
 
         self.transformer = transforms.get_transformer(transformer_config, min_value=min_value, max_value=max_value,
@@ -97,24 +129,17 @@ class AbstractHDF5Dataset(ConfigDataset):
             self.labels = None
             self.weight_maps = None
 
-            # add mirror padding if needed
-            if self.mirror_padding is not None:
-                z, y, x = self.mirror_padding
-                pad_width = ((z, z), (y, y), (x, x))
-                padded_volumes = []
-                for raw in self.raws:
-                    if raw.ndim == 4:
-                        channels = [np.pad(r, pad_width=pad_width, mode='reflect') for r in raw]
-                        padded_volume = np.stack(channels)
-                    else:
-                        padded_volume = np.pad(raw, pad_width=pad_width, mode='reflect')
-
-                    padded_volumes.append(padded_volume)
-
-                self.raws = padded_volumes
+            # add mirror padding if needed (already done when reading the region of interest); the padded voxels
+            # are reflected on the fly, so no padded copy of the raw data is created
+            if self.mirror_padding is not None and roi is None:
+                self.raws = [PaddedVolume(raw, self.mirror_padding) for raw in self.raws]
 
         # build slice indices for raw and label data sets
-        slice_builder = get_slice_builder(self.raws, self.labels, self.weight_maps, slice_builder_config)
+        self.patch_index_cache = PatchIndexCache.from_config(patch_index_cache)
+        self.index_key = {'label_internal_path': label_internal_path}
+        slice_builder = get_slice_builder(self.raws, self.labels, self.weight_maps, slice_builder_config,
+                                          file_path=file_path, patch_index_cache=self.patch_index_cache,
+                                          index_key=self.index_key)
         self.raw_slices = slice_builder.raw_slices
         self.label_slices = slice_builder.label_slices
         self.weight_slices = slice_builder.weight_slices
@@ -126,6 +151,95 @@ class AbstractHDF5Dataset(ConfigDataset):
     def create_h5_file(file_path, internal_paths):
         raise NotImplementedError
 
+    @classmethod
+    def _read_roi(cls, file_path, internal_paths, roi, mirror_padding):
+        """
+        Reads the region of interest `roi` extended by the `mirror_padding` from each of the `internal_paths`.
+        The data outside of the volume is mirror padded (see `PaddedVolume`), i.e. the padding is taken from
+        the volume itself if possible.
+        """
+        start, stop = roi
+        padding = (0, 0, 0) if mirror_padding is None else mirror_padding
+        raws = []
+        with _closing(cls.create_h5_file(file_path, internal_paths)) as f:
+            for internal_path in internal_paths:
+                ds = f[internal_path]
+                assert ds.ndim in [3, 4], 'Region of interest is supported only for 3D (DxHxW) or 4D (CxDxHxW) datasets'
+                volume_shape = ds.shape[-3:]
+                assert all(0 <= a < b <= size for a, b, size in zip(start, stop, volume_shape)), \
+                    f'Invalid roi: {roi} for the volume of shape {volume_shape}'
+
+                read_start = [max(a - p, 0) for a, p in zip(start, padding)]
+                read_stop = [min(b + p, size) for b, p, size in zip(stop, padding, volume_shape)]
+                # padding missing at the borders of the volume
+                pad_width = tuple((p - (a - ra), p - (rb - b))
+                                  for a, b, ra, rb, p in zip(start, stop, read_start, read_stop, padding))
+
+                index = tuple(slice(a, b) for a, b in zip(read_start, read_stop))
+                if ds.ndim == 4:
+                    index = (slice(None),) + index
+                raw = ds[index]
+
+                if any(any(pw) for pw in pad_width):
+                    raw = PaddedVolume(raw, pad_width)
+                raws.append(raw)
+        return raws
+
+    @staticmethod
+    def raw_stats(file_path, raws, raw_internal_path, stats_subsample=None, stats_cache=None):
+        """
+        Returns the (min, max, mean, std) of the `raws` read from the `file_path`, taken from the `stats_cache`
+        if available.
+        """
+        stats_cache = StatsCache.from_config(stats_cache)
+        if stats_cache is None:
+            return calculate_stats(raws, subsample=stats_subsample)
+
+        key = {
+            'internal_paths': list(raw_internal_path),
+            # 2D datasets are expanded to 3D when loaded
+            'shapes': [list(raw.shape) if raw.ndim != 2 else [1] + list(raw.shape) for raw in raws],
+            'subsample': stats_subsample
+        }
+        return stats_cache.get(file_path, key, lambda: calculate_stats(raws, subsample=stats_subsample))
+
+    @classmethod
+    def file_raw_stats(cls, file_path, raw_internal_path, stats_subsample=None, stats_cache=None):
+        """
+        Same as `raw_stats`, but the raw datasets of the whole volume are read block by block directly from the file.
+        """
+        with _closing(cls.create_h5_file(file_path, raw_internal_path)) as f:
+            raws = [f[internal_path] for internal_path in raw_internal_path]
+            return cls.raw_stats(file_path, raws, raw_internal_path, stats_subsample=stats_subsample,
+                                 stats_cache=stats_cache)
+
+    def patch_label_counts(self, values):
+        """
+        Returns the number of voxels equal to each of the label `values` in every patch (of the first label
+        dataset), as an int64 array of shape `(len(self), len(values))`, e.g. used by the `WeightedPatchSampler`.
+        The counts are computed in a single pass over the labels (see `patch_value_counts`) and saved to/loaded
+        from the `PatchIndexCache` together with the slice index.
+        """
+        assert self.phase != 'test', 'Label statistics are not available in the test phase'
+        assert isinstance(self.label_slices, PatchSlices), \
+            'Per-patch label statistics require a fixed set of patches (not supported by the RandomPatchSliceBuilder)'
+        label = self.labels[0]
+
+        def _count():
+            return {'counts': patch_value_counts(label, self.label_slices, values)}
+
+        if self.patch_index_cache is None:
+            return _count()['counts']
+
+        key = {
+            'dataset': self.index_key,
+            'shape': list(label.shape),
+            'patch_shape': list(self.label_slices.patch_shape),
+            'origins': hashlib.sha1(np.ascontiguousarray(self.label_slices.origins).tobytes()).hexdigest(),
+            'values': [int(value) for value in values]
+        }
+        return self.patch_index_cache.get(self.file_path, key, _count)['counts']
+
     @staticmethod
     def fetch_datasets(input_file_h5, internal_paths):
         raise NotImplementedError
@@ -207,23 +321,61 @@ class AbstractHDF5Dataset(ConfigDataset):
         # are going to be included in the final file_paths
         file_paths = cls.traverse_h5_paths(file_paths)
 
+        # optional list of regions of interest `[start, stop]` predicted separately in the test phase
+        rois = phase_config.get('rois', None) if phase == 'test' else None
+        if not rois:
+            rois = [None]
+
+        # share a single cache between the datasets
+        stats_cache = StatsCache.from_config(dataset_config.get('stats_cache', None))
+        patch_index_cache = PatchIndexCache.from_config(dataset_config.get('patch_index_cache', None))
+
         datasets = []
         for file_path in file_paths:
-            try:
-                logger.info(f'Loading {phase} set from: {file_path}...')
-                dataset = cls(file_path=file_path,
-                              phase=phase,
-                              slice_builder_config=slice_builder_config,
-                              transformer_config=transformer_config,
-                              mirror_padding=dataset_config.get('mirror_padding', None),
-                              raw_internal_path=dataset_config.get('raw_internal_path', 'raw'),
-                              label_internal_path=dataset_config.get('label_internal_path', 'label'),
-                              weight_internal_path=dataset_config.get('weight_internal_path', None))
-                datasets.append(dataset)
-            except Exception:
-                logger.error(f'Skipping {phase} set: {file_path}', exc_info=True)
+            for roi in rois:
+                try:
+                    logger.info(f'Loading {phase} set from: {file_path}' + (f', roi: {roi}...' if roi else '...'))
+                    dataset = cls(file_path=file_path,
+                                  phase=phase,
+                                  slice_builder_config=slice_builder_config,
+                                  transformer_config=transformer_config,
+                                  mirror_padding=dataset_config.get('mirror_padding', None),
+                                  raw_internal_path=dataset_config.get('raw_internal_path', 'raw'),
+                                  label_internal_path=dataset_config.get('label_internal_path', 'label'),
+                                  weight_internal_path=dataset_config.get('weight_internal_path', None),
+                                  roi=roi,
+                                  stats_subsample=dataset_config.get('stats_subsample', None),
+                                  stats_cache=stats_cache,
+                                  patch_index_cache=patch_index_cache,
+                                  **cls.dataset_kwargs(dataset_config))
+                    datasets.append(dataset)
+                except Exception:
+                    logger.error(f'Skipping {phase} set: {file_path}', exc_info=True)
         return datasets
 
+    @classmethod
+    def dataset_kwargs(cls, dataset_config):
+        """
+        Returns the additional, implementation specific constructor arguments taken from the `dataset_config`.
+        """
+        return {}
+
+    @classmethod
+    def precompute_stats(cls, dataset_config, phase):
+        stats_cache = StatsCache.from_config(dataset_config.get('stats_cache', None))
+        assert stats_cache is not None, "Precomputing the statistics requires 'stats_cache' in the loaders config"
+
+        file_paths = cls.traverse_h5_paths(dataset_config[phase]['file_paths'])
+        raw_internal_path = dataset_config.get('raw_internal_path', 'raw')
+        if isinstance(raw_internal_path, str):
+            raw_internal_path = [raw_internal_path]
+
+        # the statistics are always computed from the whole volume (also for the regions of interest)
+        for file_path in file_paths:
+            logger.info(f'Computing input stats of: {file_path}')
+            cls.file_raw_stats(file_path, raw_internal_path,
+                               stats_subsample=dataset_config.get('stats_subsample', None), stats_cache=stats_cache)
+
     @staticmethod
     def traverse_h5_paths(file_paths):
         assert isinstance(file_paths, list)
@@ -239,14 +391,30 @@ class AbstractHDF5Dataset(ConfigDataset):
         return results
 
 
+@contextmanager
+def _closing(input_file):
+    # Zarr containers (see `ZarrDataset`) are not closed explicitly
+    try:
+        yield input_file
+    finally:
+        if hasattr(input_file, 'close'):
+            input_file.close()
+
+
 class StandardHDF5Dataset(AbstractHDF5Dataset):
     """
     Implementation of the HDF5 dataset which loads the data from all of the H5 files into the memory.
     Fast but might consume a lot of memory.
+
+    With `shared_memory: true` in the `loaders` config the datasets are loaded into shared memory (see
+    `_SharedArray`), so that all of the DataLoader workers (forked or spawned) read from a single copy of the data
+    instead of keeping their own.
     """
 
     def __init__(self, file_path, phase, slice_builder_config, transformer_config, mirror_padding=(16, 32, 32),
-                 raw_internal_path='raw', label_internal_path='label', weight_internal_path=None):
+                 raw_internal_path='raw', label_internal_path='label', weight_internal_path=None, roi=None,
+                 stats_subsample=None, stats_cache=None, patch_index_cache=None, shared_memory=False):
+        self.shared_memory = shared_memory
         super().__init__(file_path=file_path,
                          phase=phase,
                          slice_builder_config=slice_builder_config,
@@ -254,39 +422,79 @@ class StandardHDF5Dataset(AbstractHDF5Dataset):
                          mirror_padding=mirror_padding,
                          raw_internal_path=raw_internal_path,
                          label_internal_path=label_internal_path,
-                         weight_internal_path=weight_internal_path)
+                         weight_internal_path=weight_internal_path,
+                         roi=roi,
+                         stats_subsample=stats_subsample,
+                         stats_cache=stats_cache,
+                         patch_index_cache=patch_index_cache)
+
+    @classmethod
+    def dataset_kwargs(cls, dataset_config):
+        return {'shared_memory': dataset_config.get('shared_memory', False)}
 
     @staticmethod
     def create_h5_file(file_path, internal_paths):
         return h5py.File(file_path, 'r')
 
-    @staticmethod
-    def fetch_datasets(input_file_h5, internal_paths):
+    def fetch_datasets(self, input_file_h5, internal_paths):
+        if self.shared_memory:
+            return [_SharedArray(input_file_h5[internal_path]) for internal_path in internal_paths]
         return [input_file_h5[internal_path][...] for internal_path in internal_paths]
 
 
-class LazyHDF5Dataset(AbstractHDF5Dataset):
+class _SharedArray:
+    """
+    Read-only, array-like view of an H5 dataset loaded into a shared memory torch tensor. When the DataLoader sends
+    the dataset to its workers, the tensor is passed by a handle to the shared memory (the torch multiprocessing
+    reductions) instead of being copied, and forked workers do not duplicate its pages on write either.
+    The data is kept as raw bytes, so any NumPy dtype is supported. 2D datasets are exposed as 3D (1xHxW), as done
+    by `fetch_and_check` for the in-memory datasets.
     """
-    Implementation of the HDF5 dataset which loads the data lazily. It's slower, but has a low memory footprint.
 
-    The problem of loading h5 dataset from multiple loader workers results in an error:
+    def __init__(self, dataset):
+        self.shape = (1,) + dataset.shape if dataset.ndim == 2 else dataset.shape
+        self.ndim = len(self.shape)
+        self.dtype = dataset.dtype
+        self.chunks = None
+        self._nbytes = int(np.prod(self.shape)) * self.dtype.itemsize
+        self.tensor = torch.empty(max(self._nbytes, 1), dtype=torch.uint8).share_memory_()
+        self._array = None
+        if self._nbytes > 0:
+            # read straight into the shared memory
+            dataset.read_direct(self._get_array().reshape(dataset.shape))
+
+    def __getstate__(self):
+        # the NumPy view would be pickled as a copy of the data
+        state = dict(self.__dict__)
+        state['_array'] = None
+        return state
+
+    def _get_array(self):
+        if self._array is None:
+            self._array = self.tensor.numpy()[:self._nbytes].view(self.dtype).reshape(self.shape)
+        return self._array
+
+    def __getitem__(self, index):
+        return self._get_array()[index]
 
-        # WARN: we load everything into memory due to hdf5 bug when reading H5 from multiple subprocesses, i.e.
-        # File "h5py/_proxy.pyx", line 84, in h5py._proxy.H5PY_H5Dread
-        # OSError: Can't read data (inflate() failed)
+    def __len__(self):
+        return self.shape[0]
 
-    this happens when the H5 dataset is compressed. The workaround is to create the uncompressed datasets
-    from a single worker (synchronization is necessary) and use them instead. Assuming the user specified internal
-    dataset path as PATH, this will create a corresponding `_uncompressed_PATH` dataset inside the same H5 file.
 
-    Unfortunately even after fixing the above error, reading the H5 from multiple worker threads sometimes
-    returns corrupted data and as a result. e.g. cross-entropy loss fails with: RuntimeError: CUDA error: device-side assert triggered.
+class LazyHDF5Dataset(AbstractHDF5Dataset):
+    """
+    Implementation of the HDF5 dataset which loads the data lazily. It's slower, but has a low memory footprint.
 
-    This can be workaround by using only a single worker thread, i.e. set `num_workers: 1` in the config.
+    Sharing an open H5 file between the DataLoader workers gives corrupted reads (e.g. `OSError: Can't read data
+    (inflate() failed)` for compressed datasets), since the forked workers inherit the state of the HDF5 library
+    from the main process. Instead the datasets are accessed through `_LazyH5Array` proxies, which (re)open the file
+    on the first read in every process. The compressed data is read directly and the input files are never modified,
+    so the dataset can be used with any number of workers.
     """
 
     def __init__(self, file_path, phase, slice_builder_config, transformer_config, mirror_padding=(16, 32, 32),
-                 raw_internal_path='raw', label_internal_path='label', weight_internal_path=None):
+                 raw_internal_path='raw', label_internal_path='label', weight_internal_path=None, roi=None,
+                 stats_subsample=None, stats_cache=None, patch_index_cache=None):
         super().__init__(file_path=file_path,
                          phase=phase,
                          slice_builder_config=slice_builder_config,
@@ -294,33 +502,63 @@ class LazyHDF5Dataset(AbstractHDF5Dataset):
                          mirror_padding=mirror_padding,
                          raw_internal_path=raw_internal_path,
                          label_internal_path=label_internal_path,
-                         weight_internal_path=weight_internal_path)
+                         weight_internal_path=weight_internal_path,
+                         roi=roi,
+                         stats_subsample=stats_subsample,
+                         stats_cache=stats_cache,
+                         patch_index_cache=patch_index_cache)
 
     @staticmethod
     def create_h5_file(file_path, internal_paths):
-        # make this part mutually exclusive
-        lock.acquire()
+        return h5py.File(file_path, 'r')
 
-        uncompressed_paths = {}
-        for internal_path in internal_paths:
-            if internal_path is not None:
-                assert '_uncompressed' not in internal_path
-                uncompressed_paths[internal_path] = f'_uncompressed_{internal_path}'
+    @staticmethod
+    def fetch_datasets(input_file_h5, internal_paths):
+        return [_LazyH5Array(input_file_h5.filename, internal_path, input_file_h5[internal_path])
+                for internal_path in internal_paths]
 
-        with h5py.File(file_path, 'r+') as f:
-            for k, v in uncompressed_paths.items():
-                if v not in f:
-                    # create uncompressed dataset
-                    data = f[k][...]
-                    f.create_dataset(v, data=data)
 
-        lock.release()
+class _LazyH5Array:
+    """
+    Read-only, array-like proxy of the dataset at `internal_path` inside the H5 file at `file_path`. The file is
+    opened lazily on the first read in every process (e.g. inside each DataLoader worker) and is never shared
+    between the processes. 2D datasets are exposed as 3D (1xHxW), as done by `fetch_and_check` for the in-memory
+    datasets.
+    """
 
-        # finally return the H5
-        return h5py.File(file_path, 'r')
+    def __init__(self, file_path, internal_path, dataset):
+        self.file_path = file_path
+        self.internal_path = internal_path
+        self.dtype = dataset.dtype
+        self._expand_dims = dataset.ndim == 2
+        self.shape = (1,) + dataset.shape if self._expand_dims else dataset.shape
+        self.ndim = len(self.shape)
+        self.chunks = ((1,) + dataset.chunks if self._expand_dims else dataset.chunks) if dataset.chunks else None
+        self._dataset = None
+        self._pid = None
+
+    def __getstate__(self):
+        # the open file handle cannot be pickled (e.g. for the 'spawn' workers); reopen after unpickling
+        state = dict(self.__dict__)
+        state['_dataset'] = None
+        state['_pid'] = None
+        return state
+
+    def _get_dataset(self):
+        if self._pid != os.getpid():
+            # first read in this process: do not use the handle inherited from the parent process
+            self._dataset = h5py.File(self.file_path, 'r')[self.internal_path]
+            self._pid = os.getpid()
+        return self._dataset
+
+    def __getitem__(self, index):
+        dataset = self._get_dataset()
+        if not self._expand_dims:
+            return dataset[index]
+        if not isinstance(index, tuple):
+            index = (index,)
+        index = index + (slice(None),) * (3 - len(index))
+        return np.expand_dims(dataset[index[1:]], axis=0)[index[:1]]
 
-    @staticmethod
-    def fetch_datasets(input_file_h5, internal_paths):
-        # convert to uncompressed
-        internal_paths = [f'_uncompressed_{internal_path}' for internal_path in internal_paths]
-        return [input_file_h5[internal_path] for internal_path in internal_paths]
+    def __len__(self):
+        return self.shape[0]
@@ -0,0 +1,153 @@
+import glob
+import os
+
+import h5py
+import numpy as np
+
+from pytorch3dunet.datasets.hdf5 import AbstractHDF5Dataset
+from pytorch3dunet.datasets.utils import _iter_blocks
+from pytorch3dunet.unet3d.utils import get_logger
+
+logger = get_logger('NpyDataset')
+
+
+def _npy_path(container, internal_path):
+    return os.path.join(container, *internal_path.strip('/').split('/')) + '.npy'
+
+
+def _is_npy_container(path):
+    return os.path.isdir(path) and len(glob.glob(os.path.join(path, '*.npy'))) > 0
+
+
+class _NpyContainer:
+    """
+    Directory with one uncompressed `.npy` file per internal path (e.g. `raw.npy`, `label.npy`), used in place of
+    the H5 file by the `NpyDataset`.
+    """
+
+    def __init__(self, path):
+        assert os.path.isdir(path), f'Not a directory: {path}'
+        self.filename = path
+
+    def __getitem__(self, internal_path):
+        return _NpyArray(_npy_path(self.filename, internal_path))
+
+    def __contains__(self, internal_path):
+        return os.path.exists(_npy_path(self.filename, internal_path))
+
+
+class _NpyArray:
+    """
+    Read-only, array-like proxy of a memory-mapped `.npy` file. Patches are views into the mapping, so all of the
+    DataLoader workers read the data through the (shared) OS page cache instead of keeping their own copies.
+    The mapping is re-created after unpickling (e.g. in the spawned workers) instead of pickling its content.
+    2D arrays are exposed as 3D (1xHxW), as done by `fetch_and_check` for the in-memory datasets.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._array = None
+        array = self._get_array()
+        self.shape = array.shape
+        self.ndim = array.ndim
+        self.dtype = array.dtype
+        self.chunks = None
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['_array'] = None
+        return state
+
+    def _get_array(self):
+        if self._array is None:
+            array = np.load(self.path, mmap_mode='r')
+            if array.ndim == 2:
+                array = array[np.newaxis]
+            self._array = array
+        return self._array
+
+    def __getitem__(self, index):
+        return self._get_array()[index]
+
+    def __len__(self):
+        return self.shape[0]
+
+
+class NpyDataset(AbstractHDF5Dataset):
+    """
+    Implementation of the dataset backed by uncompressed, memory-mapped `.npy` files, meant for hot training data on
+    fast local storage. Each entry of the `file_paths` is a directory with a `<internal_path>.npy` file for every
+    internal path of the corresponding H5 file (see `convert_h5_to_npy`), or a directory of such directories.
+
+    Patches are sliced directly from the memory maps (no decompression, no copy of the whole volume), so the page
+    cache is shared between all of the DataLoader workers and the memory usage does not grow with `num_workers`.
+    """
+
+    def __init__(self, file_path, phase, slice_builder_config, transformer_config, mirror_padding=(16, 32, 32),
+                 raw_internal_path='raw', label_internal_path='label', weight_internal_path=None, roi=None,
+                 stats_subsample=None, stats_cache=None, patch_index_cache=None):
+        super().__init__(file_path=file_path,
+                         phase=phase,
+                         slice_builder_config=slice_builder_config,
+                         transformer_config=transformer_config,
+                         mirror_padding=mirror_padding,
+                         raw_internal_path=raw_internal_path,
+                         label_internal_path=label_internal_path,
+                         weight_internal_path=weight_internal_path,
+                         roi=roi,
+                         stats_subsample=stats_subsample,
+                         stats_cache=stats_cache,
+                         patch_index_cache=patch_index_cache)
+
+    @staticmethod
+    def create_h5_file(file_path, internal_paths):
+        return _NpyContainer(file_path)
+
+    @staticmethod
+    def fetch_datasets(input_file, internal_paths):
+        return [input_file[internal_path] for internal_path in internal_paths]
+
+    @staticmethod
+    def traverse_h5_paths(file_paths):
+        assert isinstance(file_paths, list)
+        results = []
+        for file_path in file_paths:
+            if os.path.isdir(file_path) and not _is_npy_container(file_path):
+                # if file path is a directory of the containers take all of them
+                subdirs = [os.path.normpath(subdir) for subdir in sorted(glob.glob(os.path.join(file_path, '*', '')))]
+                containers = [subdir for subdir in subdirs if _is_npy_container(subdir)]
+                # nested internal paths only, e.g. 'volumes/raw.npy'
+                results.extend(containers if containers else [file_path])
+            else:
+                results.append(file_path)
+        return results
+
+
+def convert_h5_to_npy(h5_path, output_dir, internal_paths=None, block_size=64 * 1024 ** 2):
+    """
+    Converts the datasets of the H5 file at `h5_path` into the `.npy` files read by the `NpyDataset`. The data is
+    copied block by block (see `_iter_blocks`), so the H5 datasets are never loaded into memory as a whole.
+
+    :param h5_path: path to the input H5 file
+    :param output_dir: directory where the `<file name>/<internal_path>.npy` files are saved
+    :param internal_paths (list): internal paths of the datasets to convert; all datasets are converted if None
+    :param block_size (int): maximum size (in bytes) of the blocks copied at a time
+    :return: path to the output directory of the H5 file (i.e. the `file_path` of the `NpyDataset`)
+    """
+    container = os.path.join(output_dir, os.path.splitext(os.path.basename(h5_path))[0])
+    with h5py.File(h5_path, 'r') as f:
+        if internal_paths is None:
+            internal_paths = []
+            f.visititems(lambda name, obj: internal_paths.append(name) if isinstance(obj, h5py.Dataset) else None)
+
+        for internal_path in internal_paths:
+            ds = f[internal_path]
+            npy_path = _npy_path(container, internal_path)
+            logger.info(f'Converting {h5_path}/{internal_path} to: {npy_path}')
+            os.makedirs(os.path.dirname(npy_path), exist_ok=True)
+            output = np.lib.format.open_memmap(npy_path, mode='w+', dtype=ds.dtype, shape=ds.shape)
+            for index in _iter_blocks(ds, block_size):
+                output[index] = ds[index]
+            output.flush()
+            del output
+    return container
@@ -1,9 +1,15 @@
 import collections
+import collections.abc
+import hashlib
 import importlib
+import itertools
+import json
+import os
+import tempfile
 
 import numpy as np
 import torch
-from torch.utils.data import DataLoader, ConcatDataset, Dataset
+from torch.utils.data import DataLoader, ConcatDataset, Dataset, Sampler
 
 from pytorch3dunet.unet3d.utils import get_logger
 
@@ -31,10 +37,24 @@ class ConfigDataset(Dataset):
         """
         raise NotImplementedError
 
+    @classmethod
+    def precompute_stats(cls, dataset_config, phase):
+        """
+        Computes the normalization statistics of all inputs of a given phase and saves them in the `StatsCache`
+        given by the `stats_cache` option of the `dataset_config`, without creating the datasets.
+
+        Args:
+            dataset_config (dict): dataset configuration
+            phase (str): one of ['train', 'val', 'test']
+        """
+        raise NotImplementedError
+
 
 class SliceBuilder:
     """
-    Builds the position of the patches in a given raw/label/weight ndarray based on the the patch and stride shape
+    Builds the position of the patches in a given raw/label/weight ndarray based on the the patch and stride shape.
+    The positions are kept as `PatchSlices`, i.e. the array of the patch origins shared by the raw/label/weight
+    datasets of the same shape.
     """
 
     def __init__(self, raw_datasets, label_datasets, weight_dataset, patch_shape, stride_shape, **kwargs):
@@ -58,14 +78,44 @@ class SliceBuilder:
             self._label_slices = None
         else:
             # take the first element in the label_datasets to build slices
-            self._label_slices = self._build_slices(label_datasets[0], patch_shape, stride_shape)
+            self._label_slices = self._shared_slices(self._raw_slices, label_datasets[0], patch_shape, stride_shape)
             assert len(self._raw_slices) == len(self._label_slices)
         if weight_dataset is None:
             self._weight_slices = None
         else:
-            self._weight_slices = self._build_slices(weight_dataset[0], patch_shape, stride_shape)
+            self._weight_slices = self._shared_slices(self._raw_slices, weight_dataset[0], patch_shape, stride_shape)
             assert len(self.raw_slices) == len(self._weight_slices)
 
+    # whether the slices depend only on the datasets and the config, i.e. can be saved to the `PatchIndexCache`
+    cacheable = True
+
+    @classmethod
+    def from_index_arrays(cls, raw_datasets, label_datasets, weight_datasets, arrays):
+        """
+        Recreates the slice builder from the patch origins saved by `index_arrays` (e.g. loaded from the
+        `PatchIndexCache`) without building the slices again.
+        """
+        slice_builder = cls.__new__(cls)
+        slice_builder._raw_slices = _origins_to_slices(raw_datasets, arrays, 'raw')
+        slice_builder._label_slices = _origins_to_slices(label_datasets, arrays, 'label')
+        slice_builder._weight_slices = _origins_to_slices(weight_datasets, arrays, 'weight')
+        return slice_builder
+
+    def index_arrays(self):
+        """
+        Returns the compact representation of the slices: the int32 (N, 3) array of the spatial origins of the
+        patches and the patch shape for each of the raw/label/weight slices. The origins shared with the raw
+        slices are saved only once.
+        """
+        arrays = {}
+        for name, slices in [('raw', self.raw_slices), ('label', self.label_slices), ('weight', self.weight_slices)]:
+            if slices is None:
+                continue
+            if name == 'raw' or slices.origins is not self.raw_slices.origins:
+                arrays[name + '_origins'] = slices.origins
+            arrays[name + '_patch_shape'] = np.array(slices.patch_shape, dtype='int64')
+        return arrays
+
     @property
     def raw_slices(self):
         return self._raw_slices
@@ -84,33 +134,26 @@ class SliceBuilder:
         and builds an array of slice positions.
 
         Returns:
-            list of slices, i.e.
-            [(slice, slice, slice, slice), ...] if len(shape) == 4
-            [(slice, slice, slice), ...] if len(shape) == 3
+            `PatchSlices` of the patches, i.e. a sequence of
+            (slice, slice, slice, slice) if len(shape) == 4
+            (slice, slice, slice) if len(shape) == 3
         """
-        slices = []
-        if dataset.ndim == 4:
-            in_channels, i_z, i_y, i_x = dataset.shape
-        else:
-            i_z, i_y, i_x = dataset.shape
-
+        i_z, i_y, i_x = dataset.shape[-3:]
         k_z, k_y, k_x = patch_shape
         s_z, s_y, s_x = stride_shape
-        z_steps = SliceBuilder._gen_indices(i_z, k_z, s_z)
-        for z in z_steps:
-            y_steps = SliceBuilder._gen_indices(i_y, k_y, s_y)
-            for y in y_steps:
-                x_steps = SliceBuilder._gen_indices(i_x, k_x, s_x)
-                for x in x_steps:
-                    slice_idx = (
-                        slice(z, z + k_z),
-                        slice(y, y + k_y),
-                        slice(x, x + k_x)
-                    )
-                    if dataset.ndim == 4:
-                        slice_idx = (slice(0, in_channels),) + slice_idx
-                    slices.append(slice_idx)
-        return slices
+        z_steps = list(SliceBuilder._gen_indices(i_z, k_z, s_z))
+        y_steps = list(SliceBuilder._gen_indices(i_y, k_y, s_y))
+        x_steps = list(SliceBuilder._gen_indices(i_x, k_x, s_x))
+        # z-y-x order, i.e. x changes the fastest
+        origins = np.stack(np.meshgrid(z_steps, y_steps, x_steps, indexing='ij'), axis=-1).reshape(-1, 3)
+        return PatchSlices.for_dataset(origins.astype('int32'), patch_shape, dataset)
+
+    @staticmethod
+    def _shared_slices(slices, dataset, patch_shape, stride_shape):
+        # the datasets of the same spatial shape share the patch origins
+        if tuple(dataset.shape[-3:]) == tuple(slices.volume_shape):
+            return PatchSlices.for_dataset(slices.origins, patch_shape, dataset, slices.volume_shape)
+        return SliceBuilder._build_slices(dataset, patch_shape, stride_shape)
 
     @staticmethod
     def _gen_indices(i, k, s):
@@ -127,9 +170,74 @@ class SliceBuilder:
         assert patch_shape[0] >= 16, 'Depth must be greater or equal 16'
 
 
+class PatchSlices(collections.abc.Sequence):
+    """
+    Compact, read-only sequence of the patch positions built by the slice builders: an int32 (N, 3) array of the
+    spatial origins of the patches and the patch shape (DxHxW). The tuples of slices are created on access, so no
+    Python objects are kept per patch and the sequence is pickled (e.g. to the DataLoader workers) as a single
+    array. The raw/label/weight slices of the volumes of the same spatial shape share the `origins` array and differ
+    only in the `leading` slices, i.e. the channel slice of the 4D datasets.
+
+    Args:
+        origins (ndarray): int32 (N, 3) array of the spatial origins of the patches
+        patch_shape (tuple): spatial (DxHxW) shape of the patches
+        leading (tuple): slices of the non-spatial axes prepended to every patch position
+        volume_shape (tuple): spatial shape of the volume the positions are built for
+    """
+
+    def __init__(self, origins, patch_shape, leading=(), volume_shape=None):
+        assert origins.ndim == 2 and origins.shape[1] == 3, 'Origins must be a (N, 3) array'
+        self.origins = origins
+        self.patch_shape = tuple(int(p) for p in patch_shape)
+        self.leading = tuple(leading)
+        self.volume_shape = volume_shape
+
+    @classmethod
+    def for_dataset(cls, origins, patch_shape, dataset, volume_shape=None):
+        leading = (slice(0, dataset.shape[0]),) if dataset.ndim == 4 else ()
+        if volume_shape is None:
+            volume_shape = tuple(dataset.shape[-3:])
+        return cls(origins, patch_shape, leading, volume_shape)
+
+    @property
+    def patch_size(self):
+        """
+        Number of elements of every patch (including the non-spatial axes).
+        """
+        return int(np.prod([s.stop - s.start for s in self.leading] + list(self.patch_shape)))
+
+    def select(self, mask):
+        """
+        Returns the positions of the patches selected by a given boolean mask or an array of indices.
+        """
+        return PatchSlices(self.origins[mask], self.patch_shape, self.leading, self.volume_shape)
+
+    def __len__(self):
+        return len(self.origins)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return self.select(idx)
+        origin = self.origins[idx].tolist()
+        return self.leading + tuple(slice(o, o + p) for o, p in zip(origin, self.patch_shape))
+
+
+def _origins_to_slices(datasets, arrays, name):
+    # inverse of `SliceBuilder.index_arrays`
+    if datasets is None:
+        return None
+    origins = arrays.get(name + '_origins', arrays['raw_origins'])
+    return PatchSlices.for_dataset(origins, arrays[name + '_patch_shape'], datasets[0])
+
+
 class FilterSliceBuilder(SliceBuilder):
     """
-    Filter patches containing more than `1 - threshold` of ignore_index label
+    Filter patches containing more than `1 - threshold` of ignore_index label.
+
+    The number of `ignore_index` voxels of all patches is computed at once from the summed-area tables of the labels
+    (see `patch_value_counts`), built in a single streaming pass over the label volume. If `patch_index_cache` and
+    `file_path` are given (passed by the datasets, see `get_slice_builder`) the counts are saved to/loaded from the
+    `PatchIndexCache`, so that later runs skip the pass over the labels.
     """
 
     def __init__(self, raw_datasets, label_datasets, weight_datasets, patch_shape, stride_shape, ignore_index=(0,),
@@ -140,20 +248,54 @@ class FilterSliceBuilder(SliceBuilder):
 
         rand_state = np.random.RandomState(47)
 
-        def ignore_predicate(raw_label_idx):
-            label_idx = raw_label_idx[1]
-            patch = label_datasets[0][label_idx]
-            non_ignore_counts = np.array([np.count_nonzero(patch != ii) for ii in ignore_index])
-            non_ignore_counts = non_ignore_counts / patch.size
-            return np.any(non_ignore_counts > threshold) or rand_state.rand() < slack_acceptance
-
-        zipped_slices = zip(self.raw_slices, self.label_slices)
+        ignore_counts = self._ignore_counts(label_datasets[0], self.label_slices, ignore_index, patch_shape,
+                                            stride_shape, **kwargs)
+        patch_size = self.label_slices.patch_size
+        non_ignore_fractions = (patch_size - ignore_counts) / patch_size
+        accepted = np.any(non_ignore_fractions > threshold, axis=1)
+        # the rejected patches are accepted with `slack_acceptance` probability, one draw per rejected patch in order
+        rejected = np.flatnonzero(~accepted)
+        accepted[rejected] = rand_state.rand(len(rejected)) < slack_acceptance
         # ignore slices containing too much ignore_index
-        filtered_slices = list(filter(ignore_predicate, zipped_slices))
-        # unzip and save slices
-        raw_slices, label_slices = zip(*filtered_slices)
-        self._raw_slices = list(raw_slices)
-        self._label_slices = list(label_slices)
+        self._filter_slices(accepted)
+
+    @staticmethod
+    def _ignore_counts(label, label_slices, ignore_index, patch_shape, stride_shape, file_path=None,
+                       patch_index_cache=None, index_key=None, **kwargs):
+        def _count():
+            return {'counts': patch_value_counts(label, label_slices, ignore_index)}
+
+        patch_index_cache = PatchIndexCache.from_config(patch_index_cache)
+        if patch_index_cache is None or file_path is None:
+            return _count()['counts']
+
+        key = {
+            'dataset': index_key,
+            'shape': list(label.shape),
+            'patch_shape': list(patch_shape),
+            'stride_shape': list(stride_shape),
+            'values': [int(ii) for ii in ignore_index]
+        }
+        return patch_index_cache.get(file_path, key, _count)['counts']
+
+    def _filter_slices(self, mask):
+        """
+        Keeps only the raw/label/weight slices of the patches selected by the boolean `mask`.
+        """
+        mask = np.asarray(mask, dtype=bool)
+        raw_slices = self._raw_slices.select(mask)
+
+        def _select(slices):
+            if slices is None:
+                return None
+            if slices.origins is self._raw_slices.origins:
+                # keep sharing the origins with the raw slices
+                return PatchSlices(raw_slices.origins, slices.patch_shape, slices.leading, slices.volume_shape)
+            return slices.select(mask)
+
+        self._label_slices = _select(self._label_slices)
+        self._weight_slices = _select(self._weight_slices)
+        self._raw_slices = raw_slices
 
 
 class EmbeddingsSliceBuilder(FilterSliceBuilder):
@@ -172,8 +314,7 @@ class EmbeddingsSliceBuilder(FilterSliceBuilder):
 
         rand_state = np.random.RandomState(47)
 
-        def ignore_predicate(raw_label_idx):
-            label_idx = raw_label_idx[1]
+        def ignore_predicate(label_idx):
             patch = label_datasets[0][label_idx]
             num_instances = np.unique(patch).size
 
@@ -184,13 +325,8 @@ class EmbeddingsSliceBuilder(FilterSliceBuilder):
 
             return False
 
-        zipped_slices = zip(self.raw_slices, self.label_slices)
-        # ignore slices containing too much ignore_index
-        filtered_slices = list(filter(ignore_predicate, zipped_slices))
-        # unzip and save slices
-        raw_slices, label_slices = zip(*filtered_slices)
-        self._raw_slices = list(raw_slices)
-        self._label_slices = list(label_slices)
+        # the number of instances is checked only for the patches passing the ignore_index filter
+        self._filter_slices([ignore_predicate(label_idx) for label_idx in self.label_slices])
 
 
 class RandomFilterSliceBuilder(EmbeddingsSliceBuilder):
@@ -212,24 +348,155 @@ class RandomFilterSliceBuilder(EmbeddingsSliceBuilder):
 
         rand_state = np.random.RandomState(47)
 
-        def ignore_predicate(raw_label_idx):
+        def ignore_predicate():
             result = rand_state.rand() < patch_acceptance_probab
             if result:
                 self.max_num_patches -= 1
 
             return result and self.max_num_patches > 0
 
-        zipped_slices = zip(self.raw_slices, self.label_slices)
-        # ignore slices containing too much ignore_index
-        filtered_slices = list(filter(ignore_predicate, zipped_slices))
-        # unzip and save slices
-        raw_slices, label_slices = zip(*filtered_slices)
-        self._raw_slices = list(raw_slices)
-        self._label_slices = list(label_slices)
+        # accept a random sample of the remaining slices
+        self._filter_slices([ignore_predicate() for _ in range(len(self.label_slices))])
+
+
+class RandomPatchSliceBuilder(SliceBuilder):
+    """
+    Draws `num_patches` random patch positions instead of iterating over a fixed grid, so no index of the patches is
+    built up front and every epoch sees a new set of patches. The positions are drawn when the dataset reads a patch
+    (see `_RandomSlices`), `stride_shape` is ignored.
+
+    By default the patch origins are drawn uniformly. If `class_weights` (one weight per label value) is given, the
+    class of the patch center is drawn first with probability proportional to its weight (among the classes present
+    in the volume) and the center is drawn uniformly among the voxels of this class. The voxels of every class are
+    found once on the label volume subsampled by `sample_stride` along each axis.
+    """
+
+    # the positions are drawn anew in every epoch
+    cacheable = False
+
+    def __init__(self, raw_datasets, label_datasets, weight_datasets, patch_shape, stride_shape=None,
+                 num_patches=None, class_weights=None, sample_stride=4, **kwargs):
+        patch_shape = tuple(patch_shape)
+        if not kwargs.get('skip_shape_check', False):
+            self._check_patch_shape(patch_shape)
+
+        raw = raw_datasets[0]
+        volume_shape = tuple(raw.shape[-3:])
+        assert all(v >= p for v, p in zip(volume_shape, patch_shape)), \
+            'Sample size has to be bigger than the patch size'
+        if num_patches is None:
+            # roughly the number of non-overlapping patches in the volume
+            num_patches = int(np.ceil(np.prod(volume_shape) / np.prod(patch_shape)))
+
+        class_centers = None
+        if class_weights is not None:
+            assert label_datasets is not None, 'Class weighted sampling requires the labels'
+            class_centers = self._class_centers(label_datasets[0], len(class_weights), sample_stride)
+            class_weights = np.array([w if len(centers) > 0 else 0 for w, centers in zip(class_weights, class_centers)],
+                                     dtype='float64')
+            assert class_weights.sum() > 0, 'None of the weighted classes is present in the labels'
+            class_weights /= class_weights.sum()
+
+        origins = _RandomOrigins(volume_shape, patch_shape, num_patches, class_weights, class_centers)
+
+        def _slices(dataset, draw):
+            if dataset is None:
+                return None
+            leading = (slice(0, dataset[0].shape[0]),) if dataset[0].ndim == 4 else ()
+            return _RandomSlices(origins, leading, draw)
+
+        # the raw patch is read first and draws a new position, labels and weights reuse it
+        self._raw_slices = _slices(raw_datasets, True)
+        self._label_slices = _slices(label_datasets, False)
+        self._weight_slices = _slices(weight_datasets, False)
+
+    @staticmethod
+    def _class_centers(label, num_classes, sample_stride, block_size=64 * 1024 ** 2):
+        assert label.ndim == 3, 'Class weighted sampling supports only 3D (DxHxW) labels'
+        centers = [[] for _ in range(num_classes)]
+        # read the labels slab by slab, keeping every `sample_stride`-th voxel
+        slab = max(sample_stride, (block_size // (label.dtype.itemsize * int(np.prod(label.shape[1:])))) //
+                   sample_stride * sample_stride)
+        for z in range(0, label.shape[0], slab):
+            block = np.asarray(label[z:z + slab])[::sample_stride, ::sample_stride, ::sample_stride]
+            for c in range(num_classes):
+                coords = np.argwhere(block == c).astype('int32') * sample_stride
+                coords[:, 0] += z
+                centers[c].append(coords)
+        return [np.concatenate(c) for c in centers]
+
+
+class _RandomOrigins:
+    """
+    Draws the random patch origins for the `RandomPatchSliceBuilder`. The random state is seeded from the torch seed
+    of the process, which is different in every DataLoader worker and epoch.
+    """
+
+    def __init__(self, volume_shape, patch_shape, num_patches, class_weights=None, class_centers=None):
+        self.volume_shape = volume_shape
+        self.patch_shape = patch_shape
+        self.num_patches = num_patches
+        self.class_weights = class_weights
+        self.class_centers = class_centers
+        self._rand_state = None
+        self._seed = None
+        self._last = None
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['_rand_state'] = None
+        state['_seed'] = None
+        return state
+
+    def _get_rand_state(self):
+        seed = torch.initial_seed() % 2 ** 32
+        if self._rand_state is None or seed != self._seed:
+            self._rand_state = np.random.RandomState(seed)
+            self._seed = seed
+        return self._rand_state
+
+    def draw(self, idx):
+        rs = self._get_rand_state()
+        max_origin = np.subtract(self.volume_shape, self.patch_shape)
+        if self.class_weights is None:
+            origin = tuple(int(rs.randint(0, m + 1)) for m in max_origin)
+        else:
+            centers = self.class_centers[rs.choice(len(self.class_weights), p=self.class_weights)]
+            center = centers[rs.randint(len(centers))]
+            origin = tuple(int(np.clip(c - p // 2, 0, m)) for c, p, m in zip(center, self.patch_shape, max_origin))
+        self._last = (idx, origin)
+        return origin
+
+    def get(self, idx):
+        if self._last is not None and self._last[0] == idx:
+            return self._last[1]
+        return self.draw(idx)
+
+
+class _RandomSlices:
+    """
+    Sequence of the random patch positions of the `RandomPatchSliceBuilder`. The sequence of the raw patches draws
+    a new position on every access, while the label/weight sequences reuse the position drawn for the same index.
+    """
+
+    def __init__(self, origins, leading, draw):
+        self.origins = origins
+        self.leading = leading
+        self.draw = draw
+
+    def __len__(self):
+        return self.origins.num_patches
+
+    def __getitem__(self, idx):
+        if idx >= len(self):
+            raise IndexError(idx)
+        origin = self.origins.draw(idx) if self.draw else self.origins.get(idx)
+        return self.leading + tuple(slice(o, o + p) for o, p in zip(origin, self.origins.patch_shape))
 
 
 def _get_cls(class_name):
-    modules = ['pytorch3dunet.datasets.hdf5', 'pytorch3dunet.datasets.dsb', 'pytorch3dunet.datasets.utils']
+    modules = ['pytorch3dunet.datasets.hdf5', 'pytorch3dunet.datasets.dsb', 'pytorch3dunet.datasets.zarr',
+               'pytorch3dunet.datasets.npy', 'pytorch3dunet.datasets.utils']
     for module in modules:
         m = importlib.import_module(module)
         clazz = getattr(m, class_name, None)
@@ -238,11 +505,151 @@ def _get_cls(class_name):
     raise RuntimeError(f'Unsupported dataset class: {class_name}')
 
 
-def get_slice_builder(raws, labels, weight_maps, config):
+def get_slice_builder(raws, labels, weight_maps, config, file_path=None, patch_index_cache=None, index_key=None):
+    """
+    Creates the slice builder given by the `config`.
+
+    If the `file_path` of the datasets and the `patch_index_cache` are given, the slices are saved to/loaded from
+    the `PatchIndexCache` as the compact arrays of the patch origins (see `SliceBuilder.index_arrays`), keyed by the
+    `index_key` (identifying the datasets within the file, e.g. the internal paths), the shapes of the datasets and
+    the `config`. The slices are not specific to the phase, so e.g. the train and val datasets of the same file
+    share them. They are also passed on to the slice builders caching their own per-patch arrays.
+    """
     assert 'name' in config
     logger.info(f"Slice builder config: {config}")
     slice_builder_cls = _get_cls(config['name'])
-    return slice_builder_cls(raws, labels, weight_maps, **config)
+
+    def _create():
+        return slice_builder_cls(raws, labels, weight_maps, file_path=file_path, patch_index_cache=patch_index_cache,
+                                 index_key=index_key, **config)
+
+    patch_index_cache = PatchIndexCache.from_config(patch_index_cache)
+    if patch_index_cache is None or file_path is None or not slice_builder_cls.cacheable:
+        return _create()
+
+    def _shapes(datasets):
+        return None if datasets is None else [list(ds.shape) for ds in datasets]
+
+    key = {
+        'dataset': index_key,
+        'shapes': [_shapes(raws), _shapes(labels), _shapes(weight_maps)],
+        'slice_builder': config
+    }
+    arrays = patch_index_cache.get(file_path, key, lambda: _create().index_arrays())
+    return slice_builder_cls.from_index_arrays(raws, labels, weight_maps, arrays)
+
+
+class WeightedPatchSampler(Sampler):
+    """
+    Samples the patches of the training datasets (with replacement) by the label statistics of the patches, in order
+    to show the patches of the rare classes more often than they occur in the data.
+
+    The number of voxels of every class in every patch is computed once from the labels (see
+    `AbstractHDF5Dataset.patch_label_counts`). The weight of a patch is the mean over its voxels of the inverse
+    class frequencies (raised to the power of `class_balance`), i.e. `class_balance: 0` samples the patches
+    uniformly and `class_balance: 1` gives every class the same share of the sampled voxels. The patches without
+    any voxel of the `classes` get the smallest weight of the remaining patches.
+
+    If `loss_weight > 0` the weights are additionally multiplied by `(loss / mean loss) ** loss_weight`, where
+    `loss` is the exponential moving average of the loss of the patch reported by the trainer (see
+    `update_losses`), so that the hard examples are sampled more often. The weights are updated every
+    `refresh_every` sampled patches. The losses are assigned to the patches in the order they were sampled, which
+    requires the DataLoader to return the batches in order (the default).
+
+    Args:
+        datasets (list): datasets of the `ConcatDataset` to sample from
+        classes (list): label values of the classes
+        class_balance (float): exponent of the inverse class frequencies
+        loss_weight (float): exponent of the relative loss of the patches; 0 disables the loss reweighting
+        loss_momentum (float): momentum of the moving average of the patch losses
+        num_samples (int): number of patches sampled per epoch; defaults to the number of patches
+        refresh_every (int): number of patches sampled with the same weights
+        seed (int): optional seed of the random state
+    """
+
+    def __init__(self, datasets, classes, class_balance=1.0, loss_weight=0.0, loss_momentum=0.9, num_samples=None,
+                 refresh_every=1024, seed=None, **kwargs):
+        counts = np.concatenate([dataset.patch_label_counts(classes) for dataset in datasets]).astype('float64')
+        assert len(counts) > 0, 'No patches to sample from'
+
+        totals = counts.sum(axis=0)
+        frequencies = totals / max(totals.sum(), 1)
+        inverse_frequencies = np.zeros_like(frequencies)
+        present = frequencies > 0
+        inverse_frequencies[present] = frequencies[present] ** -class_balance
+        logger.info(f'Class frequencies: {dict(zip(classes, frequencies.tolist()))}')
+
+        weights = (counts @ inverse_frequencies) / np.maximum(counts.sum(axis=1), 1)
+        if not np.any(weights > 0):
+            weights = np.ones_like(weights)
+        self.class_weights = np.maximum(weights, weights[weights > 0].min())
+
+        self.loss_weight = loss_weight
+        self.loss_momentum = loss_momentum
+        self.losses = np.full(len(counts), np.nan)
+        self.num_samples = len(counts) if num_samples is None else num_samples
+        self.refresh_every = refresh_every
+        self.rand_state = np.random.RandomState(seed)
+        # sampled patches waiting for their loss
+        self._pending = collections.deque()
+
+    @property
+    def tracks_loss(self):
+        return self.loss_weight > 0
+
+    def weights(self):
+        """
+        Returns the current sampling probability of every patch.
+        """
+        weights = self.class_weights
+        known = ~np.isnan(self.losses)
+        if self.tracks_loss and np.any(known):
+            # patches without a loss yet keep their class weight
+            relative_losses = np.ones_like(weights)
+            relative_losses[known] = self.losses[known] / max(self.losses[known].mean(), 1e-12)
+            weights = weights * relative_losses ** self.loss_weight
+        return weights / weights.sum()
+
+    def update_losses(self, losses):
+        """
+        Updates the moving average of the losses of the next sampled patches, given in the order of sampling
+        (e.g. the losses of the samples of a batch).
+        """
+        for loss in losses:
+            if not self._pending:
+                return
+            idx = self._pending.popleft()
+            if np.isnan(self.losses[idx]):
+                self.losses[idx] = loss
+            else:
+                self.losses[idx] = self.loss_momentum * self.losses[idx] + (1 - self.loss_momentum) * loss
+
+    def __iter__(self):
+        self._pending.clear()
+        remaining = self.num_samples
+        while remaining > 0:
+            size = min(self.refresh_every, remaining)
+            for idx in self.rand_state.choice(len(self.class_weights), size=size, p=self.weights()).tolist():
+                if self.tracks_loss:
+                    self._pending.append(idx)
+                yield idx
+            remaining -= size
+
+    def __len__(self):
+        return self.num_samples
+
+
+def get_sampler(config, datasets):
+    """
+    Creates the sampler of the training patches given by the `sampler` section of the train loader config
+    (e.g. the `WeightedPatchSampler`), or returns None if not configured, i.e. the patches are shuffled.
+    """
+    if config is None:
+        return None
+    config = dict(config)
+    sampler_cls = _get_cls(config.pop('name', 'WeightedPatchSampler'))
+    logger.info(f'Sampler config: {config}')
+    return sampler_cls(datasets, **config)
 
 
 def get_train_loaders(config):
@@ -271,6 +678,7 @@ def get_train_loaders(config):
         "Train and validation 'file_paths' overlap. One cannot use validation data for training!"
 
     train_datasets = dataset_class.create_datasets(loaders_config, phase='train')
+    train_sampler = get_sampler(loaders_config['train'].get('sampler', None), train_datasets)
 
     val_datasets = dataset_class.create_datasets(loaders_config, phase='val')
 
@@ -285,16 +693,19 @@ def get_train_loaders(config):
     logger.info(f'Batch size for train/val loader: {batch_size}')
     # when training with volumetric data use batch_size of 1 due to GPU memory constraints
     return {
-        'train': DataLoader(ConcatDataset(train_datasets), batch_size=batch_size, shuffle=True,
-                            num_workers=num_workers),
+        'train': DataLoader(ConcatDataset(train_datasets), batch_size=batch_size, shuffle=train_sampler is None,
+                            sampler=train_sampler, num_workers=num_workers),
         'val': DataLoader(ConcatDataset(val_datasets), batch_size=batch_size, shuffle=True, num_workers=num_workers)
     }
 
 
-def get_test_loaders(config):
+def get_test_loaders(config, file_paths=None):
     """
     Returns test DataLoader.
 
+    :param config: a top level configuration object containing the 'loaders' key
+    :param file_paths: optional list of files (or directories) to predict instead of the `file_paths` of the test
+        loader config, all other options of the loaders config are used as is
     :return: generator of DataLoader objects
     """
 
@@ -310,6 +721,8 @@ def get_test_loaders(config):
         logger.warn(f"Cannot find dataset class in the config. Using default '{dataset_cls_str}'.")
     dataset_class = _get_cls(dataset_cls_str)
 
+    if file_paths is not None:
+        loaders_config = dict(loaders_config, test=dict(loaders_config['test'], file_paths=file_paths))
     test_datasets = dataset_class.create_datasets(loaders_config, phase='test')
 
     num_workers = loaders_config.get('num_workers', 1)
@@ -342,12 +755,416 @@ def prediction_collate(batch):
     raise TypeError((error_msg.format(type(batch[0]))))
 
 
-def calculate_stats(images):
+def _iter_blocks(image, block_size):
     """
-    Calculates min, max, mean, std given a list of ndarrays
+    Yields the slices of the blocks the `image` is read in by `calculate_stats`: blocks of whole chunks of at most
+    `block_size` bytes (but at least one chunk) of a chunked H5 dataset, otherwise slabs of at most `block_size` bytes
+    along the z-axis (or the first axis for 2D images).
+    """
+    chunks = getattr(image, 'chunks', None)
+    if isinstance(chunks, tuple):
+        # group the chunks starting from the last axis, e.g. into whole chunk-aligned z-slabs, so that the small
+        # (auto-)chunks of H5 datasets are not read one by one
+        block_shape = list(chunks)
+        size = int(np.prod(chunks)) * image.dtype.itemsize
+        for axis in reversed(range(image.ndim)):
+            count = max(1, block_size // max(size, 1))
+            block_shape[axis] = min(count * chunks[axis], image.shape[axis])
+            if block_shape[axis] < image.shape[axis]:
+                break
+            # the whole axis fits in the block, continue with the preceding one
+            size = size // chunks[axis] * image.shape[axis]
+
+        ranges = [range(0, extent, step) for extent, step in zip(image.shape, block_shape)]
+        for starts in itertools.product(*ranges):
+            yield tuple(slice(start, start + step) for start, step in zip(starts, block_shape))
+        return
+
+    axis = max(image.ndim - 3, 0)
+    slab_size = int(np.prod(image.shape[axis + 1:])) * image.dtype.itemsize
+    step = max(1, block_size // max(slab_size, 1))
+    for start in range(0, image.shape[axis], step):
+        yield (slice(None),) * axis + (slice(start, start + step),)
+
+
+def calculate_stats(images, subsample=None, block_size=64 * 1024 ** 2, seed=0):
+    """
+    Calculates min, max, mean, std given a list of ndarrays (or h5py datasets) in a single pass over the data.
+
+    The images are read block by block (see `_iter_blocks`) and the per-block statistics are merged with the
+    pairwise (Chan et al.) update of the mean and the sum of squared deviations, so neither a flattened copy of the
+    images is created nor the h5py datasets are loaded into memory at once.
+
+    :param images: list of ndarrays or h5py datasets
+    :param subsample (float): if given, only a random fraction `subsample` of the blocks is read, which gives
+        approximate statistics for a fraction of the I/O
+    :param block_size (int): maximum size (in bytes) of the blocks read from the images
+    :param seed (int): seed of the random block selection
     """
-    # flatten first since the images might not be the same size
-    flat = np.concatenate(
-        [img.ravel() for img in images]
-    )
-    return np.min(flat), np.max(flat), np.mean(flat), np.std(flat)
+    if subsample is not None:
+        assert 0 < subsample <= 1, f'Invalid subsample fraction: {subsample}'
+    rng = np.random.RandomState(seed)
+
+    count, mean, m2 = 0, 0., 0.
+    min_value, max_value = None, None
+    for image in images:
+        for index in _iter_blocks(image, block_size):
+            if subsample is not None and count > 0 and rng.random_sample() >= subsample:
+                continue
+            block = np.asarray(image[index])
+            if block.size == 0:
+                continue
+
+            block_min, block_max = block.min(), block.max()
+            min_value = block_min if min_value is None else min(min_value, block_min)
+            max_value = block_max if max_value is None else max(max_value, block_max)
+
+            block = block.astype('float64', copy=False)
+            block_count = block.size
+            block_mean = block.mean()
+            block_m2 = np.square(block - block_mean).sum()
+
+            # merge the block statistics into the running ones
+            delta = block_mean - mean
+            total = count + block_count
+            mean += delta * block_count / total
+            m2 += block_m2 + delta ** 2 * count * block_count / total
+            count = total
+
+    assert count > 0, 'Cannot calculate the statistics of empty images'
+    return min_value, max_value, mean, np.sqrt(m2 / count)
+
+
+def patch_value_counts(label, slices, values, block_size=64 * 1024 ** 2):
+    """
+    Counts the voxels equal to each of the `values` in every patch of the `label` volume, i.e. the box sums of the
+    indicator volumes `label == value` over the patches given by `slices`.
+
+    The box sums are separable, so the summed-area table is never materialized as a whole: the label volume is
+    read once, slab by slab along the z-axis, while the running sum of the indicator planes is
+    accumulated. When the z-range of some patches is complete, the difference of the running sums at its borders is
+    integrated along the y and x-axis and the box sums of all of the (y, x) ranges are taken at once. Only the
+    running sums at the start of the z-ranges still in progress are kept in memory.
+
+    :param label: 3D (DxHxW) or 4D (CxDxHxW) ndarray or array-like (e.g. h5py dataset); the voxels of all channels
+        are counted for the 4D labels
+    :param slices: `PatchSlices` or a list of slice tuples (with the unit step), e.g. the `label_slices` of the
+        `SliceBuilder`
+    :param values: list of the label values to count
+    :param block_size (int): maximum size (in bytes) of the slabs read from the label volume
+    :return: int64 ndarray of shape `(len(slices), len(values))`
+    """
+    assert label.ndim in [3, 4], 'Supports only 3D (DxHxW) or 4D (CxDxHxW) labels'
+    values = list(values)
+    if len(slices) == 0:
+        return np.zeros((0, len(values)), dtype='int64')
+
+    # (start, stop) of the patches along each spatial axis
+    if isinstance(slices, PatchSlices):
+        ranges = np.stack([slices.origins, slices.origins + np.array(slices.patch_shape)], axis=-1)
+    else:
+        ranges = np.array([[s.indices(size)[:2] for s, size in zip(index[-3:], label.shape[-3:])]
+                           for index in slices])
+    axis_ranges = []
+    for axis in range(3):
+        unique_ranges, inverse = np.unique(ranges[:, axis], axis=0, return_inverse=True)
+        axis_ranges.append((unique_ranges, inverse.reshape(-1)))
+    (z_ranges, z_inverse), (y_ranges, y_inverse), (x_ranges, x_inverse) = axis_ranges
+
+    def _yx_box_sums(plane_sums):
+        # box sums of the (nv, H, W) `plane_sums` over all of the (y, x) ranges
+        nv, h, w = plane_sums.shape
+        cumsum = np.zeros((nv, h + 1, w), dtype='int64')
+        np.cumsum(plane_sums, axis=1, out=cumsum[:, 1:])
+        y_sums = cumsum[:, y_ranges[:, 1]] - cumsum[:, y_ranges[:, 0]]
+        cumsum = np.zeros((nv, len(y_ranges), w + 1), dtype='int64')
+        np.cumsum(y_sums, axis=2, out=cumsum[:, :, 1:])
+        return cumsum[:, :, x_ranges[:, 1]] - cumsum[:, :, x_ranges[:, 0]]
+
+    box_sums = np.zeros((len(z_ranges), len(values), len(y_ranges), len(x_ranges)), dtype='int64')
+    ranges_by_stop = collections.defaultdict(list)
+    last_stop = {}
+    for i, (start, stop) in enumerate(z_ranges):
+        ranges_by_stop[stop].append(i)
+        last_stop[start] = max(last_stop.get(start, 0), stop)
+    boundaries = sorted(set(ranges_by_stop) | set(last_stop))
+
+    # running sums of the indicator planes, i.e. the counts in `label[..., :z, :, :]`
+    running_sums = np.zeros((len(values),) + tuple(label.shape[-2:]), dtype='int64')
+    start_sums = {}
+
+    def _at_boundary(z):
+        for i in ranges_by_stop.get(z, []):
+            box_sums[i] = _yx_box_sums(running_sums - start_sums[z_ranges[i, 0]])
+        if z in last_stop:
+            start_sums[z] = running_sums.copy()
+        for start in [start for start in start_sums if last_stop[start] <= z]:
+            del start_sums[start]
+
+    def _accumulate(block):
+        axes = tuple(range(block.ndim - 2))
+        for k, value in enumerate(values):
+            running_sums[k] += np.count_nonzero(block == value, axis=axes)
+
+    boundary_iter = iter(boundaries)
+    boundary = next(boundary_iter, None)
+    if boundary == 0:
+        _at_boundary(0)
+        boundary = next(boundary_iter, None)
+    z_axis = label.ndim - 3
+    depth = label.shape[z_axis]
+    slab = max(1, block_size // (label.dtype.itemsize * int(np.prod(label.shape)) // depth))
+    for start in range(0, depth, slab):
+        stop = min(start + slab, depth)
+        block = np.asarray(label[(slice(None),) * z_axis + (slice(start, stop),)])
+        z = start
+        while boundary is not None and boundary <= stop:
+            _accumulate(block[..., z - start:boundary - start, :, :])
+            _at_boundary(boundary)
+            z = boundary
+            boundary = next(boundary_iter, None)
+        _accumulate(block[..., z - start:, :, :])
+
+    return box_sums[z_inverse, :, y_inverse, x_inverse]
+
+
+class StatsCache:
+    """
+    Persistent cache of the normalization statistics (min, max, mean, std) of the input files, so that they are
+    computed only once and reused across runs and across the train/val/test phases.
+
+    The statistics of a file (or a directory of images) are stored in a JSON sidecar: `<path>.stats.json` next to
+    the file (`<path>/.stats.json` for directories) or, if `cache_dir` is given, `<cache_dir>/<hash of path>.json`.
+    The sidecar is invalidated when the size or modification time of the file (or of any file in the directory)
+    changes. Within a sidecar the statistics are keyed by the `key` given by the dataset, e.g. the internal paths,
+    shapes and subsampling of the raw datasets.
+
+    Args:
+        cache_dir (str): optional directory for the sidecars, e.g. if the data directories are read-only
+    """
+
+    def __init__(self, cache_dir=None):
+        self.cache_dir = cache_dir
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    @classmethod
+    def from_config(cls, stats_cache):
+        """
+        Creates the cache from the `stats_cache` option of the loaders config: `true` (sidecars next to the data),
+        a path to the cache directory, or `false`/None (no caching). `StatsCache` instances are returned as is.
+        """
+        if not stats_cache:
+            return None
+        if isinstance(stats_cache, StatsCache):
+            return stats_cache
+        if stats_cache is True:
+            return cls()
+        return cls(stats_cache)
+
+    def cache_file(self, path):
+        path = os.path.abspath(path)
+        if self.cache_dir is not None:
+            return os.path.join(self.cache_dir, hashlib.sha1(path.encode()).hexdigest() + '.json')
+        if os.path.isdir(path):
+            return os.path.join(path, '.stats.json')
+        return path + '.stats.json'
+
+    @staticmethod
+    def _signature(path):
+        if os.path.isdir(path):
+            # top-level entries only, e.g. the images of a directory or the arrays of a Zarr container
+            files = sorted((entry for entry in os.scandir(path) if not entry.name.startswith('.')),
+                           key=lambda entry: entry.name)
+            stats = [(entry.name, entry.stat()) for entry in files]
+        else:
+            stats = [(os.path.basename(path), os.stat(path))]
+        content = json.dumps([(name, st.st_size, st.st_mtime_ns) for name, st in stats])
+        return hashlib.sha1(content.encode()).hexdigest()
+
+    def _load(self, cache_file, signature):
+        try:
+            with open(cache_file, 'r') as f:
+                content = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        if content.get('signature') != signature:
+            # the data has changed since the statistics were computed
+            return {}
+        return content.get('entries', {})
+
+    def get(self, path, key, calculate):
+        """
+        Returns the cached statistics of the file (or directory) at `path` for a given `key` (JSON serializable)
+        or calls `calculate()` and saves its result if not cached yet.
+        """
+        cache_file = self.cache_file(path)
+        signature = self._signature(path)
+        key = json.dumps(key, sort_keys=True)
+
+        entries = self._load(cache_file, signature)
+        if key in entries:
+            logger.info(f'Using cached input stats from: {cache_file}')
+            return tuple(entries[key])
+
+        stats = calculate()
+        entries[key] = [float(value) for value in stats]
+        try:
+            # write atomically, the same file might be used by multiple processes at once
+            fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(cache_file), suffix='.tmp')
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'path': os.path.abspath(path), 'signature': signature, 'entries': entries}, f)
+            os.replace(tmp_file, cache_file)
+        except OSError:
+            logger.warn(f'Cannot save input stats to: {cache_file}', exc_info=True)
+        return stats
+
+
+class PatchIndexCache:
+    """
+    Persistent cache of the patch index built by the slice builders (see `get_slice_builder`) and of the per-patch
+    arrays computed by them (e.g. the number of `ignore_index` voxels in every patch used by the
+    `FilterSliceBuilder`), so that they are computed only once per file.
+
+    The arrays of a file (or a directory) are stored in `.npz` files, one per `key`: in the `<path>.patches/`
+    directory next to the file (`<path>/.patches/` for directories) or, if `cache_dir` is given, in `cache_dir`.
+    As for the `StatsCache` the arrays are invalidated when the size or modification time of the file changes.
+
+    Args:
+        cache_dir (str): optional directory for the cached arrays, e.g. if the data directories are read-only
+    """
+
+    def __init__(self, cache_dir=None):
+        self.cache_dir = cache_dir
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    @classmethod
+    def from_config(cls, patch_index_cache):
+        """
+        Creates the cache from the `patch_index_cache` option of the loaders config: `true` (next to the data),
+        a path to the cache directory, or `false`/None (no caching). `PatchIndexCache` instances are returned as is.
+        """
+        if not patch_index_cache:
+            return None
+        if isinstance(patch_index_cache, PatchIndexCache):
+            return patch_index_cache
+        if patch_index_cache is True:
+            return cls()
+        return cls(patch_index_cache)
+
+    def cache_file(self, path, key):
+        path = os.path.abspath(path)
+        key_hash = hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest()
+        if self.cache_dir is not None:
+            return os.path.join(self.cache_dir, hashlib.sha1(path.encode()).hexdigest() + '-' + key_hash + '.npz')
+        if os.path.isdir(path):
+            return os.path.join(path, '.patches', key_hash + '.npz')
+        return os.path.join(path + '.patches', key_hash + '.npz')
+
+    def get(self, path, key, calculate):
+        """
+        Returns the cached dict of arrays of the file (or directory) at `path` for a given `key` (JSON serializable)
+        or calls `calculate()` and saves the dict of arrays it returns if not cached yet.
+        """
+        cache_file = self.cache_file(path, key)
+        signature = StatsCache._signature(path)
+
+        try:
+            with np.load(cache_file, allow_pickle=False) as content:
+                if str(content['__signature__']) == signature:
+                    logger.info(f'Using cached patch index from: {cache_file}')
+                    return {name: content[name] for name in content.files if name != '__signature__'}
+        except (OSError, ValueError, KeyError):
+            pass
+
+        arrays = calculate()
+        try:
+            os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+            # write atomically, the same file might be used by multiple processes at once
+            fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(cache_file), suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, __signature__=np.array(signature), **arrays)
+            os.replace(tmp_file, cache_file)
+        except OSError:
+            logger.warn(f'Cannot save patch index to: {cache_file}', exc_info=True)
+        return arrays
+
+
+class PaddedVolume:
+    """
+    Read-only view of a 3D (DxHxW) or 4D (CxDxHxW) volume mirror padded (as in `np.pad(..., mode='reflect')`) along
+    the spatial axes. The padding is never materialized: patches inside of the volume are read directly, patches
+    crossing the border are read from the part of the volume they reflect and mirrored in memory. Works with any
+    array-like volume supporting slicing, e.g. ndarray or h5py.Dataset.
+
+    Args:
+        volume: 3D (DxHxW) or 4D (CxDxHxW) array-like
+        pad_width (int or tuple): number of voxels padded to each side of the spatial axes; either a single int,
+            an int per axis (z, y, x) or a (before, after) pair per axis
+    """
+
+    def __init__(self, volume, pad_width):
+        assert volume.ndim in [3, 4], 'Supports only 3D (DxHxW) or 4D (CxDxHxW) volumes'
+        if np.isscalar(pad_width):
+            pad_width = (pad_width,) * 3
+        assert len(pad_width) == 3, f'Invalid pad_width: {pad_width}'
+        pad_width = tuple((int(p), int(p)) if np.isscalar(p) else (int(p[0]), int(p[1])) for p in pad_width)
+
+        volume_shape = volume.shape[-3:]
+        for (before, after), size in zip(pad_width, volume_shape):
+            assert before < size and after < size, 'Mirror padding must be smaller than the volume'
+
+        self.volume = volume
+        self.pad_width = pad_width
+        self.ndim = volume.ndim
+        self.dtype = volume.dtype
+        self.shape = tuple(volume.shape[:-3]) + tuple(
+            size + before + after for (before, after), size in zip(pad_width, volume_shape))
+
+    def _source_coords(self, axis, s):
+        # coordinates in the volume of the voxels selected by the slice `s` along a given spatial axis
+        size = self.volume.shape[-3:][axis]
+        before = self.pad_width[axis][0]
+        start, stop, step = s.indices(self.shape[-3:][axis])
+        coords = np.abs(np.arange(start, stop, step) - before)
+        return np.where(coords >= size, 2 * (size - 1) - coords, coords)
+
+    def source_slices(self, index):
+        """
+        Returns the spatial (DHW) bounding box (in the volume coordinates) of the voxels reflected by a given `index`.
+        """
+        slices = []
+        for axis, s in enumerate(index[-3:]):
+            coords = self._source_coords(axis, s)
+            slices.append(slice(int(coords.min()), int(coords.max()) + 1) if len(coords) else slice(0, 0))
+        return tuple(slices)
+
+    def __getitem__(self, index):
+        if not isinstance(index, tuple):
+            index = (index,)
+        assert len(index) == self.ndim and all(isinstance(s, slice) for s in index[-3:]), \
+            'Spatial axes of the padded volume can be indexed only with slices'
+
+        volume_index = []
+        takes = []
+        for axis, s in enumerate(index[-3:]):
+            size = self.volume.shape[-3:][axis]
+            before = self.pad_width[axis][0]
+            start, stop, step = s.indices(self.shape[-3:][axis])
+            if start >= before and stop - before <= size:
+                # inside of the volume, read directly
+                volume_index.append(slice(start - before, stop - before, step))
+                takes.append(None)
+            else:
+                # read the reflected part of the volume and mirror it in memory
+                coords = self._source_coords(axis, s)
+                offset = int(coords.min()) if len(coords) else 0
+                volume_index.append(slice(offset, int(coords.max()) + 1 if len(coords) else 0))
+                takes.append(coords - offset)
+
+        patch = np.asarray(self.volume[tuple(index[:-3]) + tuple(volume_index)])
+        for axis, take in enumerate(takes):
+            if take is not None:
+                patch = np.take(patch, take, axis=patch.ndim - 3 + axis)
+        return patch
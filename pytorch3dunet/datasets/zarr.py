@@ -0,0 +1,177 @@
+import glob
+import itertools
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from pytorch3dunet.datasets.hdf5 import AbstractHDF5Dataset
+from pytorch3dunet.unet3d.utils import get_logger
+
+try:
+    import zarr
+except ImportError:
+    zarr = None
+
+logger = get_logger('ZarrDataset')
+
+ZARR_EXTENSIONS = ('.zarr', '.n5')
+
+
+def open_zarr(path, mode='r'):
+    """
+    Opens the Zarr (or N5 if `path` ends with `.n5`) container at `path`.
+    """
+    if zarr is None:
+        raise ImportError("Reading/writing Zarr and N5 requires the 'zarr' package, "
+                          "e.g. 'conda install -c conda-forge zarr'")
+    if path.rstrip('/').endswith('.n5'):
+        return zarr.open(zarr.N5Store(path), mode=mode)
+    return zarr.open(path, mode=mode)
+
+
+def is_zarr_path(path):
+    return path.rstrip('/').endswith(ZARR_EXTENSIONS)
+
+
+class ZarrFile:
+    """
+    Zarr/N5 output container with the part of the `h5py.File` interface used by the predictors
+    (`create_dataset`, `attrs`, item access, `flush` and `close`).
+    """
+
+    def __init__(self, path, mode='r'):
+        self.path = path
+        self.group = open_zarr(path, mode)
+
+    def __getattr__(self, name):
+        return getattr(self.group, name)
+
+    def __getitem__(self, name):
+        return self.group[name]
+
+    def __contains__(self, name):
+        return name in self.group
+
+    def flush(self):
+        # chunks are written to the store right away
+        pass
+
+    def close(self):
+        pass
+
+
+class _ZarrArray:
+    """
+    Read-only proxy of a Zarr array which decompresses the chunks overlapping with a requested patch in parallel,
+    using `num_threads` threads. The thread pool is created lazily in every process, so the proxy can be shared
+    with the (forked or spawned) DataLoader workers; the chunks are read directly from the store by each worker.
+    """
+
+    def __init__(self, array, num_threads):
+        assert array.ndim in [3, 4], 'Supports only 3D (DxHxW) or 4D (CxDxHxW) arrays'
+        self.array = array
+        self.shape = array.shape
+        self.ndim = array.ndim
+        self.dtype = array.dtype
+        self.chunks = array.chunks
+        self.num_threads = num_threads
+        self._executor = None
+        self._pid = None
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['_executor'] = None
+        state['_pid'] = None
+        return state
+
+    def _get_executor(self):
+        if self._pid != os.getpid():
+            # threads of the parent process do not survive the fork
+            self._executor = ThreadPoolExecutor(max_workers=self.num_threads)
+            self._pid = os.getpid()
+        return self._executor
+
+    def __getitem__(self, index):
+        if not isinstance(index, tuple):
+            index = (index,)
+        index = index + (slice(None),) * (self.ndim - len(index))
+        if self.num_threads <= 1 or not all(isinstance(s, slice) and s.step in (None, 1) for s in index):
+            return self.array[index]
+
+        # split the requested region along the chunk boundaries
+        bounds = [s.indices(size)[:2] for s, size in zip(index, self.shape)]
+        axis_blocks = []
+        for (start, stop), chunk in zip(bounds, self.chunks):
+            edges = [start] + list(range((start // chunk + 1) * chunk, stop, chunk)) + [stop]
+            axis_blocks.append([(a, b) for a, b in zip(edges[:-1], edges[1:]) if b > a])
+        blocks = list(itertools.product(*axis_blocks))
+        if len(blocks) <= 1:
+            return self.array[index]
+
+        out = np.empty(tuple(max(stop - start, 0) for start, stop in bounds), dtype=self.dtype)
+
+        def _read(block):
+            source = tuple(slice(a, b) for a, b in block)
+            target = tuple(slice(a - start, b - start) for (a, b), (start, _) in zip(block, bounds))
+            out[target] = self.array[source]
+
+        # consume the iterator in order to propagate the exceptions
+        list(self._get_executor().map(_read, blocks))
+        return out
+
+    def __len__(self):
+        return self.shape[0]
+
+
+class ZarrDataset(AbstractHDF5Dataset):
+    """
+    Implementation of the dataset backed by Zarr or N5 containers (`file_paths` ending with `.zarr` or `.n5`), which
+    reads the patches directly from the chunked arrays, i.e. the data is never loaded into memory as a whole.
+    The chunks of a patch are decompressed by `decompression_threads` threads (default: 4, set in the `loaders`
+    config). The containers are read directly from the storage in every DataLoader worker, so the dataset can be
+    used with any number of workers.
+    """
+
+    def __init__(self, file_path, phase, slice_builder_config, transformer_config, mirror_padding=(16, 32, 32),
+                 raw_internal_path='raw', label_internal_path='label', weight_internal_path=None, roi=None,
+                 stats_subsample=None, stats_cache=None, patch_index_cache=None, decompression_threads=4):
+        self.decompression_threads = decompression_threads
+        super().__init__(file_path=file_path,
+                         phase=phase,
+                         slice_builder_config=slice_builder_config,
+                         transformer_config=transformer_config,
+                         mirror_padding=mirror_padding,
+                         raw_internal_path=raw_internal_path,
+                         label_internal_path=label_internal_path,
+                         weight_internal_path=weight_internal_path,
+                         roi=roi,
+                         stats_subsample=stats_subsample,
+                         stats_cache=stats_cache,
+                         patch_index_cache=patch_index_cache)
+
+    @classmethod
+    def dataset_kwargs(cls, dataset_config):
+        return {'decompression_threads': dataset_config.get('decompression_threads', 4)}
+
+    @staticmethod
+    def create_h5_file(file_path, internal_paths):
+        return open_zarr(file_path, mode='r')
+
+    def fetch_datasets(self, input_file, internal_paths):
+        return [_ZarrArray(input_file[internal_path], self.decompression_threads) for internal_path in internal_paths]
+
+    @staticmethod
+    def traverse_h5_paths(file_paths):
+        assert isinstance(file_paths, list)
+        results = []
+        for file_path in file_paths:
+            if is_zarr_path(file_path):
+                results.append(file_path)
+            elif os.path.isdir(file_path):
+                # if file path is a directory take all Zarr/N5 containers in that directory
+                for ext in ZARR_EXTENSIONS:
+                    results.extend(sorted(glob.glob(os.path.join(file_path, '*' + ext))))
+            else:
+                results.append(file_path)
+        return results
@@ -0,0 +1,40 @@
+import argparse
+
+from pytorch3dunet.datasets.utils import _get_cls
+from pytorch3dunet.unet3d import utils
+from pytorch3dunet.unet3d.config import _load_config_yaml
+
+logger = utils.get_logger('UNet3DStats')
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(description='Precompute the input statistics of the UNet3D datasets')
+    parser.add_argument('--config', type=str, action='append', required=True,
+                        help='Path to the YAML train/prediction config; can be given multiple times')
+    parser.add_argument('--phases', type=str, nargs='+', default=['train', 'val', 'test'],
+                        help='Phases of the loaders config to process (missing phases are skipped)')
+    parser.add_argument('--cache-dir', type=str, default=None,
+                        help='Directory of the stats cache (overrides `stats_cache` from the loaders config)')
+    return parser.parse_args()
+
+
+def main():
+    args = _parse_args()
+    for config_path in args.config:
+        loaders_config = dict(_load_config_yaml(config_path)['loaders'])
+        if args.cache_dir is not None:
+            loaders_config['stats_cache'] = args.cache_dir
+        elif not loaders_config.get('stats_cache', None):
+            # keep the statistics next to the data
+            loaders_config['stats_cache'] = True
+
+        dataset_class = _get_cls(loaders_config.get('dataset', 'StandardHDF5Dataset'))
+        for phase in args.phases:
+            if phase not in loaders_config:
+                continue
+            logger.info(f'Precomputing {phase} stats from: {config_path}')
+            dataset_class.precompute_stats(loaders_config, phase)
+
+
+if __name__ == '__main__':
+    main()
@@ -6,17 +6,23 @@ import torch.nn as nn
 
 from pytorch3dunet.datasets.utils import get_test_loaders
 from pytorch3dunet.unet3d import utils
-from pytorch3dunet.unet3d.config import load_config
+from pytorch3dunet.unet3d.config import create_parser, load_config
 from pytorch3dunet.unet3d.model import get_model
 
 logger = utils.get_logger('UNet3DPredict')
 
 
-def _get_output_file(dataset, suffix='_predictions', output_dir=None):
-    input_dir, file_name = os.path.split(dataset.file_path)
+def _get_output_file(dataset, suffix='_predictions', output_dir=None, output_format='h5'):
+    assert output_format in ['h5', 'zarr', 'n5'], f'Unsupported output format: {output_format}'
+    roi = getattr(dataset, 'roi', None)
+    if roi is not None:
+        # predictions of different regions of interest go into separate files
+        suffix += '_roi_' + '_'.join(f'{start}-{stop}' for start, stop in zip(*roi))
+    # Zarr/N5 containers are directories
+    input_dir, file_name = os.path.split(os.path.normpath(dataset.file_path))
     if output_dir is None:
         output_dir = input_dir
-    output_file = os.path.join(output_dir, os.path.splitext(file_name)[0] + suffix + '.h5')
+    output_file = os.path.join(output_dir, os.path.splitext(file_name)[0] + suffix + '.' + output_format)
     return output_file
 
 
@@ -44,9 +50,21 @@ def _get_predictor(model, loader, output_file, config):
     return predictor_class(model, loader, output_file, config, **predictor_config)
 
 
+def _parse_args():
+    parser = create_parser(description='UNet3D prediction')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='Number of processes used for the prediction on CPU '
+                             '(overrides `workers` from the predictor config); each process accumulates its '
+                             'predictions in a shared memory buffer of up to `shard_buffer_mb` MB (default: 512)')
+    return parser.parse_args()
+
+
 def main():
+    args = _parse_args()
     # Load configuration
-    config = load_config()
+    config = load_config(args)
+    if args.workers is not None:
+        config.setdefault('predictor', {})['workers'] = args.workers
 
     # Create the model
     model = get_model(config)
@@ -72,7 +90,8 @@ def main():
     for test_loader in get_test_loaders(config):
         logger.info(f"Processing '{test_loader.dataset.file_path}'...")
 
-        output_file = _get_output_file(dataset=test_loader.dataset, output_dir=output_dir)
+        output_file = _get_output_file(dataset=test_loader.dataset, output_dir=output_dir,
+                                       output_format=config.get('predictor', {}).get('output_format', 'h5'))
 
         predictor = _get_predictor(model, test_loader, output_file, config)
         # run the model prediction on the entire dataset and save to the 'output_file' H5
@@ -0,0 +1,396 @@
+import argparse
+import io
+import itertools
+import json
+import os
+import queue
+import socketserver
+import threading
+import time
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import numpy as np
+import torch
+
+from pytorch3dunet.datasets.utils import get_test_loaders
+from pytorch3dunet.predict import _get_output_file, _get_predictor
+from pytorch3dunet.unet3d import utils
+from pytorch3dunet.unet3d.config import load_config
+from pytorch3dunet.unet3d.model import get_model
+from pytorch3dunet.unet3d.predictor import StandardPredictor
+
+logger = utils.get_logger('UNet3DServer')
+
+
+class _BatchScheduler:
+    """
+    Runs the forward passes of a single model on behalf of all concurrent requests. Patches submitted by the request
+    threads are put into a common queue and grouped (by shape) into batches of at most `max_batch_size` patches.
+    A batch is run as soon as it is full or `max_wait` seconds after its first patch arrived, whichever comes first.
+
+    The scheduler is callable like the model itself, so that it can be given to the predictors in place of the model:
+    the batch from the predictor is split into patches, scheduled and the predictions are stacked back together.
+
+    Args:
+        model (nn.Module): model used for prediction (already in the eval mode and on the right device)
+        max_batch_size (int): maximum number of patches in a single forward pass
+        max_wait (float): maximum time (in seconds) a patch waits for other patches to be batched with
+    """
+
+    def __init__(self, model, max_batch_size, max_wait=0.005):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.testing = True
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def eval(self):
+        # the model is put into the eval mode once, when it is loaded
+        pass
+
+    def __call__(self, batch):
+        futures = []
+        for patch in batch:
+            future = Future()
+            self._queue.put((patch, future))
+            futures.append(future)
+
+        predictions = [future.result() for future in futures]
+        if isinstance(predictions[0], (list, tuple)):
+            # multiple output heads
+            return [torch.stack(head) for head in zip(*predictions)]
+        return torch.stack(predictions)
+
+    def _next_batch(self):
+        items = [self._queue.get()]
+        deadline = time.time() + self.max_wait
+        while len(items) < self.max_batch_size:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                items.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return items
+
+    def _run(self):
+        while True:
+            items = self._next_batch()
+            # patches of different shapes cannot be stacked into a single batch
+            groups = {}
+            for patch, future in items:
+                groups.setdefault(tuple(patch.shape), []).append((patch, future))
+
+            for group in groups.values():
+                patches, futures = zip(*group)
+                try:
+                    with torch.no_grad():
+                        predictions = self.model(torch.stack(patches))
+                    for i, future in enumerate(futures):
+                        if isinstance(predictions, (list, tuple)):
+                            future.set_result([prediction[i] for prediction in predictions])
+                        else:
+                            future.set_result(predictions[i])
+                except Exception as e:
+                    logger.error('Forward pass failed', exc_info=True)
+                    for future in futures:
+                        future.set_exception(e)
+
+
+class PredictionService:
+    """
+    Keeps the models loaded and warmed up between the prediction requests.
+
+    Every model is given by a prediction config (the same as for `predict3dunet`) and is identified by the name of its
+    config file (without extension). Patches from concurrent requests to the same model are micro-batched
+    by a `_BatchScheduler` (batch size given by `loaders.batch_size`, waiting time by `max_wait_ms`
+    in the `server` section of the config).
+
+    The files predicted on request must be inside of the `data_root` directory, the outputs are saved there as well.
+
+    Args:
+        configs (dict): model name -> prediction config
+        data_root (str): directory of the files which can be predicted; predicting files is disabled if None
+    """
+
+    def __init__(self, configs, data_root=None):
+        assert len(configs) > 0, 'At least one model is required'
+        self.configs = configs
+        self.data_root = None if data_root is None else os.path.realpath(data_root)
+        self.schedulers = {}
+        for name, config in configs.items():
+            model = self._load_model(name, config)
+            server_config = config.get('server', {})
+            self.schedulers[name] = _BatchScheduler(model,
+                                                    max_batch_size=config['loaders'].get('batch_size', 1),
+                                                    max_wait=server_config.get('max_wait_ms', 5) / 1000)
+
+    @property
+    def model_names(self):
+        return list(self.configs.keys())
+
+    @staticmethod
+    def _load_model(name, config):
+        model = get_model(config)
+        model_path = config['model_path']
+        logger.info(f"Loading model '{name}' from {model_path}...")
+        utils.load_checkpoint(model_path, model)
+        model = model.to(config['device'])
+        model.eval()
+        model.testing = True
+
+        # run a single forward pass, so that the first request does not pay for the lazy initialization
+        patch_shape = tuple(config['loaders']['test']['slice_builder']['patch_shape'])
+        in_channels = config['model'].get('in_channels', 1)
+        logger.info(f"Warming up model '{name}' with patch shape: {patch_shape}")
+        with torch.no_grad():
+            model(torch.zeros((1, in_channels) + patch_shape, device=config['device']))
+        return model
+
+    def _predictor_config(self, name):
+        predictor_config = dict(self.configs[name].get('predictor', {}))
+        # the forward passes are already shared between the requests; do not fork per request
+        predictor_config['workers'] = 1
+        return predictor_config
+
+    def predict_array(self, name, volume):
+        """
+        Returns the predictions for an in-memory `volume` (see `StandardPredictor.predict_array`).
+        """
+        config = self.configs[name]
+        predictor = StandardPredictor(self.schedulers[name], None, None, config, **self._predictor_config(name))
+        return predictor.predict_array(volume)
+
+    def predict_array_slabs(self, name, volume):
+        """
+        Yields the predictions for an in-memory `volume` slab by slab along the z-axis as soon as they are final
+        (see `StandardPredictor.predict_array_slabs`).
+        """
+        config = self.configs[name]
+        predictor = StandardPredictor(self.schedulers[name], None, None, config, **self._predictor_config(name))
+        return predictor.predict_array_slabs(volume)
+
+    def resolve_path(self, path):
+        """
+        Returns the real path of a `path` given by a client (absolute or relative to the `data_root`), making sure that
+        it points inside of the `data_root`.
+        """
+        if self.data_root is None:
+            raise PermissionError('Predicting files is disabled, start the server with the --data-root option')
+        real_path = os.path.realpath(os.path.join(self.data_root, path))
+        if os.path.commonpath([real_path, self.data_root]) != self.data_root:
+            raise PermissionError(f'Path outside of the data root: {path}')
+        return real_path
+
+    def predict_file(self, name, file_path, output_dir=None):
+        """
+        Predicts the H5 file at `file_path` (inside of the `data_root`) with the test loaders and the predictor from
+        the config (i.e. the same way as `predict3dunet`) and returns the paths to the output files (one per region
+        of interest if the `rois` are given in the config).
+        """
+        file_path = self.resolve_path(file_path)
+        if output_dir is not None:
+            output_dir = self.resolve_path(output_dir)
+            os.makedirs(output_dir, exist_ok=True)
+
+        predictor_config = self._predictor_config(name)
+        config = dict(self.configs[name], predictor=predictor_config)
+        output_files = []
+        for loader in get_test_loaders(config, file_paths=[file_path]):
+            output_file = _get_output_file(dataset=loader.dataset, output_dir=output_dir,
+                                           output_format=predictor_config.get('output_format', 'h5'))
+            predictor = _get_predictor(self.schedulers[name], loader, output_file, config)
+            predictor.predict()
+            output_files.append(output_file)
+
+        if not output_files:
+            raise RuntimeError(f'Cannot load the test dataset from: {file_path}')
+        return output_files
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+    """
+    HTTP API of the `PredictionService`:
+        - GET /models: JSON list of the loaded models
+        - POST /predict/<model>: body is a volume in the NumPy `.npy` format, the response is the `.npy` encoded
+            prediction (CDHW), sent once the whole volume has been predicted
+        - POST /predict/<model>?stream=true: same as above, but the predictions are streamed back (with the chunked
+            transfer encoding) as a sequence of `.npy` encoded CDHW slabs along the z-axis, each sent as soon as
+            all of the patches overlapping with it have been predicted
+        - POST /predict/<model> with a JSON body {"path": <H5 file>, "output_dir": <optional>}: predicts the H5 file
+            and responds with {"output_paths": [<output H5 files>]}; both paths must be inside of the data root
+            of the service (responds with 403 otherwise)
+    The model name can be omitted if only one model is loaded.
+    """
+
+    # required by the chunked transfer encoding of the streamed predictions
+    protocol_version = 'HTTP/1.1'
+
+    # number of bytes written to the socket at a time when sending the predictions back
+    block_size = 64 * 1024 ** 2
+
+    def do_GET(self):
+        if urlparse(self.path).path.rstrip('/') == '/models':
+            self._send_json(200, {'models': self.server.service.model_names})
+        else:
+            self._send_json(404, {'error': f'Unknown resource: {self.path}'})
+
+    def do_POST(self):
+        # read the whole body first, so that the connection can be reused after an error response
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        url = urlparse(self.path)
+        parts = url.path.strip('/').split('/')
+        service = self.server.service
+        if parts[0] != 'predict' or len(parts) > 2:
+            self._send_json(404, {'error': f'Unknown resource: {self.path}'})
+            return
+
+        if len(parts) == 2:
+            name = parts[1]
+        elif len(service.model_names) == 1:
+            name = service.model_names[0]
+        else:
+            self._send_json(400, {'error': f'Model name required, one of: {service.model_names}'})
+            return
+
+        if name not in service.configs:
+            self._send_json(404, {'error': f'Unknown model: {name}'})
+            return
+
+        stream = parse_qs(url.query).get('stream', ['false'])[0].lower() in ['1', 'true']
+        try:
+            if self.headers.get('Content-Type', '').startswith('application/json'):
+                request = json.loads(body)
+                output_paths = service.predict_file(name, request['path'], request.get('output_dir'))
+                self._send_json(200, {'output_paths': output_paths})
+            elif stream:
+                volume = np.load(io.BytesIO(body), allow_pickle=False)
+                slabs = service.predict_array_slabs(name, volume)
+                # errors before the first slab is ready are still reported with a proper status code
+                first = next(slabs)
+                self._stream_arrays(itertools.chain([first], slabs))
+            else:
+                volume = np.load(io.BytesIO(body), allow_pickle=False)
+                self._send_array(service.predict_array(name, volume))
+        except PermissionError as e:
+            self._send_json(403, {'error': str(e)})
+        except Exception as e:
+            logger.error(f'Prediction request failed: {self.path}', exc_info=True)
+            self._send_json(500, {'error': str(e)})
+
+    def _send_json(self, status, content):
+        body = json.dumps(content).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_array(self, array):
+        header, data = self._encode_array(array)
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(len(header) + len(data)))
+        self.end_headers()
+        self.wfile.write(header)
+        for start in range(0, len(data), self.block_size):
+            self.wfile.write(data[start:start + self.block_size])
+
+    def _stream_arrays(self, slabs):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-npy-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        try:
+            for _, _, slab in slabs:
+                header, data = self._encode_array(slab)
+                self._write_chunk(header)
+                for start in range(0, len(data), self.block_size):
+                    self._write_chunk(data[start:start + self.block_size])
+        except Exception:
+            # the status has already been sent, the client sees the incomplete response
+            logger.error(f'Streaming the predictions failed: {self.path}', exc_info=True)
+            self.close_connection = True
+            return
+        self.wfile.write(b'0\r\n\r\n')
+
+    def _write_chunk(self, data):
+        if len(data) == 0:
+            # an empty chunk terminates the response
+            return
+        self.wfile.write(f'{len(data):X}\r\n'.encode())
+        self.wfile.write(data)
+        self.wfile.write(b'\r\n')
+
+    @staticmethod
+    def _encode_array(array):
+        # `.npy` header and the raw bytes of the array
+        array = np.ascontiguousarray(array)
+        header = io.BytesIO()
+        np.lib.format.write_array_header_1_0(header, np.lib.format.header_data_from_array_1_0(array))
+        return header.getvalue(), memoryview(array.reshape(-1)).cast('B')
+
+    def address_string(self):
+        # client address is empty for the Unix sockets
+        return str(self.client_address[0]) if self.client_address else 'local'
+
+    def log_message(self, format, *args):
+        logger.info(f'{self.address_string()} - {format % args}')
+
+
+class _ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        request, _ = super().get_request()
+        return request, ('local', 0)
+
+
+def create_server(service, host='127.0.0.1', port=8000, socket_path=None):
+    """
+    Creates the HTTP server of the `service` listening on the `host`:`port` or on the Unix socket at `socket_path`.
+    Each request is handled in a separate thread.
+    """
+    if socket_path is not None:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = _ThreadingUnixHTTPServer(socket_path, _RequestHandler)
+    else:
+        server = ThreadingHTTPServer((host, port), _RequestHandler)
+    server.service = service
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description='UNet3D prediction server')
+    parser.add_argument('--config', type=str, action='append', required=True,
+                        help='Path to the YAML prediction config; can be given multiple times to serve multiple models')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='Host to listen on')
+    parser.add_argument('--port', type=int, default=8000, help='Port to listen on')
+    parser.add_argument('--socket', type=str, default=None, help='Path to the Unix socket to listen on instead of TCP')
+    parser.add_argument('--data-root', type=str, default=None,
+                        help='Directory of the H5 files which can be predicted on request (disabled if not given)')
+    args = parser.parse_args()
+
+    configs = {}
+    for config_path in args.config:
+        name = os.path.splitext(os.path.basename(config_path))[0]
+        configs[name] = load_config(argparse.Namespace(config=config_path))
+
+    service = PredictionService(configs, data_root=args.data_root)
+    server = create_server(service, host=args.host, port=args.port, socket_path=args.socket)
+    logger.info(f'Serving models {list(configs.keys())} on {args.socket or f"{args.host}:{args.port}"}')
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -8,10 +8,15 @@ from pytorch3dunet.unet3d import utils
 logger = utils.get_logger('ConfigLoader')
 
 
-def load_config():
-    parser = argparse.ArgumentParser(description='UNet3D')
+def create_parser(description='UNet3D'):
+    parser = argparse.ArgumentParser(description=description)
     parser.add_argument('--config', type=str, help='Path to the YAML config file', required=True)
-    args = parser.parse_args()
+    return parser
+
+
+def load_config(args=None):
+    if args is None:
+        args = create_parser().parse_args()
     config = _load_config_yaml(args.config)
     # Get a device to train on
     device_str = config.get('device', None)
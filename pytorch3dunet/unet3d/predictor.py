@@ -1,14 +1,28 @@
+import collections
+import hashlib
+import itertools
+import json
+import multiprocessing.connection
+import os
+import queue
+import threading
 import time
 
 import h5py
 import hdbscan
 import numpy as np
 import torch
+from skimage.filters import threshold_otsu
 from sklearn.cluster import MeanShift
-
-from pytorch3dunet.datasets.utils import SliceBuilder
+from torch.utils.data import DataLoader, Subset
+
+from pytorch3dunet.datasets.array import ArrayDataset
+from pytorch3dunet.datasets.utils import prediction_collate
+from pytorch3dunet.datasets.zarr import ZarrFile, is_zarr_path
+from pytorch3dunet.unet3d.utils import gaussian_importance_map
+from pytorch3dunet.unet3d.utils import gaussian_importance_profiles
+from pytorch3dunet.unet3d.utils import get_halo_slices
 from pytorch3dunet.unet3d.utils import get_logger
-from pytorch3dunet.unet3d.utils import remove_halo
 
 logger = get_logger('UNet3DPredictor')
 
@@ -43,14 +57,29 @@ class _AbstractPredictor:
 
 class StandardPredictor(_AbstractPredictor):
     """
-    Applies the model on the given dataset and saves the result in the `output_file` in the H5 format.
-    Predictions from the network are kept in memory. If the results from the network don't fit in into RAM
-    use `LazyPredictor` instead.
+    Applies the model on the given dataset and saves the result in the `output_file` in the H5 format (or Zarr/N5 if
+    the `output_file` ends with `.zarr`/`.n5`). Predictions from the network are kept in memory. If the results from
+    the network don't fit in into RAM use `LazyPredictor` instead.
 
     The output dataset names inside the H5 is given by `des_dataset_name` config argument. If the argument is
     not present in the config 'predictions{n}' is used as a default dataset name, where `n` denotes the number
     of the output head from the network.
 
+    Overlapping patches are blended according to the `blending` predictor argument:
+        - 'average' (default): the `patch_halo` is removed from each patch and the remaining predictions are averaged
+        - 'gaussian': the whole patch is kept and weighted by a Gaussian importance map (see `gaussian_importance_map`),
+            which allows for a smaller overlap between the patches for the same prediction quality
+
+    If `tta` is given ('flip', 'rot90' or 'all', see `_tta_variants`) the flipped/rotated variants of every batch are
+    predicted together, transformed back and averaged before stitching. Note that the effective batch size given
+    to the network is multiplied by the number of variants.
+
+    If `skip_empty` is given, the patches without any foreground in a coarse foreground mask of the raw data are not
+    predicted (see `_skip_empty_patches`).
+
+    If `workers` > 1 is given, the patches are split between `workers` processes running the prediction on the CPU
+    (see `_predict_patches_parallel`), which takes up to `workers * shard_buffer_mb` MB of additional memory.
+
     Args:
         model (Unet3D): trained 3D UNet model used for prediction
         data_loader (torch.utils.data.DataLoader): input data loader
@@ -62,6 +91,133 @@ class StandardPredictor(_AbstractPredictor):
         super().__init__(model, loader, output_file, config, **kwargs)
 
     def predict(self):
+        output_heads = self.config['model'].get('output_heads', 1)
+
+        logger.info(f'Running prediction on {len(self.loader)} batches...')
+
+        # dimensionality of the the output predictions
+        prediction_maps_shape = self._prediction_maps_shape(self.loader.dataset)
+        logger.info(f'The shape of the output prediction maps (CDHW): {prediction_maps_shape}')
+
+        # pre-compute the destination and source slices of the patches together with the normalization weights
+        stitcher = self._create_stitcher(self.loader.dataset)
+
+        # create destination H5 file
+        h5_output_file = self._open_output_file()
+        roi = getattr(self.loader.dataset, 'roi', None)
+        if roi is not None:
+            # position of the predictions inside the input volume
+            h5_output_file.attrs['roi_start'], h5_output_file.attrs['roi_stop'] = roi
+        # allocate prediction arrays
+        logger.info('Allocating prediction arrays...')
+        prediction_maps = self._allocate_prediction_maps(prediction_maps_shape, output_heads, h5_output_file, stitcher)
+
+        # Run predictions on the entire input dataset
+        self._run_prediction(self.loader, prediction_maps, stitcher)
+
+        # save results to
+        self._save_results(prediction_maps, stitcher, output_heads, h5_output_file, self.loader.dataset)
+        # close the output H5 file
+        h5_output_file.close()
+
+    def _open_output_file(self, mode='w'):
+        if is_zarr_path(self.output_file):
+            # Zarr/N5 output container (`output_format` of the predictor config)
+            return ZarrFile(self.output_file, mode)
+        return h5py.File(self.output_file, mode)
+
+    def predict_array(self, volume, stats=None):
+        """
+        Runs the sliding window prediction on an in-memory `volume` and returns the stitched and normalized predictions
+        without any file I/O. Patching and data transformations are given by the `slice_builder` and `transformer`
+        sections of the `loaders.test` config, the batch size and mirror padding by the `loaders` config.
+
+        Args:
+            volume (ndarray or torch.Tensor): 3D (DHW) or 4D (CDHW) input volume
+            stats (tuple): optional (min, max, mean, std) of the input used for the normalization of the patches;
+                computed from the `volume` if not given
+
+        Returns:
+            4D (CDHW) ndarray with the predictions or a list of those if the network has multiple output heads
+        """
+        loader, stitcher, prediction_maps = self._array_prediction(volume, stats)
+
+        self._run_prediction(loader, prediction_maps, stitcher)
+
+        prediction_maps = [stitcher.normalize(prediction_map) for prediction_map in prediction_maps]
+        if len(prediction_maps) == 1:
+            return prediction_maps[0]
+        return prediction_maps
+
+    def predict_array_slabs(self, volume, stats=None):
+        """
+        Same as `predict_array`, but yields the stitched and normalized predictions slab by slab along the z-axis as
+        soon as all of the patches overlapping with the slab have been predicted, e.g. in order to stream them back
+        to a client while the rest of the volume is still being predicted. The prediction runs in a background thread.
+
+        Args:
+            volume (ndarray or torch.Tensor): 3D (DHW) or 4D (CDHW) input volume
+            stats (tuple): optional (min, max, mean, std) of the input used for the normalization of the patches
+
+        Yields:
+            (z_start, z_stop, slab): z-range of the slab in the output and the 4D (CDHW) slab of the predictions
+            (or a list of those if the network has multiple output heads)
+        """
+        assert self.predictor_config.get('workers', 1) == 1, 'Predicting slabs is not supported with multiple workers'
+        loader, stitcher, prediction_maps = self._array_prediction(volume, stats)
+        depth = prediction_maps[0].shape[1]
+        if not stitcher.precomputed:
+            # the sum of weights is known only at the end of the prediction
+            prediction_maps = self.predict_array(volume, stats)
+            yield 0, depth, prediction_maps
+            return
+
+        final_z = queue.Queue()
+        # the last output head is stitched last, so it tells which part of all of the heads is final
+        tracked_maps = prediction_maps[:-1] + [
+            _ProgressMap(prediction_maps[-1], stitcher.destination_slices(), final_z.put)
+        ]
+
+        def _predict():
+            try:
+                self._run_prediction(loader, tracked_maps, stitcher)
+                final_z.put(depth)
+            except BaseException as e:
+                final_z.put(e)
+
+        threading.Thread(target=_predict, daemon=True).start()
+
+        z_start = 0
+        while z_start < depth:
+            z_stop = final_z.get()
+            if isinstance(z_stop, BaseException):
+                raise z_stop
+            if z_stop <= z_start:
+                continue
+            index = (slice(z_start, z_stop), slice(None), slice(None))
+            slabs = [stitcher.normalize(prediction_map[(slice(None),) + index], index)
+                     for prediction_map in prediction_maps]
+            yield z_start, z_stop, slabs[0] if len(slabs) == 1 else slabs
+            z_start = z_stop
+
+    def _array_prediction(self, volume, stats):
+        # loader, stitcher and the (empty) prediction maps of an in-memory volume
+        loaders_config = self.config['loaders']
+        test_config = loaders_config['test']
+        dataset = ArrayDataset(volume,
+                               slice_builder_config=test_config['slice_builder'],
+                               transformer_config=test_config['transformer'],
+                               mirror_padding=loaders_config.get('mirror_padding', None),
+                               stats=stats)
+        loader = DataLoader(dataset, batch_size=loaders_config.get('batch_size', 1), collate_fn=prediction_collate)
+
+        output_heads = self.config['model'].get('output_heads', 1)
+        prediction_maps_shape = self._prediction_maps_shape(dataset)
+        stitcher = self._create_stitcher(dataset)
+        prediction_maps = [np.zeros(prediction_maps_shape, dtype='float32') for _ in range(output_heads)]
+        return loader, stitcher, prediction_maps
+
+    def _prediction_maps_shape(self, dataset):
         out_channels = self.config['model'].get('out_channels')
         if out_channels is None:
             out_channels = self.config['model']['dt_out_channels']
@@ -69,111 +225,274 @@ class StandardPredictor(_AbstractPredictor):
         prediction_channel = self.config.get('prediction_channel', None)
         if prediction_channel is not None:
             logger.info(f"Using only channel '{prediction_channel}' from the network output")
+            # single channel prediction map
+            out_channels = 1
 
-        device = self.config['device']
-        output_heads = self.config['model'].get('output_heads', 1)
+        return (out_channels,) + self._output_shape(dataset)
 
-        logger.info(f'Running prediction on {len(self.loader)} batches...')
+    def _output_shape(self, dataset):
+        # spatial shape of the predictions, i.e. the shape of the input volume without the mirror padding
+        mirror_padding = getattr(dataset, 'mirror_padding', None)
+        if mirror_padding is None:
+            return self._volume_shape(dataset)
+        return tuple(size - 2 * pad for size, pad in zip(self._volume_shape(dataset), mirror_padding))
 
-        # dimensionality of the the output predictions
-        volume_shape = self._volume_shape(self.loader.dataset)
-        if prediction_channel is None:
-            prediction_maps_shape = (out_channels,) + volume_shape
+    def _create_stitcher(self, dataset):
+        blending = self.predictor_config.get('blending', 'average')
+        assert blending in ['average', 'gaussian'], f'Unsupported blending mode: {blending}'
+        logger.info(f'Using {blending} blending of the overlapping patches')
+
+        patch_halo = self.predictor_config.get('patch_halo', (4, 8, 8))
+        if blending == 'average':
+            self._validate_halo(patch_halo, self.config['loaders']['test']['slice_builder'])
+            logger.info(f'Using patch_halo: {patch_halo}')
+
+        return _PatchStitcher(self._output_shape(dataset), blending, patch_halo,
+                              sigma_scale=self.predictor_config.get('gaussian_sigma_scale', 0.125),
+                              slices=getattr(dataset, 'raw_slices', None),
+                              padding=getattr(dataset, 'mirror_padding', None))
+
+    def _run_prediction(self, loader, prediction_maps, stitcher):
+        skip_empty = self.predictor_config.get('skip_empty', None)
+        if skip_empty:
+            loader = self._skip_empty_patches(loader, prediction_maps, stitcher,
+                                              {} if skip_empty is True else skip_empty)
+
+        workers = self.predictor_config.get('workers', 1)
+        if workers > 1:
+            self._predict_patches_parallel(loader, prediction_maps, stitcher, workers)
         else:
-            # single channel prediction map
-            prediction_maps_shape = (1,) + volume_shape
+            self._predict_patches(loader, prediction_maps, stitcher)
 
-        logger.info(f'The shape of the output prediction maps (CDHW): {prediction_maps_shape}')
+    def _predict_patches(self, loader, prediction_maps, stitcher):
+        """
+        Runs the model on all patches from the `loader` and accumulates the predictions into the `prediction_maps`.
 
-        patch_halo = self.predictor_config.get('patch_halo', (4, 8, 8))
-        self._validate_halo(patch_halo, self.config['loaders']['test']['slice_builder'])
-        logger.info(f'Using patch_halo: {patch_halo}')
+        If `pipeline: true` is given in the predictor config the forward pass, device to host copy and stitching
+        (i.e. writing to the output H5 in case of the `LazyPredictor`) run concurrently in separate threads connected
+        by bounded queues of size `queue_size`.
+        """
+        device = self.config['device']
+        output_heads = self.config['model'].get('output_heads', 1)
+        prediction_channel = self.config.get('prediction_channel', None)
 
-        # create destination H5 file
-        h5_output_file = h5py.File(self.output_file, 'w')
-        # allocate prediction and normalization arrays
-        logger.info('Allocating prediction and normalization arrays...')
-        prediction_maps, normalization_masks = self._allocate_prediction_maps(prediction_maps_shape,
-                                                                              output_heads, h5_output_file)
+        def _to_numpy(item):
+            predictions, indices = item
+            return [prediction.cpu().numpy() for prediction in predictions], indices
+
+        def _stitch(item):
+            predictions, indices = item
+            # accumulate the whole batch into the output arrays of every output head
+            for prediction, prediction_map in zip(predictions, prediction_maps):
+                stitcher.stitch(prediction, indices, prediction_map)
+
+        stages = [_to_numpy, _stitch]
 
         # Sets the module in evaluation mode explicitly (necessary for batchnorm/dropout layers if present)
         self.model.eval()
         # Set the `testing=true` flag otherwise the final Softmax/Sigmoid won't be applied!
         self.model.testing = True
-        # Run predictions on the entire input dataset
         with torch.no_grad():
-            for batch, indices in self.loader:
-                # send batch to device
-                batch = batch.to(device)
+            if self.predictor_config.get('pipeline', False):
+                queue_size = self.predictor_config.get('queue_size', 4)
+                logger.info(f'Running the prediction pipeline with queue size: {queue_size}')
+                with _Pipeline(stages, queue_size) as pipeline:
+                    for batch, indices in loader:
+                        pipeline.put((self._forward(batch, device, output_heads, prediction_channel), indices))
+            else:
+                for batch, indices in loader:
+                    item = (self._forward(batch, device, output_heads, prediction_channel), indices)
+                    for stage in stages:
+                        item = stage(item)
 
-                # forward pass
-                predictions = self.model(batch)
+    def _skip_empty_patches(self, loader, prediction_maps, stitcher, skip_empty_config):
+        """
+        Finds the patches without any foreground in a coarse foreground mask of the raw data, stitches a constant
+        `background` prediction (default: 0, or a list with a value per output channel) in their place and returns
+        the loader over the remaining patches.
 
-                # wrap predictions into a list if there is only one output head from the network
-                if output_heads == 1:
-                    predictions = [predictions]
+        The foreground mask is computed on the raw data downsampled by `downsample` (default: 4) along each axis and
+        thresholded with the given `threshold` or, if not given, with the Otsu's threshold of the downsampled data.
+        """
+        dataset = loader.dataset
+        raw_slices = getattr(dataset, 'raw_slices', None)
+        assert raw_slices is not None, 'Skipping empty patches requires the patch positions to be known up front'
 
-                # for each output head
-                for prediction, prediction_map, normalization_mask in zip(predictions, prediction_maps,
-                                                                          normalization_masks):
+        factor = skip_empty_config.get('downsample', 4)
+        raw = dataset.raws[0]
+        if raw.ndim == 4:
+            small = np.max([raw[c, ::factor, ::factor, ::factor] for c in range(raw.shape[0])], axis=0)
+        else:
+            small = raw[::factor, ::factor, ::factor]
+
+        threshold = skip_empty_config.get('threshold', None)
+        if threshold is None:
+            threshold = threshold_otsu(small)
+        mask = small > threshold
+        logger.info(f'Foreground threshold: {threshold}, foreground fraction: {mask.mean():.3f}')
+
+        foreground, background = [], []
+        for i, index in enumerate(raw_slices):
+            # slices of the patch in the downsampled mask (rounded outwards)
+            mask_index = tuple(slice(s.start // factor, -(-s.stop // factor)) for s in index[-3:])
+            if mask[mask_index].any():
+                foreground.append(i)
+            else:
+                background.append(i)
 
-                    # convert to numpy array
-                    prediction = prediction.cpu().numpy()
+        logger.info(f'Skipping {len(background)} out of {len(raw_slices)} patches without foreground')
+        if background:
+            self._stitch_background([raw_slices[i] for i in background], prediction_maps, stitcher,
+                                    skip_empty_config.get('background', 0))
 
-                    # for each batch sample
-                    for pred, index in zip(prediction, indices):
-                        # save patch index: (C,D,H,W)
-                        if prediction_channel is None:
-                            channel_slice = slice(0, out_channels)
-                        else:
-                            channel_slice = slice(0, 1)
-                        index = (channel_slice,) + index
-
-                        if prediction_channel is not None:
-                            # use only the 'prediction_channel'
-                            logger.info(f"Using channel '{prediction_channel}'...")
-                            pred = np.expand_dims(pred[prediction_channel], axis=0)
-
-                        logger.info(f'Saving predictions for slice:{index}...')
-
-                        # remove halo in order to avoid block artifacts in the output probability maps
-                        u_prediction, u_index = remove_halo(pred, index, volume_shape, patch_halo)
-                        # accumulate probabilities into the output prediction array
-                        prediction_map[u_index] += u_prediction
-                        # count voxel visits for normalization
-                        normalization_mask[u_index] += 1
+        return DataLoader(_PatchSubset(dataset, foreground), batch_size=loader.batch_size,
+                          num_workers=loader.num_workers, collate_fn=loader.collate_fn)
 
-        # save results to
-        self._save_results(prediction_maps, normalization_masks, output_heads, h5_output_file, self.loader.dataset)
-        # close the output H5 file
-        h5_output_file.close()
+    @staticmethod
+    def _stitch_background(indices, prediction_maps, stitcher, background):
+        for prediction_map in prediction_maps:
+            channels = prediction_map.shape[0]
+            values = np.broadcast_to(np.asarray(background, dtype='float32'), (channels,))
+            if not np.any(values) and isinstance(prediction_map, np.ndarray):
+                # zero predictions do not change the in-memory prediction map
+                continue
 
-    def _allocate_prediction_maps(self, output_shape, output_heads, output_file):
-        # initialize the output prediction arrays
-        prediction_maps = [np.zeros(output_shape, dtype='float32') for _ in range(output_heads)]
-        # initialize normalization mask in order to average out probabilities of overlapping patches
-        normalization_masks = [np.zeros(output_shape, dtype='uint8') for _ in range(output_heads)]
-        return prediction_maps, normalization_masks
-
-    def _save_results(self, prediction_maps, normalization_masks, output_heads, output_file, dataset):
-        def _slice_from_pad(pad):
-            if pad == 0:
-                return slice(None, None)
-            else:
-                return slice(pad, -pad)
+            patches = {}
+            for index in indices:
+                patch_shape = tuple(s.stop - s.start for s in index[-3:])
+                if patch_shape not in patches:
+                    patches[patch_shape] = np.broadcast_to(values.reshape((1, channels, 1, 1, 1)),
+                                                           (1, channels) + patch_shape)
+                stitcher.stitch(patches[patch_shape], [index], prediction_map)
 
-        # save probability maps
-        prediction_datasets = self._get_output_dataset_names(output_heads, prefix='predictions')
-        for prediction_map, normalization_mask, prediction_dataset in zip(prediction_maps, normalization_masks,
-                                                                          prediction_datasets):
-            prediction_map = prediction_map / normalization_mask
+    def _predict_patches_parallel(self, loader, prediction_maps, stitcher, workers):
+        """
+        Splits the patches of the dataset into contiguous (in the z-y-x order of the slice builder) shards and predicts
+        each shard in a separate (forked) process with its own copy of the model and `threads_per_worker` intra-op
+        threads (default: number of torch threads divided by the number of workers). At most `workers` shards are
+        predicted at the same time.
+
+        Every worker accumulates its predictions into a shared memory buffer covering the z-range of its patches
+        (and the whole YX extent of the output). The number of shards is chosen such that each buffer takes at most
+        `shard_buffer_mb` MB (default: 512, but at least the z-extent of a single row of patches), so the additional
+        memory is bounded by `workers` buffers. The buffer of a shard is added to the `prediction_maps` (i.e. written
+        to the output file by the `LazyPredictor`) and released as soon as its worker is done.
+        """
+        assert self.config['device'].type == 'cpu', 'Multi-process prediction is supported only on the CPU'
+        dataset = loader.dataset
+        raw_slices = getattr(dataset, 'raw_slices', None)
+        assert raw_slices is not None and stitcher.precomputed, \
+            'Multi-process prediction requires the patch positions to be known up front'
+
+        threads = self.predictor_config.get('threads_per_worker', max(1, torch.get_num_threads() // workers))
+        shard_buffer_size = max(1, int(self.predictor_config.get('shard_buffer_mb', 512) * 1024 ** 2))
+        output_size = sum(int(np.prod(prediction_map.shape)) * 4 for prediction_map in prediction_maps)
+        num_shards = min(len(dataset), max(workers, -(-output_size // shard_buffer_size)))
+        logger.info(f'Running prediction of {num_shards} shards in {workers} processes with {threads} threads each')
+
+        shards = []
+        for indices in np.array_split(np.arange(len(dataset)), num_shards):
+            # patches lying entirely in the mirror padding have empty destination slices
+            dst_slices = [index for index in stitcher.destination_slices([raw_slices[i] for i in indices])
+                          if index[0].stop > index[0].start]
+            if not dst_slices:
+                continue
+            z_start = min(index[0].start for index in dst_slices)
+            z_stop = max(index[0].stop for index in dst_slices)
+            shards.append((indices.tolist(), slice(z_start, z_stop)))
+
+        for prediction_map in prediction_maps:
+            if isinstance(prediction_map, _ChunkAccumulator):
+                # each shard buffer is accumulated as a single (big) patch; all of the shards are expected up front,
+                # so that the chunks are written as soon as all of the shards covering them are merged
+                yx_slices = tuple(slice(0, size) for size in prediction_map.shape[2:])
+                prediction_map.expect([(z_range,) + yx_slices for _, z_range in shards])
+
+        # fork in order to share the model and the dataset with the workers without pickling
+        context = torch.multiprocessing.get_context('fork')
+        pending = collections.deque(shards)
+        running = {}
+        failed = 0
+        while pending or running:
+            while pending and len(running) < workers:
+                indices, z_range = pending.popleft()
+                buffers = [
+                    torch.zeros((prediction_map.shape[0], z_range.stop - z_range.start) +
+                                tuple(prediction_map.shape[2:])).share_memory_()
+                    for prediction_map in prediction_maps
+                ]
+                process = context.Process(target=self._predict_shard,
+                                          args=(loader, indices, z_range.start, buffers, stitcher, threads))
+                process.start()
+                running[process.sentinel] = (process, z_range, buffers)
+
+            for sentinel in multiprocessing.connection.wait(list(running)):
+                process, z_range, buffers = running.pop(sentinel)
+                process.join()
+                if process.exitcode != 0:
+                    failed += 1
+                    continue
+                # merge the predictions of the shard and release its shared memory
+                for buffer, prediction_map in zip(buffers, prediction_maps):
+                    buffer = buffer.numpy()
+                    index = (slice(0, buffer.shape[0]), z_range) + tuple(slice(0, size) for size in buffer.shape[2:])
+                    if isinstance(prediction_map, _ChunkAccumulator):
+                        prediction_map.add(index, buffer)
+                    else:
+                        prediction_map[index] += buffer
+                buffers.clear()
+
+        if failed:
+            raise RuntimeError(f'{failed} out of {len(shards)} prediction shards failed')
+
+    def _predict_shard(self, loader, indices, z_start, buffers, stitcher, threads):
+        torch.set_num_threads(threads)
+        loader = DataLoader(Subset(loader.dataset, indices), batch_size=loader.batch_size,
+                            collate_fn=loader.collate_fn)
+        prediction_maps = [_ShardBuffer(buffer.numpy(), z_start) for buffer in buffers]
+        self._predict_patches(loader, prediction_maps, stitcher)
+
+    def _forward(self, batch, device, output_heads, prediction_channel):
+        # send batch to device
+        batch = batch.to(device)
+
+        tta = self.predictor_config.get('tta', None)
+        variants = _tta_variants(tta, batch.shape[-3:]) if tta else [_IDENTITY]
+        if len(variants) > 1:
+            # run all test-time augmentation variants of the batch through the model as a single (bigger) batch
+            batch = torch.cat([_augment(batch, variant) for variant in variants])
+
+        # forward pass
+        predictions = self.model(batch)
+
+        # wrap predictions into a list if there is only one output head from the network
+        if output_heads == 1:
+            predictions = [predictions]
+
+        if len(variants) > 1:
+            # undo the augmentations and average the predictions of the variants
+            predictions = [
+                torch.stack([_deaugment(variant_prediction, variant)
+                             for variant_prediction, variant in zip(prediction.chunk(len(variants)), variants)]).mean(0)
+                for prediction in predictions
+            ]
+
+        if prediction_channel is not None:
+            # use only the 'prediction_channel'
+            predictions = [prediction[:, prediction_channel:prediction_channel + 1] for prediction in predictions]
 
-            if dataset.mirror_padding is not None:
-                z_s, y_s, x_s = [_slice_from_pad(p) for p in dataset.mirror_padding]
+        return predictions
 
-                logger.info(f'Dataset loaded with mirror padding: {dataset.mirror_padding}. Cropping before saving...')
+    def _allocate_prediction_maps(self, output_shape, output_heads, output_file, stitcher):
+        # initialize the output prediction arrays
+        return [np.zeros(output_shape, dtype='float32') for _ in range(output_heads)]
 
-                prediction_map = prediction_map[:, z_s, y_s, x_s]
+    def _save_results(self, prediction_maps, stitcher, output_heads, output_file, dataset):
+        # save probability maps
+        prediction_datasets = self._get_output_dataset_names(output_heads, prefix='predictions')
+        for prediction_map, prediction_dataset in zip(prediction_maps, prediction_datasets):
+            # average out probabilities of overlapping patches (in-place in order to avoid a copy of the whole volume)
+            stitcher.normalize(prediction_map)
 
             logger.info(f'Saving predictions to: {self.output_file}/{prediction_dataset}...')
             output_file.create_dataset(prediction_dataset, data=prediction_map, compression="gzip")
@@ -189,12 +508,670 @@ class StandardPredictor(_AbstractPredictor):
             patch_overlap - patch_halo >= 0), f"Not enough patch overlap for stride: {stride} and halo: {patch_halo}"
 
 
+# test-time augmentation variant: (flipped spatial axes of the DHW patch, number of rot90 in the HW plane)
+_IDENTITY = ((), 0)
+
+
+def _tta_variants(mode, patch_shape):
+    """
+    Returns the list of test-time augmentation variants for a given `mode`:
+        - 'flip': all combinations of flips along the D, H and W axes (as in `RandomFlip`), 8 variants
+        - 'rot90': rotations by k * 90 degrees in the HW plane (as in `RandomRotate90`), 4 variants
+        - 'all' (or True): flips along the D axis combined with all rotations and reflections in the HW plane,
+            i.e. the 16 distinct variants which can be obtained by combining the above
+    Rotations by 90 and 270 degrees are skipped if the patch is not square in the HW plane.
+    """
+    if mode is True:
+        mode = 'all'
+    assert mode in ['flip', 'rot90', 'all'], f'Unsupported test-time augmentation: {mode}'
+
+    if mode == 'flip':
+        variants = [(tuple(axis for axis, flip in zip((0, 1, 2), flips) if flip), 0)
+                    for flips in itertools.product([False, True], repeat=3)]
+    elif mode == 'rot90':
+        variants = [((), k) for k in range(4)]
+    else:
+        variants = [(tuple(axis for axis, flip in zip((0, 1), flips) if flip), k)
+                    for flips in itertools.product([False, True], repeat=2) for k in range(4)]
+
+    if patch_shape[-1] != patch_shape[-2]:
+        variants = [(axes, k) for axes, k in variants if k % 2 == 0]
+    return variants
+
+
+def _augment(batch, variant):
+    # batch is NCDHW, variant axes are given in DHW
+    axes, k = variant
+    if axes:
+        batch = torch.flip(batch, [axis + 2 for axis in axes])
+    if k:
+        batch = torch.rot90(batch, k, (3, 4))
+    return batch
+
+
+def _deaugment(batch, variant):
+    axes, k = variant
+    if k:
+        batch = torch.rot90(batch, -k, (3, 4))
+    if axes:
+        batch = torch.flip(batch, [axis + 2 for axis in axes])
+    return batch
+
+
+class _Pipeline:
+    """
+    Runs consecutive processing stages in separate threads connected by bounded queues. Items are fed to the first
+    stage with `put`, the result of each stage is passed on to the next one and the result of the last stage
+    is discarded. An exception raised in any of the stages stops the pipeline and is re-raised in the producer thread.
+
+    Args:
+        stages (list): list of callables, each taking the result of the previous stage
+        queue_size (int): maximum number of items waiting in front of each stage
+    """
+
+    _END = object()
+
+    def __init__(self, stages, queue_size=4):
+        assert queue_size > 0, 'queue_size must be positive'
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in stages]
+        self.threads = [threading.Thread(target=self._run_stage, args=(i, stage), name=f'PipelineStage{i}',
+                                         daemon=True)
+                        for i, stage in enumerate(stages)]
+        self._stopped = threading.Event()
+        self._error = None
+
+    def __enter__(self):
+        for thread in self.threads:
+            thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None and not self._stopped.is_set():
+            try:
+                self._put(self.queues[0], self._END)
+            except RuntimeError:
+                # one of the stages failed in the meantime
+                pass
+        else:
+            # producer failed, stop all stages
+            self._stopped.set()
+        for thread in self.threads:
+            thread.join()
+        if self._error is not None and exc_type is None:
+            raise RuntimeError('Prediction pipeline failed') from self._error
+        return False
+
+    def put(self, item):
+        self._put(self.queues[0], item)
+
+    def _put(self, q, item):
+        while not self._stopped.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+        raise RuntimeError('Prediction pipeline failed') from self._error
+
+    def _get(self, q):
+        while not self._stopped.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return self._END
+
+    def _run_stage(self, i, stage):
+        output_queue = self.queues[i + 1] if i + 1 < len(self.queues) else None
+        try:
+            while True:
+                item = self._get(self.queues[i])
+                if item is self._END:
+                    if output_queue is not None and not self._stopped.is_set():
+                        self._put(output_queue, self._END)
+                    return
+                result = stage(item)
+                if output_queue is not None:
+                    self._put(output_queue, result)
+        except Exception as e:
+            if self._error is None:
+                self._error = e
+                logger.error(f'Prediction pipeline stage {i} failed', exc_info=True)
+            self._stopped.set()
+
+
+class _PatchStitcher:
+    """
+    Accumulates batches of predicted patches into the output prediction arrays and normalizes the result.
+
+    Destination (output array) and source (predicted patch) slices are computed once per patch position: either up front
+    from the slice builder grid of the dataset or the first time a given position is seen. Blending weights are applied
+    to the whole batch at once, so that stitching a batch boils down to a single accumulation per patch.
+
+    The sum of the weights in every voxel (the number of visits in the 'average' blending mode) does not depend on the
+    predictions, so it is computed once from the patch positions and shared by all output heads and channels.
+    If the patches form a regular grid (as created by the `SliceBuilder`) the weights are separable and stored as
+    1D profiles (one per axis), otherwise a single DHW weight map is used.
+
+    If the input volume was mirror padded by `padding` voxels (see `PaddedVolume`), the patch positions are given in
+    the padded coordinates and the predictions of the padded border are cropped while stitching, so that the output
+    prediction maps have the shape of the original volume.
+
+    Args:
+        volume_shape (tuple): spatial shape (DHW) of the output prediction maps
+        blending (str): 'average' (remove `patch_halo` and average) or 'gaussian' (weight by the importance map)
+        patch_halo (tuple): number of voxels removed from each side of the patch in the 'average' blending mode
+        sigma_scale (float): standard deviation of the Gaussian importance map ('gaussian' blending)
+        slices (list): patch positions (e.g. `raw_slices` of the dataset) used to pre-compute the slices and weights;
+            if None the weights are accumulated while stitching
+        padding (tuple): mirror padding (z, y, x) of the input volume
+    """
+
+    def __init__(self, volume_shape, blending, patch_halo, sigma_scale=0.125, slices=None, padding=None):
+        assert blending in ['average', 'gaussian'], f'Unsupported blending mode: {blending}'
+        self.volume_shape = tuple(volume_shape)
+        self.padding = tuple(padding) if padding is not None else None
+        # shape of the (padded) volume the patches were taken from
+        if self.padding is None:
+            self._input_shape = self.volume_shape
+        else:
+            self._input_shape = tuple(size + 2 * pad for size, pad in zip(self.volume_shape, self.padding))
+        self.blending = blending
+        self.patch_halo = patch_halo
+        self.sigma_scale = sigma_scale
+        # maps patch position to the (destination, source) spatial slices
+        self._slices = {}
+        # gaussian importance profiles and maps, built once per patch shape
+        self._importance_profiles = {}
+        self._importance_maps = {}
+        # separable weights: list of 1D profiles (one per axis)
+        self._weight_profiles = None
+        # non-separable weights: DHW array
+        self._weight_map = None
+        self._accumulate = slices is None
+        if slices is not None:
+            self._compute_weights(slices)
+
+    @staticmethod
+    def _slice_key(index):
+        # slice objects are not hashable; use only the spatial dimensions in case of 4D slicing
+        return tuple((s.start, s.stop) for s in index[-3:])
+
+    def _get_slices(self, index):
+        key = self._slice_key(index)
+        slices = self._slices.get(key)
+        if slices is None:
+            index = tuple(index[-3:])
+            if self.blending == 'gaussian':
+                # keep the whole patch
+                slices = (index, (slice(None),) * 3)
+            else:
+                # remove halo in order to avoid block artifacts in the output probability maps
+                patch_index, index = get_halo_slices(index, self._input_shape, self.patch_halo)
+                slices = (index, patch_index)
+            if self.padding is not None:
+                slices = self._crop_padding(slices, key)
+            self._slices[key] = slices
+        return slices
+
+    def _crop_padding(self, slices, key):
+        # clip the destination slices to the original volume and shift them to its coordinates
+        dst, src = [], []
+        for d, s, (start, stop), pad, size in zip(*slices, key, self.padding, self.volume_shape):
+            s_start = s.indices(stop - start)[0]
+            d_start, d_stop = max(d.start, pad), min(d.stop, pad + size)
+            d_stop = max(d_stop, d_start)
+            s_start += d_start - d.start
+            dst.append(slice(d_start - pad, d_stop - pad))
+            src.append(slice(s_start, s_start + d_stop - d_start))
+        return tuple(dst), tuple(src)
+
+    def _profiles(self, patch_shape):
+        patch_shape = tuple(patch_shape)
+        if patch_shape not in self._importance_profiles:
+            if self.blending == 'gaussian':
+                profiles = gaussian_importance_profiles(patch_shape, sigma_scale=self.sigma_scale)
+            else:
+                profiles = [np.ones(size) for size in patch_shape]
+            self._importance_profiles[patch_shape] = profiles
+        return self._importance_profiles[patch_shape]
+
+    def _importance_map(self, patch_shape):
+        patch_shape = tuple(patch_shape)
+        if patch_shape not in self._importance_maps:
+            logger.info(f'Creating gaussian importance map for patch shape: {patch_shape}')
+            self._importance_maps[patch_shape] = gaussian_importance_map(patch_shape, sigma_scale=self.sigma_scale)
+        return self._importance_maps[patch_shape]
+
+    def _compute_weights(self, slices):
+        keys = {self._slice_key(index): index for index in slices}
+        # unique patch positions along each axis
+        axis_positions = [{key[axis] for key in keys} for axis in range(3)]
+        if len(keys) == np.prod([len(positions) for positions in axis_positions]):
+            # regular grid: sum the weights along each axis separately
+            profiles = [np.zeros(size, dtype='float64') for size in self.volume_shape]
+            visited = [set() for _ in range(3)]
+            for key, index in keys.items():
+                dst, src = self._get_slices(index)
+                patch_shape = [stop - start for start, stop in key]
+                for axis, (profile, patch_profile) in enumerate(zip(profiles, self._profiles(patch_shape))):
+                    if key[axis] not in visited[axis]:
+                        visited[axis].add(key[axis])
+                        profile[dst[axis]] += patch_profile[src[axis]]
+            self._weight_profiles = [profile.astype('float32') for profile in profiles]
+        else:
+            self._weight_map = np.zeros(self.volume_shape, dtype='float32')
+            for key, index in keys.items():
+                patch_shape = [stop - start for start, stop in key]
+                self._accumulate_weights(index, patch_shape)
+
+    def _accumulate_weights(self, index, patch_shape):
+        dst, src = self._get_slices(index)
+        if self.blending == 'gaussian':
+            self._weight_map[dst] += self._importance_map(patch_shape)[src]
+        else:
+            # count voxel visits
+            self._weight_map[dst] += 1
+
+    def stitch(self, predictions, indices, prediction_map):
+        """
+        Accumulates a batch of predictions into the `prediction_map`.
+
+        Args:
+            predictions (ndarray): 5D (NCDHW) batch of predicted patches
+            indices (list): positions of the patches inside the output volume
+            prediction_map (ndarray or h5py.Dataset): 4D (CDHW) output prediction array
+        """
+        patch_shape = predictions.shape[2:]
+        if self.blending == 'gaussian':
+            # weight the whole batch by the importance map
+            predictions = predictions * self._importance_map(patch_shape)
+
+        if self._accumulate and self._weight_map is None:
+            # patch positions were not known up front, accumulate the weights while stitching
+            self._weight_map = np.zeros(self.volume_shape, dtype='float32')
+
+        channel_slice = slice(0, predictions.shape[1])
+        for pred, index in zip(predictions, indices):
+            dst, src = self._get_slices(index)
+            if any(s.stop <= s.start for s in dst):
+                # patch lies entirely in the mirror padding
+                continue
+            if isinstance(prediction_map, _ChunkAccumulator):
+                prediction_map.add((channel_slice,) + dst, pred[(channel_slice,) + src])
+            else:
+                prediction_map[(channel_slice,) + dst] += pred[(channel_slice,) + src]
+            if self._accumulate:
+                self._accumulate_weights(index, patch_shape)
+
+    @property
+    def precomputed(self):
+        """
+        True if the sum of weights was computed up front from the patch positions, i.e. any region of the output
+        can be normalized as soon as all of the patches overlapping with it have been stitched.
+        """
+        return not self._accumulate
+
+    def destination_slices(self, slices=None):
+        """
+        Returns the spatial (DHW) destination slices of the given patch positions (`slices`) or of all patch positions
+        known to the stitcher if `slices` is None.
+        """
+        if slices is None:
+            return [dst for dst, _ in self._slices.values()]
+        return [self._get_slices(index)[0] for index in slices]
+
+    def normalize(self, prediction_map, index=None):
+        """
+        Divides (in-place) the accumulated predictions by the sum of weights in every voxel.
+
+        Args:
+            prediction_map (ndarray): 4D (CDHW) accumulated predictions
+            index (tuple): optional spatial (DHW) position of `prediction_map` inside the output volume, used when
+                normalizing the output block by block
+        """
+        if index is None:
+            index = (slice(None),) * 3
+        index = tuple(index[-3:])
+
+        if self._weight_profiles is not None:
+            for axis, profile in enumerate(self._weight_profiles):
+                shape = [1, 1, 1, 1]
+                shape[axis + 1] = -1
+                prediction_map /= profile[index[axis]].reshape(shape)
+        else:
+            prediction_map /= self._weight_map[index]
+        return prediction_map
+
+
+class _PatchSubset(Subset):
+    """
+    Subset of the patches of a given dataset, which keeps the positions of the selected patches in `raw_slices`.
+    """
+
+    def __init__(self, dataset, indices):
+        super().__init__(dataset, indices)
+        self.raw_slices = [dataset.raw_slices[i] for i in indices]
+        self.raws = dataset.raws
+        self.mirror_padding = getattr(dataset, 'mirror_padding', None)
+
+
+class _ShardBuffer:
+    """
+    4D (CDHW) accumulation buffer of a prediction worker which covers only the z-range of the worker's patches,
+    starting at `z_start`. Translates the output volume coordinates used by the `_PatchStitcher` into the buffer
+    coordinates.
+    """
+
+    def __init__(self, buffer, z_start):
+        self.buffer = buffer
+        self.z_start = z_start
+
+    def _shift(self, index):
+        channel_slice, z, y, x = index
+        return channel_slice, slice(z.start - self.z_start, z.stop - self.z_start), y, x
+
+    def __getitem__(self, index):
+        return self.buffer[self._shift(index)]
+
+    def __setitem__(self, index, value):
+        self.buffer[self._shift(index)] = value
+
+
+class _ProgressMap:
+    """
+    4D (CDHW) in-memory prediction array which keeps track of the patches stitched into it. After each patch
+    `on_final(z)` is called if the output became final up to a higher z-coordinate `z`, i.e. none of the remaining
+    patches (given by their spatial destination slices `patch_slices`) is going to change the output below `z`.
+    """
+
+    def __init__(self, array, patch_slices, on_final):
+        self.array = array
+        self.shape = array.shape
+        self.on_final = on_final
+        # z-start -> number of patches starting at the given z which are still going to be stitched
+        self._pending = collections.Counter(index[0].start for index in patch_slices
+                                            if all(s.stop > s.start for s in index))
+        self._final_z = 0
+
+    def __getitem__(self, index):
+        return self.array[index]
+
+    def __setitem__(self, index, value):
+        self.array[index] = value
+        z_start = index[1].start
+        self._pending[z_start] -= 1
+        if self._pending[z_start] <= 0:
+            del self._pending[z_start]
+        final_z = min(self._pending) if self._pending else self.shape[1]
+        if final_z > self._final_z:
+            self._final_z = final_z
+            self.on_final(final_z)
+
+
+def _chunk_ids(index, chunk_shape):
+    # ids of the chunks of a given shape overlapping with the spatial (DHW) `index`
+    if any(s.stop <= s.start for s in index[-3:]):
+        return iter(())
+    ranges = [range(s.start // c, (s.stop - 1) // c + 1) for s, c in zip(index[-3:], chunk_shape)]
+    return itertools.product(*ranges)
+
+
+class _ChunkAccumulator:
+    """
+    Accumulates the predicted patches in memory, chunk by chunk, in front of a chunked output H5 dataset. Each chunk
+    is written to the H5 (and compressed) only once: as soon as all of the patches overlapping with the chunk have
+    been accumulated. Since the `SliceBuilder` iterates over the volume in the z-y-x order, only the chunks along
+    the current z-slab of patches are kept in memory at any time.
+
+    The number of chunks kept in memory is bounded by `max_cache_size`. If the cache is full the least recently used
+    chunk is written to the H5 ahead of time and its remaining patches are added to the data already saved.
+
+    If `normalize` is given, the chunk is normalized right before its final write, so that the output dataset does not
+    have to be read, normalized and compressed again once the prediction is done.
+
+    Chunks given in `done_chunks` are already final (e.g. written by an interrupted run), any predictions falling
+    into them are discarded. The same holds for the chunks which became final during the accumulation, so they are
+    neither expected again (see `expect`) nor normalized twice. `on_final(chunk_id)` is called after each final write
+    of a chunk.
+
+    Args:
+        dataset (h5py.Dataset): 4D (CDHW) chunked output dataset
+        patch_slices (list): spatial (DHW) destination slices of all patches which are going to be accumulated;
+            if None the chunks are written only when evicted from the cache or on `close`
+        max_cache_size (int): maximum size of the cached chunks in bytes
+        normalize (callable): optional function `normalize(chunk, chunk_slices)` applied (in-place) to the fully
+            accumulated 4D (CDHW) chunk at a given spatial (DHW) position
+        done_chunks (set): ids of the chunks which must not be changed
+        on_final (callable): optional callback invoked with the chunk id after the final write of the chunk
+    """
+
+    def __init__(self, dataset, patch_slices=None, max_cache_size=1024 ** 3, normalize=None, done_chunks=None,
+                 on_final=None):
+        assert dataset.chunks is not None, 'Output dataset must be chunked'
+        self.dataset = dataset
+        self.shape = dataset.shape
+        self.channels = dataset.shape[0]
+        self.volume_shape = dataset.shape[1:]
+        self.chunk_shape = dataset.chunks[1:]
+        chunk_size = self.channels * int(np.prod(self.chunk_shape)) * np.dtype('float32').itemsize
+        self.max_cached_chunks = max(1, max_cache_size // chunk_size)
+        self.normalize = normalize
+        self.done_chunks = set() if done_chunks is None else set(done_chunks)
+        self.on_final = on_final
+        # chunk id -> accumulated predictions
+        self._cache = collections.OrderedDict()
+        # chunk id -> number of patches which are still going to be added to the chunk
+        self._pending = collections.Counter()
+        if patch_slices is not None:
+            self.expect(patch_slices)
+        # chunks with (partial) data already written to the H5
+        self._written = set()
+
+    def expect(self, patch_slices):
+        """
+        Sets the spatial (DHW) destination slices of the patches which are going to be accumulated. The chunks which
+        are already final are skipped.
+        """
+        self._pending.clear()
+        for index in patch_slices:
+            self._pending.update(chunk_id for chunk_id in self._chunk_ids(index) if chunk_id not in self.done_chunks)
+
+    def _chunk_ids(self, index):
+        return _chunk_ids(index, self.chunk_shape)
+
+    def _chunk_slices(self, chunk_id):
+        return tuple(slice(i * c, min((i + 1) * c, size))
+                     for i, c, size in zip(chunk_id, self.chunk_shape, self.volume_shape))
+
+    def add(self, index, patch):
+        """
+        Adds the `patch` to the output at a given 4D (CDHW) `index`.
+        """
+        channel_slice = index[0]
+        index = index[1:]
+        for chunk_id in self._chunk_ids(index):
+            if chunk_id in self.done_chunks:
+                continue
+            chunk_slices = self._chunk_slices(chunk_id)
+            # intersection of the patch and the chunk in the patch and the chunk coordinates
+            patch_index = [channel_slice]
+            chunk_index = [channel_slice]
+            for p, c in zip(index, chunk_slices):
+                start, stop = max(p.start, c.start), min(p.stop, c.stop)
+                patch_index.append(slice(start - p.start, stop - p.start))
+                chunk_index.append(slice(start - c.start, stop - c.start))
+
+            chunk = self._get_chunk(chunk_id, chunk_slices)
+            chunk[tuple(chunk_index)] += patch[tuple(patch_index)]
+
+            if chunk_id in self._pending:
+                self._pending[chunk_id] -= 1
+                if self._pending[chunk_id] <= 0:
+                    # no other patch is going to touch the chunk
+                    del self._pending[chunk_id]
+                    self._flush(chunk_id, final=True)
+
+    def _get_chunk(self, chunk_id, chunk_slices):
+        chunk = self._cache.get(chunk_id)
+        if chunk is None:
+            if len(self._cache) >= self.max_cached_chunks:
+                # evict the least recently used chunk
+                self._flush(next(iter(self._cache)))
+            chunk_shape = (self.channels,) + tuple(s.stop - s.start for s in chunk_slices)
+            chunk = np.zeros(chunk_shape, dtype='float32')
+            self._cache[chunk_id] = chunk
+        else:
+            self._cache.move_to_end(chunk_id)
+        return chunk
+
+    def _flush(self, chunk_id, final=False):
+        chunk = self._cache.pop(chunk_id)
+        chunk_slices = self._chunk_slices(chunk_id)
+        index = (slice(None),) + chunk_slices
+        if chunk_id in self._written:
+            # add the part of the chunk which has already been saved
+            chunk += self.dataset[index]
+        if final and self.normalize is not None:
+            self.normalize(chunk, chunk_slices)
+        self.dataset[index] = chunk
+        self._written.add(chunk_id)
+        if final:
+            # the chunk is complete (and normalized), later patches overlapping with it must not change it
+            self.done_chunks.add(chunk_id)
+            if self.on_final is not None:
+                self.on_final(chunk_id)
+
+    def close(self):
+        """
+        Writes all the chunks which are still in memory. All the patches are assumed to be accumulated at this point,
+        so the remaining chunks are final.
+        """
+        while self._cache:
+            chunk_id = next(iter(self._cache))
+            self._pending.pop(chunk_id, None)
+            self._flush(chunk_id, final=True)
+
+        if self.normalize is not None:
+            # chunks spilled to disk which did not receive all of the expected patches have not been normalized yet
+            for chunk_id in self._pending:
+                if chunk_id in self._written:
+                    chunk_slices = self._chunk_slices(chunk_id)
+                    index = (slice(None),) + chunk_slices
+                    self.dataset[index] = self.normalize(self.dataset[index], chunk_slices)
+                    if self.on_final is not None:
+                        self.on_final(chunk_id)
+        self._pending.clear()
+
+
+class _PredictionJournal:
+    """
+    On-disk record of the output chunks which are final in the output H5, i.e. all of the patches overlapping with
+    the chunk have been accumulated and the chunk has been written to all of the output datasets
+    (see `_ChunkAccumulator`). The journal is a text file with a JSON header describing the patch grid followed by
+    the ids of the final chunks, one per line. New entries are appended in batches of `sync_every` chunks: the output H5
+    is flushed first (`flush` callback) and then the journal is fsynced, so that every journaled chunk is on disk.
+
+    A patch is completed once all of the chunks it overlaps with are final. When resuming, only the patches which
+    are not completed are predicted again. Predictions falling into the final chunks are discarded and the remaining
+    chunks are recomputed from scratch (all of the patches contributing to them are predicted again).
+
+    Args:
+        path (str): path to the journal file
+        patch_slices (list): spatial (DHW) destination slices of all patches of the dataset
+        chunk_shape (tuple): spatial (DHW) chunk shape of the output datasets
+        output_heads (int): number of output datasets, every chunk has to be final in all of them
+        flush (callable): flushes the output H5 file
+        resume (bool): read the final chunks from an existing journal
+        sync_every (int): number of final chunks written to the journal at once
+    """
+
+    def __init__(self, path, patch_slices, chunk_shape, output_heads, flush, resume=False, sync_every=64):
+        self.path = path
+        self.flush = flush
+        self.sync_every = sync_every
+        self.output_heads = output_heads
+        header = {'patches': len(patch_slices), 'chunk_shape': list(chunk_shape),
+                  'slices': _slices_digest(patch_slices)}
+
+        self.done_chunks = self._load(header) if resume else set()
+        # patches overlapping with any chunk which is not final yet
+        self.patches = [i for i, index in enumerate(patch_slices)
+                        if not all(chunk_id in self.done_chunks for chunk_id in _chunk_ids(index, chunk_shape))]
+        logger.info(f'Journal: {len(self.done_chunks)} final chunks, '
+                    f'{len(patch_slices) - len(self.patches)} out of {len(patch_slices)} patches completed')
+
+        # chunk id -> number of output datasets in which the chunk is final
+        self._final_counts = collections.Counter()
+        self._entries = []
+
+        if not resume or not os.path.exists(self.path):
+            with open(self.path, 'w') as f:
+                f.write(json.dumps(header) + '\n')
+        self._file = open(self.path, 'a')
+
+    def _load(self, header):
+        if not os.path.exists(self.path):
+            logger.info(f'Journal {self.path} not found. Starting from scratch...')
+            return set()
+
+        done_chunks = set()
+        with open(self.path, 'r') as f:
+            assert json.loads(f.readline()) == header, f'Journal {self.path} does not match the current patch grid'
+            for line in f:
+                # the last line might be truncated if the process was killed while writing it
+                if line.endswith('\n'):
+                    done_chunks.add(tuple(int(i) for i in line.split()))
+        return done_chunks
+
+    def chunk_finalized(self, chunk_id):
+        self._final_counts[chunk_id] += 1
+        if self._final_counts[chunk_id] == self.output_heads:
+            del self._final_counts[chunk_id]
+            self._entries.append(chunk_id)
+            if len(self._entries) >= self.sync_every:
+                self.sync()
+
+    def sync(self):
+        if not self._entries:
+            return
+        # make sure that the predictions are on disk before they're recorded in the journal
+        self.flush()
+        self._file.write(''.join(' '.join(str(i) for i in chunk_id) + '\n' for chunk_id in self._entries))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self.done_chunks.update(self._entries)
+        self._entries = []
+
+    def close(self, remove=False):
+        self.sync()
+        self._file.close()
+        if remove:
+            os.remove(self.path)
+
+
+def _slices_digest(slices):
+    # compact description of the patch grid used to detect a mismatch between the journal and the dataset
+    positions = [[(s.start, s.stop) for s in index[-3:]] for index in slices]
+    return hashlib.sha1(str(positions).encode()).hexdigest()
+
+
 class LazyPredictor(StandardPredictor):
     """
         Applies the model on the given dataset and saves the result in the `output_file` in the H5 format.
         Predicted patches are directly saved into the H5 and they won't be stored in memory. Since this predictor
         is slower than the `StandardPredictor` it should only be used when the predicted volume does not fit into RAM.
 
+        The output datasets are chunked according to the `stride_shape` of the slice builder. Predicted patches
+        are accumulated in memory and each chunk is written to the H5 once all of its patches have been predicted
+        (see `_ChunkAccumulator`). The size of the in-memory chunk cache is given by `chunk_cache_mb` (default: 1024).
+        If the patch positions are known up front, the chunks are normalized before being written, otherwise the output
+        datasets are normalized block by block after the prediction.
+
+        With `resume: true` the final output chunks are recorded in a journal next to the output file
+        (see `_PredictionJournal`). If the prediction is interrupted, running it again with `resume: true` reopens
+        the partial output and predicts only the patches which are not final yet.
+
         The output dataset names inside the H5 is given by `des_dataset_name` config argument. If the argument is
         not present in the config 'predictions{n}' is used as a default dataset name, where `n` denotes the number
         of the output head from the network.
@@ -208,52 +1185,110 @@ class LazyPredictor(StandardPredictor):
 
     def __init__(self, model, loader, output_file, config, **kwargs):
         super().__init__(model, loader, output_file, config, **kwargs)
+        self._journal = None
+
+    def _journal_path(self):
+        return self.output_file + '.journal'
+
+    def _resume(self):
+        return self.predictor_config.get('resume', False) and os.path.exists(self.output_file) and os.path.exists(
+            self._journal_path())
+
+    def _open_output_file(self):
+        if self._resume():
+            logger.info(f'Resuming the prediction into: {self.output_file}')
+            return super()._open_output_file('r+')
+        return super()._open_output_file()
+
+    def _allocate_prediction_maps(self, output_shape, output_heads, output_file, stitcher):
+        # align the output chunks with the stride of the slice builder
+        chunks = self._output_chunks(output_shape)
+        logger.info(f'Output chunk shape: {chunks}')
+        cache_size = self.predictor_config.get('chunk_cache_mb', 1024) * 1024 ** 2
+        # normalize each chunk before it is written if the sum of weights is known up front
+        normalize = stitcher.normalize if stitcher.precomputed else None
+
+        patch_slices = stitcher.destination_slices()
+        done_chunks = None
+        on_final = None
+        if self.predictor_config.get('resume', False):
+            assert stitcher.precomputed, 'Resumable prediction requires the patch positions to be known up front'
+            patch_slices = stitcher.destination_slices(self.loader.dataset.raw_slices)
+            self._journal = _PredictionJournal(self._journal_path(), patch_slices, chunks[1:], output_heads,
+                                               flush=output_file.flush, resume=self._resume(),
+                                               sync_every=self.predictor_config.get('journal_sync_every', 64))
+            done_chunks = self._journal.done_chunks
+            on_final = self._journal.chunk_finalized
+            patch_slices = [patch_slices[i] for i in self._journal.patches]
 
-    def _allocate_prediction_maps(self, output_shape, output_heads, output_file):
         # allocate datasets for probability maps
+        prediction_maps = []
+        for dataset_name in self._get_output_dataset_names(output_heads, prefix='predictions'):
+            if dataset_name in output_file:
+                # partial output of the interrupted run
+                dataset = output_file[dataset_name]
+                assert dataset.shape == output_shape and dataset.chunks == chunks, \
+                    f'Dataset {dataset_name} does not match the output shape {output_shape} and chunks {chunks}'
+            else:
+                dataset = output_file.create_dataset(dataset_name, shape=output_shape, dtype='float32', chunks=chunks,
+                                                     compression='gzip')
+            prediction_maps.append(_ChunkAccumulator(dataset,
+                                                     patch_slices=patch_slices,
+                                                     max_cache_size=cache_size,
+                                                     normalize=normalize,
+                                                     done_chunks=done_chunks,
+                                                     on_final=on_final))
+        return prediction_maps
+
+    def _run_prediction(self, loader, prediction_maps, stitcher):
+        if self._journal is not None and len(self._journal.patches) < len(loader.dataset):
+            # skip the patches completed by the interrupted run
+            loader = DataLoader(_PatchSubset(loader.dataset, self._journal.patches), batch_size=loader.batch_size,
+                                num_workers=loader.num_workers, collate_fn=loader.collate_fn)
+        super()._run_prediction(loader, prediction_maps, stitcher)
+
+    def _output_chunks(self, output_shape):
+        stride_shape = self.config['loaders']['test']['slice_builder']['stride_shape']
+        return (output_shape[0],) + tuple(min(s, size) for s, size in zip(stride_shape, output_shape[1:]))
+
+    def _save_results(self, prediction_maps, stitcher, output_heads, output_file, dataset):
         prediction_datasets = self._get_output_dataset_names(output_heads, prefix='predictions')
-        prediction_maps = [
-            output_file.create_dataset(dataset_name, shape=output_shape, dtype='float32', chunks=True,
-                                       compression='gzip')
-            for dataset_name in prediction_datasets]
 
-        # allocate datasets for normalization masks
-        normalization_datasets = self._get_output_dataset_names(output_heads, prefix='normalization')
-        normalization_masks = [
-            output_file.create_dataset(dataset_name, shape=output_shape, dtype='uint8', chunks=True,
-                                       compression='gzip')
-            for dataset_name in normalization_datasets]
-
-        return prediction_maps, normalization_masks
-
-    def _save_results(self, prediction_maps, normalization_masks, output_heads, output_file, dataset):
-        if dataset.mirror_padding:
-            logger.warn(
-                f'Mirror padding unsupported in LazyPredictor. Output predictions will be padded with pad_width: {dataset.pad_width}')
+        for accumulator, prediction_dataset in zip(prediction_maps, prediction_datasets):
+            # write the chunks which are still in memory
+            accumulator.close()
+            if accumulator.normalize is not None:
+                # chunks were normalized before being written
+                continue
 
-        prediction_datasets = self._get_output_dataset_names(output_heads, prefix='predictions')
-        normalization_datasets = self._get_output_dataset_names(output_heads, prefix='normalization')
-
-        # normalize the prediction_maps inside the H5
-        for prediction_map, normalization_mask, prediction_dataset, normalization_dataset in zip(prediction_maps,
-                                                                                                 normalization_masks,
-                                                                                                 prediction_datasets,
-                                                                                                 normalization_datasets):
-            # split the volume into 4 parts and load each into the memory separately
+            # normalize the prediction_maps inside the H5
+            prediction_map = accumulator.dataset
             logger.info(f'Normalizing {prediction_dataset}...')
-
-            z, y, x = prediction_map.shape[1:]
-            # take slices which are 1/27 of the original volume
-            patch_shape = (z // 3, y // 3, x // 3)
-            for index in SliceBuilder._build_slices(prediction_map, patch_shape=patch_shape, stride_shape=patch_shape):
+            # take non-overlapping blocks which are 1/27 of the original volume and load each into the memory separately
+            for index in self._split_volume(prediction_map.shape[1:], 3):
                 logger.info(f'Normalizing slice: {index}')
-                prediction_map[index] /= normalization_mask[index]
-                # make sure to reset the slice that has been visited already in order to avoid 'double' normalization
-                # when the patches overlap with each other
-                normalization_mask[index] = 1
+                index = (slice(None),) + index
+                prediction_map[index] = stitcher.normalize(prediction_map[index], index)
+
+        if self._journal is not None:
+            # the prediction is complete, the journal is no longer needed
+            output_file.flush()
+            self._journal.close(remove=True)
+            self._journal = None
 
-            logger.info(f'Deleting {normalization_dataset}...')
-            del output_file[normalization_dataset]
+    @staticmethod
+    def _split_volume(shape, n):
+        """
+        Splits the volume of a given `shape` into `n` non-overlapping blocks along each axis.
+        """
+        axis_slices = []
+        for size in shape:
+            bounds = np.linspace(0, size, min(n, size) + 1).astype('int')
+            axis_slices.append([slice(start, stop) for start, stop in zip(bounds[:-1], bounds[1:])])
+        for z in axis_slices[0]:
+            for y in axis_slices[1]:
+                for x in axis_slices[2]:
+                    yield z, y, x
 
 
 class EmbeddingsPredictor(_AbstractPredictor):
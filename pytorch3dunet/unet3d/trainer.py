@@ -174,6 +174,11 @@ class UNet3DTrainer:
 
             train_losses.update(loss.item(), self._batch_size(input))
 
+            sampler = getattr(train_loader, 'sampler', None)
+            if getattr(sampler, 'tracks_loss', False):
+                # report the loss of every patch back to the sampler, e.g. to sample the hard examples more often
+                sampler.update_losses(self._sample_losses(output, target, weight))
+
             # compute gradients and update parameters
             self.optimizer.zero_grad()
             loss.backward()
@@ -303,6 +308,23 @@ class UNet3DTrainer:
 
         return output, loss
 
+    def _sample_losses(self, output, target, weight=None):
+        # loss of every sample of the batch, computed without the gradients
+        def _sample(t, i):
+            if isinstance(t, (tuple, list)):
+                return tuple(_sample(x, i) for x in t)
+            return t[i:i + 1]
+
+        losses = []
+        with torch.no_grad():
+            for i in range(self._batch_size(output)):
+                if weight is None:
+                    loss = self.loss_criterion(_sample(output, i), _sample(target, i))
+                else:
+                    loss = self.loss_criterion(_sample(output, i), _sample(target, i), _sample(weight, i))
+                losses.append(loss.item())
+        return losses
+
     def _is_best_eval_score(self, eval_score):
         if self.eval_score_higher_is_better:
             is_best = eval_score > self.best_eval_score
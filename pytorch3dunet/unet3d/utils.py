@@ -148,6 +148,30 @@ def remove_halo(patch, index, shape, patch_halo):
     """
     Remove `pad_width` voxels around the edges of a given patch.
     """
+    i_c, i_z, i_y, i_x = index
+    p_c = slice(0, patch.shape[0])
+
+    (p_z, p_y, p_x), (i_z, i_y, i_x) = get_halo_slices((i_z, i_y, i_x), shape, patch_halo)
+
+    patch_index = (p_c, p_z, p_y, p_x)
+    index = (i_c, i_z, i_y, i_x)
+    return patch[patch_index], index
+
+
+def get_halo_slices(index, shape, patch_halo):
+    """
+    Computes the slices of the patch with the `patch_halo` removed around the edges. Halo is not removed at the borders
+    of the volume.
+
+    Args:
+        index (tuple): 3D (DHW) position of the patch inside the volume
+        shape (tuple): 3D (DHW) shape of the volume
+        patch_halo (tuple): number of voxels removed from each side of the patch along every axis
+
+    Returns:
+        tuple (patch_index, index), where `patch_index` are the slices of the patch without halo and `index` is the
+        corresponding position inside the volume
+    """
     assert len(patch_halo) == 3
 
     def _new_slices(slicing, max_size, pad):
@@ -162,23 +186,55 @@ def remove_halo(patch, index, shape, patch_halo):
             p_stop = None
             i_stop = max_size
         else:
-            p_stop = -pad if pad != 0 else 1
+            p_stop = -pad if pad != 0 else None
             i_stop = slicing.stop - pad
 
         return slice(p_start, p_stop), slice(i_start, i_stop)
 
-    D, H, W = shape
+    patch_index = []
+    volume_index = []
+    for slicing, max_size, pad in zip(index, shape, patch_halo):
+        p_slice, i_slice = _new_slices(slicing, max_size, pad)
+        patch_index.append(p_slice)
+        volume_index.append(i_slice)
 
-    i_c, i_z, i_y, i_x = index
-    p_c = slice(0, patch.shape[0])
+    return tuple(patch_index), tuple(volume_index)
 
-    p_z, i_z = _new_slices(i_z, D, patch_halo[0])
-    p_y, i_y = _new_slices(i_y, H, patch_halo[1])
-    p_x, i_x = _new_slices(i_x, W, patch_halo[2])
 
-    patch_index = (p_c, p_z, p_y, p_x)
-    index = (i_c, i_z, i_y, i_x)
-    return patch[patch_index], index
+def gaussian_importance_map(patch_shape, sigma_scale=0.125, min_value=1e-3):
+    """
+    Creates a DxHxW importance map of a given `patch_shape` where each voxel is weighted by a Gaussian centered
+    in the middle of the patch. Used for blending overlapping patch predictions, so that the voxels close to the
+    patch border (where the network has the least context) contribute less to the final prediction.
+
+    Args:
+        patch_shape (tuple): shape of the patch DxHxW
+        sigma_scale (float): standard deviation of the Gaussian given as a fraction of the patch size along each axis
+        min_value (float): lower bound of the weights in order to avoid zero weights at the patch border
+
+    Returns:
+        3D (DxHxW) float32 ndarray with the maximum value of 1
+    """
+    g_z, g_y, g_x = gaussian_importance_profiles(patch_shape, sigma_scale=sigma_scale, min_value=min_value)
+    importance_map = g_z[:, None, None] * g_y[None, :, None] * g_x[None, None, :]
+    return importance_map.astype('float32')
+
+
+def gaussian_importance_profiles(patch_shape, sigma_scale=0.125, min_value=1e-3):
+    """
+    Returns the 1D Gaussian profiles (one per axis) of the importance map, i.e. the importance map is the outer product
+    of the profiles (see `gaussian_importance_map`). Each profile is bounded below by `min_value ** (1/3)`.
+    """
+    assert len(patch_shape) == 3
+
+    def _gaussian_1d(size):
+        sigma = max(size * sigma_scale, 1e-6)
+        coords = np.arange(size, dtype='float64') - (size - 1) / 2
+        profile = np.exp(-coords ** 2 / (2 * sigma ** 2))
+        profile = profile / np.max(profile)
+        return np.maximum(profile, min_value ** (1 / 3))
+
+    return [_gaussian_1d(size) for size in patch_shape]
 
 
 def number_of_features_per_level(init_channel_number, num_levels):
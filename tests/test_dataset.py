@@ -1,11 +1,22 @@
+import json
 import os
+import pickle
+from multiprocessing.reduction import ForkingPickler
 from tempfile import NamedTemporaryFile
 
 import h5py
+import imageio
 import numpy as np
+import pytest
+import torch
 from torch.utils.data import DataLoader
 
-from pytorch3dunet.datasets.hdf5 import StandardHDF5Dataset, AbstractHDF5Dataset
+from pytorch3dunet.datasets.dsb import DSB2018Dataset
+from pytorch3dunet.datasets.hdf5 import StandardHDF5Dataset, AbstractHDF5Dataset, LazyHDF5Dataset
+from pytorch3dunet.datasets.npy import NpyDataset, convert_h5_to_npy
+from pytorch3dunet.datasets.utils import PaddedVolume, StatsCache, calculate_stats, SliceBuilder, FilterSliceBuilder, \
+    PatchSlices, WeightedPatchSampler, patch_value_counts, _iter_blocks
+from pytorch3dunet.datasets.zarr import ZarrDataset, open_zarr
 
 
 class TestHDF5Dataset:
@@ -94,6 +105,326 @@ class TestHDF5Dataset:
             for i in range(label.shape[0]):
                 assert np.allclose(img, label[i])
 
+    def test_hdf5_roi(self, transformer_config):
+        path = create_random_dataset((64, 128, 128))
+        with h5py.File(path, 'r') as f:
+            raw = f['raw'][...]
+
+        phase = 'test'
+        roi = ((0, 32, 32), (32, 96, 96))
+        dataset = StandardHDF5Dataset(path, phase=phase,
+                                      slice_builder_config=_slice_builder_conf((16, 64, 64), (8, 32, 32)),
+                                      transformer_config=transformer_config[phase]['transformer'],
+                                      mirror_padding=(8, 8, 8),
+                                      roi=roi)
+
+        # region of interest + padding, reflected only at the border of the volume
+        expected = np.pad(raw, pad_width=8, mode='reflect')[0:48, 32:112, 32:112]
+        assert np.array_equal(dataset.raws[0][:, :, :], expected)
+
+    @pytest.mark.parametrize('shape', [(24, 32, 32), (2, 24, 32, 32)])
+    def test_padded_volume(self, tmpdir, shape):
+        raw = np.random.rand(*shape).astype('float32')
+        path = os.path.join(tmpdir, 'raw.h5')
+        with h5py.File(path, 'w') as f:
+            f.create_dataset('raw', data=raw)
+
+        pad_width = ((4, 4), (8, 8), (2, 6))
+        expected = np.pad(raw, pad_width=((0, 0),) * (raw.ndim - 3) + pad_width, mode='reflect')
+        leading = (slice(None),) * (raw.ndim - 3)
+        with h5py.File(path, 'r') as f:
+            for volume in [raw, f['raw']]:
+                padded = PaddedVolume(volume, pad_width)
+                assert padded.shape == expected.shape
+                for index in [(slice(None),) * 3, (slice(0, 8), slice(4, 20), slice(30, 40)),
+                              (slice(6, 20), slice(10, 30), slice(10, 30)), (slice(None, None, 4),) * 3]:
+                    assert np.array_equal(padded[leading + index], expected[leading + index])
+
+    @pytest.mark.parametrize('chunks', [None, (4, 16, 16)])
+    def test_calculate_stats(self, tmpdir, chunks):
+        raws = [np.random.rand(24, 32, 32).astype('float32') * 10, np.random.rand(2, 8, 16, 16).astype('float32')]
+        path = os.path.join(tmpdir, 'raw.h5')
+        with h5py.File(path, 'w') as f:
+            for i, raw in enumerate(raws):
+                f.create_dataset(f'raw{i}', data=raw, chunks=chunks if raw.ndim == 3 else None)
+
+        flat = np.concatenate([raw.ravel() for raw in raws]).astype('float64')
+        expected = (flat.min(), flat.max(), flat.mean(), flat.std())
+        with h5py.File(path, 'r') as f:
+            for images in [raws, [f['raw0'], f['raw1']]]:
+                # small blocks in order to merge the statistics of many blocks
+                stats = calculate_stats(images, block_size=4096)
+                assert np.allclose(stats, expected)
+
+            # approximate statistics from a subsample of the blocks
+            min_value, max_value, mean, std = calculate_stats([f['raw0']], subsample=0.5, block_size=4096)
+            assert raws[0].min() <= min_value <= max_value <= raws[0].max()
+            assert abs(mean - raws[0].mean()) < 0.5
+
+    @pytest.mark.parametrize('block_size,block_shape', [(2048, (4, 8, 16)), (16 * 1024, (4, 32, 32)),
+                                                         (1024 ** 2, (24, 32, 32))])
+    def test_iter_blocks(self, tmpdir, block_size, block_shape):
+        path = os.path.join(tmpdir, 'raw.h5')
+        with h5py.File(path, 'w') as f:
+            ds = f.create_dataset('raw', data=np.random.rand(24, 32, 32).astype('float32'), chunks=(4, 8, 8))
+            blocks = list(_iter_blocks(ds, block_size))
+
+        # the chunks are grouped into blocks of at most block_size bytes which cover the volume
+        covered = np.zeros((24, 32, 32), dtype='int')
+        for index in blocks:
+            assert tuple(s.stop - s.start for s in index) == block_shape
+            covered[index] += 1
+        assert np.all(covered == 1)
+
+    def test_stats_cache(self, tmpdir, transformer_config):
+        path = create_random_dataset((32, 64, 64))
+        cache_dir = os.path.join(tmpdir, 'stats')
+        loaders_config = {
+            'stats_cache': cache_dir,
+            'train': {'file_paths': [path]},
+            'test': {'file_paths': [path], 'rois': [[[0, 0, 0], [16, 64, 64]]]}
+        }
+        StandardHDF5Dataset.precompute_stats(loaders_config, 'train')
+        cache_file = StatsCache(cache_dir).cache_file(path)
+        assert os.path.exists(cache_file)
+
+        with h5py.File(path, 'r') as f:
+            raw = f['raw'][...]
+        calls = []
+
+        def _calculate():
+            calls.append(1)
+            return calculate_stats([raw])
+
+        # computed by precompute_stats, shared with the test phase of the same file
+        cache = StatsCache(cache_dir)
+        key = {'internal_paths': ['raw'], 'shapes': [list(raw.shape)], 'subsample': None}
+        stats = cache.get(path, key, _calculate)
+        assert not calls
+        assert np.allclose(stats, calculate_stats([raw]))
+
+        # regions of interest are normalized with the statistics of the whole volume
+        StandardHDF5Dataset.precompute_stats(loaders_config, 'test')
+        with open(cache_file) as f:
+            assert len(json.load(f)['entries']) == 1
+
+        # modifying the file invalidates the cache
+        with h5py.File(path, 'r+') as f:
+            f['raw'][0] = 0
+        os.utime(path, ns=(os.stat(path).st_atime_ns, os.stat(path).st_mtime_ns + 10 ** 9))
+        cache.get(path, key, _calculate)
+        assert len(calls) == 1
+
+    @pytest.mark.parametrize('dataset_class,extension,dataset_kwargs', [
+        (LazyHDF5Dataset, '.h5', {}),
+        (ZarrDataset, '.zarr', {'decompression_threads': 4}),
+        (ZarrDataset, '.n5', {'decompression_threads': 4}),
+        (NpyDataset, '.npy', {}),
+        (StandardHDF5Dataset, '.h5', {'shared_memory': True})
+    ])
+    def test_same_patches_as_standard_dataset(self, tmpdir, dataset_class, extension, dataset_kwargs):
+        if dataset_class is ZarrDataset:
+            pytest.importorskip('zarr')
+        h5_path = _create_compressed_dataset(tmpdir)
+        path = _convert_dataset(h5_path, extension)
+        kwargs = _train_dataset_kwargs()
+        dataset = dataset_class(path, **dataset_kwargs, **kwargs)
+        expected = StandardHDF5Dataset(h5_path, **kwargs)
+
+        # the shared memory is passed to the spawned workers
+        context = 'spawn' if dataset_kwargs.get('shared_memory', False) else None
+        loader = DataLoader(dataset, batch_size=1, num_workers=2, shuffle=False, multiprocessing_context=context)
+        expected_loader = DataLoader(expected, batch_size=1, num_workers=0, shuffle=False)
+        for (raw_patch, label_patch), (expected_raw, expected_label) in zip(loader, expected_loader):
+            assert torch.allclose(raw_patch, expected_raw)
+            assert torch.equal(label_patch, expected_label)
+
+    def test_lazy_hdf5_dataset(self, tmpdir):
+        path = _create_compressed_dataset(tmpdir)
+        lazy = LazyHDF5Dataset(path, **_train_dataset_kwargs())
+        standard = StandardHDF5Dataset(path, **_train_dataset_kwargs())
+
+        # proxies can be pickled for the spawned workers
+        proxy = pickle.loads(pickle.dumps(lazy.raws[0]))
+        assert np.array_equal(proxy[0:4, 0:8, 0:8], standard.raws[0][0:4, 0:8, 0:8])
+
+        # input file is not modified
+        with h5py.File(path, 'r') as f:
+            assert set(f.keys()) == {'raw', 'label'}
+
+    @pytest.mark.parametrize('extension', ['.zarr', '.n5'])
+    def test_zarr_dataset(self, tmpdir, extension):
+        pytest.importorskip('zarr')
+        zarr_path = _convert_dataset(_create_compressed_dataset(tmpdir), extension)
+
+        # containers inside of the directories are found by the dataset factory
+        assert ZarrDataset.traverse_h5_paths([str(tmpdir)]) == [zarr_path]
+
+    def test_npy_dataset(self, tmpdir):
+        h5_path = _create_compressed_dataset(tmpdir)
+        container = _convert_dataset(h5_path, '.npy')
+        assert NpyDataset.traverse_h5_paths([os.path.dirname(container)]) == [container]
+
+        dataset = NpyDataset(container, **_train_dataset_kwargs())
+        expected = StandardHDF5Dataset(h5_path, **_train_dataset_kwargs())
+        # patches are views of the memory map
+        assert isinstance(dataset.raws[0][0:4, 0:8, 0:8], np.memmap)
+
+        # only the path of the memory map is pickled
+        proxy = pickle.loads(pickle.dumps(dataset.raws[0]))
+        assert len(pickle.dumps(dataset.raws[0])) < 1024
+        assert np.array_equal(proxy[0:4, 0:8, 0:8], expected.raws[0][0:4, 0:8, 0:8])
+
+    def test_shared_memory(self, tmpdir):
+        path = _create_compressed_dataset(tmpdir)
+        dataset = StandardHDF5Dataset(path, shared_memory=True, **_train_dataset_kwargs())
+        assert dataset.raws[0].tensor.is_shared()
+
+        # the shared memory is passed to the spawned workers by a handle
+        assert len(ForkingPickler.dumps(dataset.raws[0])) < 1024
+
+    @pytest.mark.parametrize('class_weights', [None, [0, 1]])
+    def test_random_patch_slice_builder(self, tmpdir, class_weights):
+        label = np.zeros((32, 128, 128), dtype='int64')
+        label[20:28, 90:110, 10:30] = 1
+        path = os.path.join(tmpdir, 'data.h5')
+        with h5py.File(path, 'w') as f:
+            f.create_dataset('raw', data=label.astype('float32') + np.random.rand(*label.shape).astype('float32'))
+            f.create_dataset('label', data=label)
+
+        slice_builder_config = {
+            'name': 'RandomPatchSliceBuilder',
+            'patch_shape': (16, 64, 64),
+            'num_patches': 20,
+            'class_weights': class_weights
+        }
+        dataset = StandardHDF5Dataset(path, **_train_dataset_kwargs(slice_builder_config, standardize=False))
+        assert len(dataset) == 20
+
+        loader = DataLoader(dataset, batch_size=1, num_workers=2, shuffle=True)
+        origins = set()
+        for raw_patch, label_patch in loader:
+            # raw and label patches are taken from the same position
+            assert torch.equal(raw_patch[0, 0].floor().long(), label_patch[0])
+            if class_weights is not None:
+                # only the patches around the foreground voxels are drawn
+                assert label_patch.sum() > 0
+            origins.add(tuple(raw_patch[0, 0, :2, :2, :2].flatten().tolist()))
+        assert len(origins) > 1
+
+    def test_patch_slices(self):
+        raw = np.zeros((2, 40, 96, 80), dtype='float32')
+        label = np.zeros((40, 96, 80), dtype='int64')
+        slice_builder = SliceBuilder([raw], [label], [label.astype('float32')], (16, 64, 64), (12, 32, 32))
+
+        raw_slices, label_slices = slice_builder.raw_slices, slice_builder.label_slices
+        assert isinstance(raw_slices, PatchSlices)
+        # raw, label and weight slices share the origins of the patches
+        assert raw_slices.origins is label_slices.origins is slice_builder.weight_slices.origins
+        assert raw_slices.origins.dtype == np.int32
+        z, y, x = [0, 12, 24], [0, 32], [0, 16]
+        expected = [(slice(i, i + 16), slice(j, j + 64), slice(k, k + 64)) for i in z for j in y for k in x]
+        assert list(label_slices) == expected
+        assert list(raw_slices) == [(slice(0, 2),) + index for index in expected]
+        assert raw_slices.patch_size == 2 * 16 * 64 * 64
+
+        # the shared origins are pickled only once
+        raw_slices, label_slices = pickle.loads(pickle.dumps((raw_slices, label_slices)))
+        assert raw_slices.origins is label_slices.origins
+        assert list(label_slices) == expected
+
+    @pytest.mark.parametrize('ignore_index', [(0,), (0, 2)])
+    def test_filter_slice_builder(self, tmpdir, ignore_index):
+        label = np.random.randint(0, 3, (36, 90, 80)) * (np.random.rand(36, 90, 80) < 0.4)
+        patch_shape, stride_shape = (16, 64, 64), (4, 10, 12)
+
+        grid = SliceBuilder([label], [label], None, patch_shape, stride_shape)
+        counts = patch_value_counts(label, grid.label_slices, [0, 1, 2], block_size=label[0].nbytes * 3)
+        expected_counts = [[np.count_nonzero(label[s] == v) for v in [0, 1, 2]] for s in grid.label_slices]
+        assert np.array_equal(counts, expected_counts)
+
+        # the per-patch predicate of the filter
+        rand_state = np.random.RandomState(47)
+        expected_slices = []
+        for label_idx in grid.label_slices:
+            patch = label[label_idx]
+            non_ignore_counts = np.array([np.count_nonzero(patch != ii) for ii in ignore_index]) / patch.size
+            if np.any(non_ignore_counts > 0.5) or rand_state.rand() < 0.1:
+                expected_slices.append(label_idx)
+
+        path = os.path.join(tmpdir, 'data.h5')
+        with h5py.File(path, 'w') as f:
+            f.create_dataset('label', data=label, chunks=(8, 32, 32))
+        for _ in range(2):
+            # the second run reads the counts from the cache
+            with h5py.File(path, 'r') as f:
+                slice_builder = FilterSliceBuilder([f['label']], [f['label']], None, patch_shape, stride_shape,
+                                                   ignore_index=ignore_index, threshold=0.5, slack_acceptance=0.1,
+                                                   file_path=path, patch_index_cache=True)
+            assert list(slice_builder.label_slices) == expected_slices
+            assert list(slice_builder.raw_slices) == expected_slices
+        assert len(os.listdir(path + '.patches')) == 1
+
+    def test_patch_index_cache(self, tmpdir, monkeypatch):
+        path = create_random_dataset((32, 128, 128), ignore_index=True)
+        slice_builder_config = {
+            'name': 'FilterSliceBuilder',
+            'patch_shape': (16, 64, 64),
+            'stride_shape': (8, 32, 32),
+            'ignore_index': (-1,),
+            'threshold': 0.7,
+            'slack_acceptance': 0.2
+        }
+        cache_dir = os.path.join(tmpdir, 'cache')
+
+        def _dataset(phase):
+            kwargs = _train_dataset_kwargs(slice_builder_config, standardize=False)
+            kwargs['phase'] = phase
+            return StandardHDF5Dataset(path, patch_index_cache=cache_dir, **kwargs)
+
+        train_dataset = _dataset('train')
+        assert 0 < len(train_dataset) < 3 * 3 * 3
+
+        def _build_slices(*args):
+            raise AssertionError('Slices should be loaded from the cache')
+
+        # the val phase reuses the cached slices of the same file
+        monkeypatch.setattr(SliceBuilder, '_build_slices', staticmethod(_build_slices))
+        val_dataset = _dataset('val')
+        assert list(val_dataset.raw_slices) == list(train_dataset.raw_slices)
+        assert list(val_dataset.label_slices) == list(train_dataset.label_slices)
+
+    def test_weighted_patch_sampler(self, tmpdir):
+        label = np.zeros((32, 256, 128), dtype='int64')
+        # the rare class is present in 1 out of 8 patches
+        label[4:12, 10:20, 10:20] = 1
+        path = os.path.join(tmpdir, 'data.h5')
+        with h5py.File(path, 'w') as f:
+            f.create_dataset('raw', data=np.random.rand(*label.shape).astype('float32'))
+            f.create_dataset('label', data=label)
+
+        slice_builder_config = _slice_builder_conf((16, 64, 64), (16, 64, 64))
+        dataset = StandardHDF5Dataset(path, **_train_dataset_kwargs(slice_builder_config, standardize=False))
+        counts = dataset.patch_label_counts([0, 1])
+        assert counts.shape == (len(dataset), 2)
+        assert np.array_equal(counts[:, 1], [np.count_nonzero(label[s] == 1) for s in dataset.label_slices])
+
+        sampler = WeightedPatchSampler([dataset], classes=[0, 1], num_samples=1000, seed=0)
+        rare = set(np.flatnonzero(counts[:, 1]).tolist())
+        sampled = list(sampler)
+        assert len(sampled) == 1000
+        # uniform sampling would give 1/8 of the patches with the rare class
+        assert sum(idx in rare for idx in sampled) > 500
+
+        # the patches with a high loss are sampled more often
+        sampler = WeightedPatchSampler([dataset], classes=[0, 1], class_balance=0, loss_weight=2.0, num_samples=200,
+                                       refresh_every=10, seed=0)
+        hard = 5
+        for idx in sampler:
+            sampler.update_losses([10.0 if idx == hard else 1.0])
+        weights = sampler.weights()
+        assert weights[hard] > 10 * np.median(weights)
+
     def test_traverse_file_paths(self, tmpdir):
         test_tmp_dir = os.path.join(tmpdir, 'test')
         os.mkdir(test_tmp_dir)
@@ -117,6 +448,45 @@ class TestHDF5Dataset:
         assert expected_files == actual_files
 
 
+class TestDSB2018Dataset:
+    def test_stats_cache(self, tmpdir):
+        _create_dsb_dataset(tmpdir)
+
+        transformer_config = {
+            'raw': [{'name': 'ToTensor', 'expand_dims': False}],
+            'label': [{'name': 'ToTensor', 'expand_dims': False, 'dtype': 'long'}]
+        }
+        datasets = []
+        for _ in range(2):
+            # the second run must not read the `.stats.json` sidecar of the first one as an image
+            datasets.append(DSB2018Dataset(str(tmpdir), 'train', transformer_config, stats_cache=True))
+        assert os.path.exists(os.path.join(tmpdir, 'images', '.stats.json'))
+        assert len(datasets[1]) == 3
+        for (raw1, mask1), (raw2, mask2) in zip(datasets[0], datasets[1]):
+            assert torch.equal(raw1, raw2)
+            assert torch.equal(mask1, mask2)
+
+    def test_precompute_stats(self, tmpdir, monkeypatch):
+        _create_dsb_dataset(tmpdir)
+        transformer_config = {
+            'raw': [{'name': 'ToTensor', 'expand_dims': False}],
+            'label': [{'name': 'ToTensor', 'expand_dims': False, 'dtype': 'long'}]
+        }
+        loaders_config = {
+            'stats_cache': True,
+            'train': {'file_paths': [str(tmpdir)], 'transformer': transformer_config}
+        }
+        DSB2018Dataset.precompute_stats(loaders_config, 'train')
+
+        def _calculate_stats(*args, **kwargs):
+            raise AssertionError('Stats should be loaded from the cache')
+
+        # the stats of the images loaded with the added channel axis are taken from the cache
+        monkeypatch.setattr('pytorch3dunet.datasets.dsb.calculate_stats', _calculate_stats)
+        dataset, = DSB2018Dataset.create_datasets(loaders_config, 'train')
+        assert len(dataset) == 3
+
+
 def create_random_dataset(shape, ignore_index=False, raw_datasets=None, label_datasets=None):
     if label_datasets is None:
         label_datasets = ['label']
@@ -144,3 +514,51 @@ def _slice_builder_conf(patch_shape, stride_shape):
         'patch_shape': patch_shape,
         'stride_shape': stride_shape
     }
+
+
+def _create_compressed_dataset(tmpdir, shape=(32, 64, 64)):
+    path = os.path.join(tmpdir, 'data.h5')
+    with h5py.File(path, 'w') as f:
+        f.create_dataset('raw', data=np.random.randint(0, 1000, shape).astype('uint16'), compression='gzip',
+                         chunks=(8, 32, 32))
+        f.create_dataset('label', data=np.random.randint(0, 2, shape), compression='gzip')
+    return path
+
+
+def _convert_dataset(h5_path, extension):
+    """
+    Returns the path of the H5 file at `h5_path` converted to the format given by its `extension`.
+    """
+    if extension == '.h5':
+        return h5_path
+    if extension == '.npy':
+        return convert_h5_to_npy(h5_path, os.path.join(os.path.dirname(h5_path), 'npy'))
+
+    output_path = os.path.splitext(h5_path)[0] + extension
+
+    container = open_zarr(output_path, mode='w')
+    with h5py.File(h5_path, 'r') as f:
+        for name in ['raw', 'label']:
+            container.create_dataset(name, data=f[name][...], chunks=(8, 16, 16))
+    return output_path
+
+
+def _train_dataset_kwargs(slice_builder_config=None, standardize=True):
+    if slice_builder_config is None:
+        slice_builder_config = _slice_builder_conf((16, 64, 64), (8, 32, 32))
+    raw_transforms = [{'name': 'Standardize'}] if standardize else []
+    transformer_config = {
+        'raw': raw_transforms + [{'name': 'ToTensor', 'expand_dims': True}],
+        'label': [{'name': 'ToTensor', 'expand_dims': False, 'dtype': 'long'}]
+    }
+    return dict(phase='train', slice_builder_config=slice_builder_config, transformer_config=transformer_config,
+                mirror_padding=None)
+
+
+def _create_dsb_dataset(root_dir, num_images=3):
+    for name in ['images', 'masks']:
+        os.makedirs(os.path.join(root_dir, name))
+    for i in range(num_images):
+        imageio.imwrite(os.path.join(root_dir, 'images', f'{i}.png'),
+                        np.random.randint(0, 255, (32, 32), dtype='uint8'))
+        imageio.imwrite(os.path.join(root_dir, 'masks', f'{i}.png'), np.random.randint(0, 2, (32, 32), dtype='uint8'))
@@ -1,18 +1,22 @@
+import gc
 import os
 from tempfile import NamedTemporaryFile
 
 import h5py
 import numpy as np
+import pytest
 import torch
 from skimage.metrics import adapted_rand_error
 from torch.utils.data import DataLoader
 
 from pytorch3dunet.datasets.hdf5 import StandardHDF5Dataset
 from pytorch3dunet.datasets.utils import prediction_collate, get_test_loaders
+from pytorch3dunet.datasets.zarr import open_zarr
 from pytorch3dunet.predict import _get_output_file, _get_predictor
 from pytorch3dunet.unet3d.model import get_model
-from pytorch3dunet.unet3d.predictor import EmbeddingsPredictor
-from pytorch3dunet.unet3d.utils import remove_halo
+from pytorch3dunet.unet3d.predictor import EmbeddingsPredictor, StandardPredictor, LazyPredictor, _PatchStitcher, \
+    _Pipeline, _ChunkAccumulator, _tta_variants, _augment, _deaugment
+from pytorch3dunet.unet3d.utils import remove_halo, gaussian_importance_map
 
 
 class FakePredictor(EmbeddingsPredictor):
@@ -31,6 +35,26 @@ class FakeModel:
         pass
 
 
+class CountingModel(FakeModel):
+    def __init__(self):
+        self.patch_count = 0
+
+    def __call__(self, input):
+        self.patch_count += input.shape[0]
+        return input
+
+
+class FailingModel(CountingModel):
+    def __init__(self, max_patch_count):
+        super().__init__()
+        self.max_patch_count = max_patch_count
+
+    def __call__(self, input):
+        if self.patch_count >= self.max_patch_count:
+            raise RuntimeError('Prediction interrupted')
+        return super().__call__(input)
+
+
 class TestPredictor:
     def test_stanard_predictor(self, tmpdir, test_config):
         # Add output dir
@@ -61,8 +85,307 @@ class TestPredictor:
             # run the model prediction on the entire dataset and save to the 'output_file' H5
             predictor.predict()
 
+    @pytest.mark.parametrize('predictor_name', ['StandardPredictor', 'LazyPredictor'])
+    @pytest.mark.parametrize('blending', ['average', 'gaussian'])
+    def test_blending(self, tmpdir, predictor_name, blending):
+        raw = np.random.rand(32, 128, 128).astype('float32')
+        output_file = _predict_identity(tmpdir, raw, predictor_name=predictor_name, blending=blending)
+
+        with h5py.File(output_file, 'r') as f:
+            predictions = f['predictions'][...]
+
+        assert predictions.shape == (1,) + raw.shape
+        # averaging the (weighted) predictions of the identity model has to give back the input
+        assert np.allclose(predictions[0], raw, atol=1e-5)
+
+    @pytest.mark.parametrize('predictor_name', ['StandardPredictor', 'LazyPredictor'])
+    def test_pipeline(self, tmpdir, predictor_name):
+        raw = np.random.rand(32, 128, 128).astype('float32')
+        output_file = _predict_identity(tmpdir, raw, predictor_name=predictor_name, pipeline=True, queue_size=2)
+
+        with h5py.File(output_file, 'r') as f:
+            predictions = f['predictions'][...]
+
+        assert np.allclose(predictions[0], raw, atol=1e-5)
+
+    @pytest.mark.parametrize('predictor_name', ['StandardPredictor', 'LazyPredictor'])
+    @pytest.mark.parametrize('blending', ['average', 'gaussian'])
+    def test_workers(self, tmpdir, predictor_name, blending):
+        raw = np.random.rand(32, 128, 128).astype('float32')
+        output_file = _predict_identity(tmpdir, raw, predictor_name=predictor_name, blending=blending, workers=3,
+                                        threads_per_worker=1)
+
+        with h5py.File(output_file, 'r') as f:
+            predictions = f['predictions'][...]
+
+        assert np.allclose(predictions[0], raw, atol=1e-5)
+
+    @pytest.mark.parametrize('predictor_name', ['StandardPredictor', 'LazyPredictor'])
+    def test_workers_bounded_shards(self, tmpdir, predictor_name):
+        raw = np.random.rand(32, 128, 128).astype('float32')
+        # the 2MB output is split into more shards than workers, each merged as soon as it is done
+        output_file = _predict_identity(tmpdir, raw, predictor_name=predictor_name, workers=2, threads_per_worker=1,
+                                        shard_buffer_mb=0.25, chunk_cache_mb=0.25)
+
+        with h5py.File(output_file, 'r') as f:
+            predictions = f['predictions'][...]
+
+        assert np.allclose(predictions[0], raw, atol=1e-5)
+
+    @pytest.mark.parametrize('predictor_name', ['StandardPredictor', 'LazyPredictor'])
+    @pytest.mark.parametrize('blending', ['average', 'gaussian'])
+    @pytest.mark.parametrize('workers', [1, 2])
+    def test_mirror_padding(self, tmpdir, predictor_name, blending, workers):
+        raw = np.random.rand(32, 128, 128).astype('float32')
+        output_file = _predict_identity(tmpdir, raw, predictor_name=predictor_name, mirror_padding=(8, 16, 16),
+                                        blending=blending, workers=workers)
+
+        with h5py.File(output_file, 'r') as f:
+            predictions = f['predictions'][...]
+
+        # predictions of the padded border are cropped while stitching
+        assert predictions.shape == (1,) + raw.shape
+        assert np.allclose(predictions[0], raw, atol=1e-5)
+
+    @pytest.mark.parametrize('roi', [((0, 32, 32), (32, 96, 96)), ((8, 16, 48), (24, 112, 128))])
+    def test_roi(self, tmpdir, roi):
+        raw = np.random.rand(32, 128, 128).astype('float32')
+        raw_transforms = [{'name': 'Standardize'}]
+        full_file = _predict_identity(str(tmpdir.mkdir('full')), raw, mirror_padding=(8, 16, 16),
+                                      raw_transforms=raw_transforms)
+        roi_file = _predict_identity(str(tmpdir.mkdir('roi')), raw, mirror_padding=(8, 16, 16),
+                                     raw_transforms=raw_transforms, roi=roi)
+
+        with h5py.File(full_file, 'r') as f:
+            full_predictions = f['predictions'][...]
+        with h5py.File(roi_file, 'r') as f:
+            roi_predictions = f['predictions'][...]
+
+        # the roi is normalized with the statistics of the whole volume
+        (z0, y0, x0), (z1, y1, x1) = roi
+        assert np.allclose(roi_predictions, full_predictions[:, z0:z1, y0:y1, x0:x1], atol=1e-5)
+
+    @pytest.mark.parametrize('predictor_name', ['StandardPredictor', 'LazyPredictor'])
+    @pytest.mark.parametrize('output_format', ['zarr', 'n5'])
+    def test_zarr_output(self, tmpdir, predictor_name, output_format):
+        pytest.importorskip('zarr')
+        raw = np.random.rand(32, 128, 128).astype('float32')
+        output_file = _predict_identity(tmpdir, raw, predictor_name=predictor_name, output_format=output_format,
+                                        blending='gaussian')
+
+        predictions = open_zarr(output_file, mode='r')['predictions'][...]
+        assert np.allclose(predictions[0], raw, atol=1e-5)
+
+    @pytest.mark.parametrize('mirror_padding', [None, (8, 16, 16)])
+    def test_predict_array(self, mirror_padding):
+        raw = np.random.rand(32, 128, 128).astype('float32')
+        config = {
+            'model': {'out_channels': 1, 'output_heads': 1},
+            'device': torch.device('cpu'),
+            'loaders': {
+                'batch_size': 2,
+                'mirror_padding': mirror_padding,
+                'test': {
+                    'slice_builder': {'name': 'SliceBuilder', 'patch_shape': (16, 64, 64), 'stride_shape': (8, 32, 32)},
+                    'transformer': {'raw': [{'name': 'ToTensor', 'expand_dims': True, 'dtype': 'float32'}]}
+                }
+            }
+        }
+        predictor = StandardPredictor(FakeModel(), None, None, config, patch_halo=(4, 8, 8))
 
+        for volume in [raw, torch.from_numpy(raw)]:
+            predictions = predictor.predict_array(volume)
+            assert predictions.shape == (1,) + raw.shape
+            assert np.allclose(predictions[0], raw, atol=1e-5)
 
+    @pytest.mark.parametrize('skip_empty', [None, {'threshold': 0.5, 'background': 0.25}])
+    def test_predict_array_slabs(self, skip_empty):
+        raw = np.random.rand(48, 96, 96).astype('float32')
+        raw[:16] = 0.25
+        config = {
+            'model': {'out_channels': 1, 'output_heads': 1},
+            'device': torch.device('cpu'),
+            'loaders': {
+                'batch_size': 2,
+                'mirror_padding': (8, 16, 16),
+                'test': {
+                    'slice_builder': {'name': 'SliceBuilder', 'patch_shape': (16, 64, 64), 'stride_shape': (8, 32, 32)},
+                    'transformer': {'raw': [{'name': 'ToTensor', 'expand_dims': True, 'dtype': 'float32'}]}
+                }
+            }
+        }
+        predictor = StandardPredictor(FakeModel(), None, None, config, skip_empty=skip_empty)
+
+        slabs = list(predictor.predict_array_slabs(raw))
+        # the slabs are yielded in order as soon as they are final
+        assert len(slabs) > 1
+        assert [z_stop for _, z_stop, _ in slabs[:-1]] == [z_start for z_start, _, _ in slabs[1:]]
+        assert slabs[0][0] == 0 and slabs[-1][1] == raw.shape[0]
+        predictions = np.concatenate([slab for _, _, slab in slabs], axis=1)
+        assert np.allclose(predictions, predictor.predict_array(raw), atol=1e-6)
+        assert np.allclose(predictions[0], raw, atol=1e-5)
+
+    @pytest.mark.parametrize('tta', ['flip', 'rot90', 'all'])
+    def test_tta(self, tmpdir, tta):
+        raw = np.random.rand(32, 128, 128).astype('float32')
+        output_file = _predict_identity(tmpdir, raw, tta=tta)
+
+        with h5py.File(output_file, 'r') as f:
+            predictions = f['predictions'][...]
+
+        # every variant is transformed back before averaging
+        assert np.allclose(predictions[0], raw, atol=1e-5)
+
+    def test_tta_variants(self):
+        assert len(_tta_variants('flip', (16, 64, 64))) == 8
+        assert len(_tta_variants('rot90', (16, 64, 64))) == 4
+        assert len(_tta_variants('all', (16, 64, 64))) == 16
+        # 90 degree rotations are skipped for non-square patches
+        assert len(_tta_variants('rot90', (16, 64, 32))) == 2
+
+        batch = torch.rand(2, 1, 4, 8, 8)
+        for variant in _tta_variants('all', batch.shape[2:]):
+            assert torch.equal(_deaugment(_augment(batch, variant), variant), batch)
+
+    @pytest.mark.parametrize('predictor_name', ['StandardPredictor', 'LazyPredictor'])
+    @pytest.mark.parametrize('threshold', [None, 0.5])
+    def test_skip_empty(self, tmpdir, predictor_name, threshold):
+        raw = np.zeros((32, 128, 128), dtype='float32')
+        raw[:8, :40, :40] = np.random.rand(8, 40, 40) + 1
+
+        model = CountingModel()
+        output_file = _predict_identity(tmpdir, raw, predictor_name=predictor_name, model=model,
+                                        skip_empty={'threshold': threshold})
+
+        with h5py.File(output_file, 'r') as f:
+            predictions = f['predictions'][...]
+
+        assert np.allclose(predictions[0], raw, atol=1e-5)
+        # only the patches overlapping with the foreground are predicted
+        assert model.patch_count == 4
+
+    @pytest.mark.parametrize('predictor_name', ['StandardPredictor', 'LazyPredictor'])
+    def test_skip_empty_workers(self, tmpdir, predictor_name):
+        # non-zero background equal to the (identity) prediction of the empty patches
+        raw = np.full((32, 128, 128), 0.25, dtype='float32')
+        raw[:8, :40, :40] = np.random.rand(8, 40, 40) + 1
+
+        output_file = _predict_identity(tmpdir, raw, predictor_name=predictor_name, workers=2, threads_per_worker=1,
+                                        skip_empty={'threshold': 0.5, 'background': 0.25})
+
+        with h5py.File(output_file, 'r') as f:
+            predictions = f['predictions'][...]
+
+        # the chunks covered only by the background patches are not normalized twice
+        assert np.allclose(predictions[0], raw, atol=1e-5)
+
+    def test_resume(self, tmpdir):
+        raw = np.random.rand(32, 128, 128).astype('float32')
+
+        # interrupt the prediction after 20 out of 27 patches
+        with pytest.raises(RuntimeError):
+            _predict_identity(tmpdir, raw, predictor_name='LazyPredictor', model=FailingModel(20), resume=True,
+                              journal_sync_every=1)
+        gc.collect()
+
+        journal_path = os.path.join(tmpdir, 'output.h5.journal')
+        with open(journal_path, 'r') as f:
+            # header + final chunks
+            assert len(f.readlines()) > 1
+
+        model = CountingModel()
+        output_file = _predict_identity(tmpdir, raw, predictor_name='LazyPredictor', model=model, resume=True)
+
+        with h5py.File(output_file, 'r') as f:
+            predictions = f['predictions'][...]
+
+        assert np.allclose(predictions[0], raw, atol=1e-5)
+        # completed patches are not predicted again
+        assert model.patch_count < 27
+        # journal is removed after the prediction is done
+        assert not os.path.exists(journal_path)
+
+    def test_pipeline_error(self):
+        def _fail(item):
+            raise ValueError(item)
+
+        with pytest.raises(RuntimeError):
+            with _Pipeline([lambda item: item, _fail], queue_size=1) as pipeline:
+                for i in range(10):
+                    pipeline.put(i)
+
+    @pytest.mark.parametrize('blending', ['average', 'gaussian'])
+    def test_stitcher_normalization(self, blending):
+        volume_shape = (32, 64, 64)
+        patch_shape = (16, 32, 32)
+        grid = [(slice(z, z + 16), slice(y, y + 32), slice(x, x + 32))
+                for z in [0, 8, 16] for y in [0, 16, 32] for x in [0, 16, 32]]
+
+        def _stitch(slices, indices):
+            stitcher = _PatchStitcher(volume_shape, blending, (4, 8, 8), slices=slices)
+            prediction_map = np.zeros((2,) + volume_shape, dtype='float32')
+            for index in indices:
+                stitcher.stitch(np.ones((1, 2) + patch_shape, dtype='float32'), [index], prediction_map)
+            return stitcher.normalize(prediction_map)
+
+        # separable weights computed from the regular grid
+        assert np.allclose(_stitch(grid, grid), 1)
+        # weights accumulated while stitching
+        assert np.allclose(_stitch(None, grid), 1)
+        # irregular patch positions: skip the central patch
+        irregular = grid[:13] + grid[14:]
+        assert np.allclose(_stitch(irregular, irregular), _stitch(None, irregular), equal_nan=True)
+
+    @pytest.mark.parametrize('max_cache_size', [1024 ** 3, 1])
+    @pytest.mark.parametrize('normalize', [False, True])
+    def test_chunk_accumulator(self, tmpdir, max_cache_size, normalize):
+        volume_shape = (32, 64, 64)
+        slices = [(slice(z, z + 16), slice(y, y + 32), slice(x, x + 32))
+                  for z in [0, 8, 16] for y in [0, 16, 32] for x in [0, 16, 32]]
+
+        with h5py.File(os.path.join(tmpdir, 'output.h5'), 'w') as f:
+            dataset = f.create_dataset('predictions', shape=(2,) + volume_shape, dtype='float32',
+                                       chunks=(2, 8, 16, 16))
+            visits = np.zeros(volume_shape, dtype='float32')
+            for index in slices:
+                visits[index] += 1
+
+            def _normalize(chunk, chunk_slices):
+                chunk /= visits[chunk_slices]
+                return chunk
+
+            accumulator = _ChunkAccumulator(dataset, patch_slices=slices, max_cache_size=max_cache_size,
+                                            normalize=_normalize if normalize else None)
+
+            flushed = []
+            _flush = accumulator._flush
+            accumulator._flush = lambda chunk_id, **kwargs: flushed.append(chunk_id) or _flush(chunk_id, **kwargs)
+
+            expected = np.zeros((2,) + volume_shape, dtype='float32')
+            for index in slices:
+                patch = np.random.rand(2, 16, 32, 32).astype('float32')
+                accumulator.add((slice(0, 2),) + index, patch)
+                expected[(slice(0, 2),) + index] += patch
+
+            if max_cache_size > 1:
+                # every chunk is written exactly once while accumulating the patches
+                assert len(accumulator._cache) == 0
+                assert len(flushed) == len(set(flushed)) == 4 * 4 * 4
+
+            accumulator.close()
+            if normalize:
+                expected /= visits
+            assert np.allclose(dataset[...], expected)
+
+    def test_gaussian_importance_map(self):
+        importance_map = gaussian_importance_map((16, 32, 32))
+
+        assert importance_map.shape == (16, 32, 32)
+        assert np.all(importance_map > 0)
+        assert np.isclose(importance_map.max(), 1)
+        # the map is symmetric and highest in the center of the patch
+        assert np.allclose(importance_map, importance_map[::-1, ::-1, ::-1])
+        assert importance_map[8, 16, 16] > importance_map[0, 16, 16]
 
     def test_embeddings_predictor(self, tmpdir):
         config = {
@@ -121,3 +444,41 @@ class TestPredictor:
 
         assert np.array_equal(input[:, 4:16, 4:16, 4:16], u_patch)
         assert u_index == (slice(0, 1), slice(116, 128), slice(116, 128), slice(116, 128))
+
+
+def _predict_identity(tmpdir, raw, patch_shape=(16, 64, 64), stride_shape=(8, 32, 32),
+                      predictor_name='StandardPredictor', model=None, mirror_padding=None, output_format='h5', roi=None,
+                      raw_transforms=(), **predictor_kwargs):
+    input_file = os.path.join(tmpdir, 'input.h5')
+    with h5py.File(input_file, 'w') as f:
+        f.create_dataset('raw', data=raw)
+
+    slice_builder_config = {
+        'name': 'SliceBuilder',
+        'patch_shape': patch_shape,
+        'stride_shape': stride_shape
+    }
+    config = {
+        'model': {'out_channels': 1, 'output_heads': 1},
+        'device': torch.device('cpu'),
+        'loaders': {'test': {'slice_builder': slice_builder_config}}
+    }
+    transformer_config = {
+        'raw': list(raw_transforms) + [
+            {'name': 'ToTensor', 'expand_dims': True, 'dtype': 'float32'}
+        ]
+    }
+
+    dataset = StandardHDF5Dataset(input_file, phase='test',
+                                  slice_builder_config=slice_builder_config,
+                                  transformer_config=transformer_config,
+                                  mirror_padding=mirror_padding,
+                                  roi=roi)
+    loader = DataLoader(dataset, batch_size=2, num_workers=1, shuffle=False, collate_fn=prediction_collate)
+
+    output_file = os.path.join(tmpdir, 'output.' + output_format)
+    predictor_kwargs['patch_halo'] = predictor_kwargs.get('patch_halo', (4, 8, 8))
+    predictor_class = {'StandardPredictor': StandardPredictor, 'LazyPredictor': LazyPredictor}[predictor_name]
+    predictor = predictor_class(model or FakeModel(), loader, output_file, config, **predictor_kwargs)
+    predictor.predict()
+    return output_file
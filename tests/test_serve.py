@@ -0,0 +1,112 @@
+import io
+import json
+import os
+import threading
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import h5py
+import numpy as np
+import pytest
+import torch
+
+from pytorch3dunet.serve import PredictionService, create_server
+from pytorch3dunet.unet3d.model import get_model
+from pytorch3dunet.unet3d.predictor import StandardPredictor
+
+
+class TestPredictionServer:
+    def test_predict(self, tmpdir, test_config):
+        config = _create_config(tmpdir, test_config)
+        service = PredictionService({'unet': config}, data_root=str(tmpdir))
+        server = create_server(service, port=0)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        url = f'http://127.0.0.1:{server.server_address[1]}'
+
+        try:
+            with urllib.request.urlopen(f'{url}/models') as response:
+                assert json.loads(response.read()) == {'models': ['unet']}
+
+            volumes = [np.random.rand(48, 96, 96).astype('float32') for _ in range(3)]
+            # concurrent requests are micro-batched by the server
+            with ThreadPoolExecutor(max_workers=3) as executor:
+                results = list(executor.map(lambda v: _post_array(f'{url}/predict/unet', v), volumes))
+
+            model = get_model(config)
+            model.load_state_dict(torch.load(config['model_path'])['model_state_dict'])
+            predictor = StandardPredictor(model, None, None, config)
+            for volume, result in zip(volumes, results):
+                assert result.shape == (2,) + volume.shape
+                assert np.allclose(result, predictor.predict_array(volume), atol=1e-5)
+
+            # the slabs of the predictions are streamed back as soon as they are final
+            slabs = _post_array_stream(f'{url}/predict/unet?stream=true', volumes[0])
+            assert len(slabs) > 1
+            assert np.allclose(np.concatenate(slabs, axis=1), results[0], atol=1e-5)
+
+            # predict H5 file with the options of the loaders config
+            input_path = os.path.join(tmpdir, 'input.h5')
+            with h5py.File(input_path, 'w') as f:
+                f.create_dataset('raw', data=volumes[0])
+            config['loaders']['stats_cache'] = True
+            output_paths = _post_json(f'{url}/predict', {'path': input_path, 'output_dir': 'out'})['output_paths']
+            assert output_paths == [os.path.join(tmpdir, 'out', 'input_predictions.h5')]
+            with h5py.File(output_paths[0], 'r') as f:
+                assert np.allclose(f['predictions'][...], results[0], atol=1e-5)
+            assert os.path.exists(input_path + '.stats.json')
+
+            # paths outside of the data root are rejected
+            for request in [{'path': '/etc/passwd'}, {'path': input_path, 'output_dir': '../'}]:
+                with pytest.raises(urllib.error.HTTPError) as e:
+                    _post_json(f'{url}/predict', request)
+                assert e.value.code == 403
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+def _create_config(tmpdir, test_config):
+    test_config['model'].update({'f_maps': 8, 'num_groups': 4})
+    test_config['device'] = torch.device('cpu')
+    test_config['loaders'].update({'batch_size': 2, 'mirror_padding': None, 'num_workers': 0})
+    test_config['loaders']['test']['transformer'] = {
+        'raw': [
+            {'name': 'Standardize'},
+            {'name': 'ToTensor', 'expand_dims': True, 'dtype': 'float32'}
+        ]
+    }
+
+    model_path = os.path.join(tmpdir, 'model.pytorch')
+    torch.save({'model_state_dict': get_model(test_config).state_dict()}, model_path)
+    test_config['model_path'] = model_path
+    return test_config
+
+
+def _post_json(url, content):
+    request = urllib.request.Request(url, data=json.dumps(content).encode(),
+                                     headers={'Content-Type': 'application/json'})
+    with urllib.request.urlopen(request) as response:
+        return json.loads(response.read())
+
+
+def _post_array(url, volume):
+    buffer = io.BytesIO()
+    np.save(buffer, volume)
+    request = urllib.request.Request(url, data=buffer.getvalue(), headers={'Content-Type': 'application/octet-stream'})
+    with urllib.request.urlopen(request) as response:
+        return np.load(io.BytesIO(response.read()))
+
+
+def _post_array_stream(url, volume):
+    buffer = io.BytesIO()
+    np.save(buffer, volume)
+    request = urllib.request.Request(url, data=buffer.getvalue(), headers={'Content-Type': 'application/octet-stream'})
+    with urllib.request.urlopen(request) as response:
+        assert response.headers['Transfer-Encoding'] == 'chunked'
+        data = io.BytesIO(response.read())
+    slabs = []
+    while data.tell() < len(data.getbuffer()):
+        slabs.append(np.lib.format.read_array(data))
+    return slabs
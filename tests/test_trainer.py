@@ -40,6 +40,18 @@ class TestUNet3DTrainer:
         with capsys.disabled():
             assert_train_save_load(tmpdir, train_config, 'CrossEntropyLoss', 'MeanIoU', 'ResidualUNet3D')
 
+    def test_weighted_sampler(self, tmpdir, capsys, train_config):
+        train_config['loaders']['train']['sampler'] = {
+            'name': 'WeightedPatchSampler',
+            'classes': [0, 1],
+            'loss_weight': 1.0
+        }
+        with capsys.disabled():
+            trainer = _train_save_load(tmpdir, train_config, 'CrossEntropyLoss', 'MeanIoU', 'UNet3D', False,
+                                       (3, 64, 64, 64))
+        # the per-patch losses were reported back to the sampler
+        assert np.any(np.isfinite(trainer.loaders['train'].sampler.losses))
+
     def test_2d_unet(self, tmpdir, capsys, train_config_2d):
         with capsys.disabled():
             assert_train_save_load(tmpdir, train_config_2d, 'CrossEntropyLoss', 'MeanIoU', 'UNet2D',